@@ -0,0 +1,118 @@
+"""Fleet heart rate monitor benchmark:
+Compares checking every reading with ingestion.check_heart_rate against
+the fleet monitor (ring buffer updates & one vectorised evaluation per
+tick), for N concurrent bikes each sending a reading per second.
+
+Reports per tick times, readings/sec through the monitor on one core
+(queued updates & the vectorised flush & evaluation), and alerts: one per unsafe reading (per reading check) against
+one per unsafe spell (monitor transitions). The monitor's tick is the
+whole path ingestion takes: update_slot per reading, flush & evaluate.
+
+Usage:
+    python benchmark/bench_fleet_monitor.py [--bikes 100 1000 10000] [--ticks N]"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ingestion'))
+from fleet_monitor import FleetHeartRateMonitor
+from ingestion import check_heart_rate
+
+def generate_fleet(bikes: int, ticks: int, seed: int = 0) -> tuple:
+    """
+    Heart rates drift a few bpm a second, like a rider's, with the odd
+    noisy reading & dropped signal (0 bpm)
+
+    Returns:
+    - (ride ids, rider ages, heart rates: ticks x bikes)
+    """
+    rng = np.random.default_rng(seed)
+    ride_ids = [f'ride-{i}' for i in range(bikes)]
+    ages = rng.integers(16, 85, bikes)
+    start = rng.normal(115, 20, bikes)
+    heart_rates = start + rng.normal(0, 3, (ticks, bikes)).cumsum(axis=0)
+    noisy = rng.random((ticks, bikes)) < 0.01
+    heart_rates[noisy] += rng.normal(0, 40, noisy.sum())
+    heart_rates[rng.random((ticks, bikes)) < 0.005] = 0
+    return ride_ids, ages, np.clip(heart_rates, 0, 220).astype(int)
+
+def time_scalar(ride_ids: list, ages: np.ndarray, heart_rates: np.ndarray) -> dict:
+    """
+    One check_heart_rate call per reading, as ingestion did per message
+
+    Returns:
+    - dictionary of seconds per tick & alerts (unsafe readings)
+    """
+    ages = ages.tolist()
+    tick_seconds = []
+    alerts = 0
+    for readings in heart_rates.tolist():
+        start = time.perf_counter()
+        for age, heart_rate in zip(ages, readings):
+            alerts += not check_heart_rate(age, heart_rate)
+        tick_seconds.append(time.perf_counter() - start)
+    return {'tick_s': statistics.median(tick_seconds), 'alerts': alerts}
+
+def time_monitor(ride_ids: list, ages: np.ndarray, heart_rates: np.ndarray) -> dict:
+    """
+    Readings stored with FleetHeartRateMonitor.update_slot (the slot kept
+    on the ride, as ingestion does), one flush & evaluate per tick
+
+    Returns:
+    - dictionary of seconds per tick, flush (queued readings written to the
+      ring buffers) & evaluation, readings/sec & alerts (transitions to
+      unsafe, by reason)
+    """
+    monitor = FleetHeartRateMonitor()
+    slots = [monitor.add_rider(ride_id, age) for ride_id, age in zip(ride_ids, ages.tolist())]
+
+    tick_seconds = []
+    flush_seconds = []
+    evaluate_seconds = []
+    alerts = {}
+    for tick, readings in enumerate(heart_rates.tolist()):
+        start = time.perf_counter()
+        for slot, heart_rate in zip(slots, readings):
+            monitor.update_slot(slot, heart_rate)
+        flush_start = time.perf_counter()
+        monitor.flush()
+        evaluate_start = time.perf_counter()
+        transitions = monitor.evaluate(float(tick))
+        tick_seconds.append(time.perf_counter() - start)
+        flush_seconds.append(evaluate_start - flush_start)
+        evaluate_seconds.append(time.perf_counter() - evaluate_start)
+        for _, state, _, reason in transitions:
+            if state == 'unsafe':
+                alerts[reason] = alerts.get(reason, 0) + 1
+    return {
+        'tick_s': statistics.median(tick_seconds),
+        'flush_s': statistics.median(flush_seconds),
+        'evaluate_s': statistics.median(evaluate_seconds),
+        'readings_per_s': heart_rates.size / sum(tick_seconds),
+        'alerts': alerts
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bikes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--ticks', type=int, default=120)
+    args = parser.parse_args()
+
+    print(f"{'bikes':>8}{'scalar ms':>11}{'monitor ms':>12}{'flush ms':>10}{'evaluate ms':>13}{'readings/s':>12}"
+          f"{'scalar alerts':>15}  monitor alerts")
+    for bikes in args.bikes:
+        fleet = generate_fleet(bikes, args.ticks)
+        scalar = time_scalar(*fleet)
+        monitor = time_monitor(*fleet)
+        print(
+            f"{bikes:>8}{scalar['tick_s'] * 1000:>11.3f}{monitor['tick_s'] * 1000:>12.3f}"
+            f"{monitor['flush_s'] * 1000:>10.3f}{monitor['evaluate_s'] * 1000:>13.3f}{monitor['readings_per_s']:>12,.0f}"
+            f"{scalar['alerts']:>15}  {sum(monitor['alerts'].values())} {monitor['alerts']}"
+        )
+
+if __name__ == '__main__':
+    main()
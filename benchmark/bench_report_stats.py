@@ -0,0 +1,208 @@
+"""Report statistics benchmark:
+Compares the original multi-pass report statistics against the single pass
+stats cells, on a synthetic week of dash_table rides.
+
+Usage:
+    python benchmark/bench_report_stats.py [--rides-per-day N] [--db-url URL]
+
+--db-url points at a throwaway PostgreSQL database: the synthetic rides are
+written to its zuckerberg_production.dash_table to time the SQL paths."""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'visualisation'))
+from report_stats import PRODUCTION_SCHEMA, compute_stats_cells, query_stats_cells, summarise_stats
+
+SCALAR_STATS = [
+    'total_rides',
+    'total_duration',
+    'avg_heart_rate_avg',
+    'avg_bmi',
+    'avg_female_bmi',
+    'avg_male_bmi',
+    'total_power_total',
+    'avg_power_avg'
+]
+
+def generate_rides(rides_per_day: int, days: int = 7, seed: int = 0) -> pd.DataFrame:
+    """
+    Generates dash_table shaped rides spread over the last few days
+
+    Returns:
+    - rides dataframe
+    """
+    rng = np.random.default_rng(seed)
+    n = rides_per_day * days
+    start = datetime.combine(datetime.today(), datetime.min.time()) - timedelta(days=days - 1)
+    offsets = np.sort(rng.integers(0, days * 86400, n))
+
+    heart_rate_avg = rng.normal(120, 15, n)
+    power_avg = rng.gamma(4, 25, n)
+    duration = rng.uniform(60, 1800, n)
+
+    rides_df = pd.DataFrame({
+        'user_id': rng.integers(1, 5000, n),
+        'ride_id': [str(uuid.UUID(int=int(i), version=4)) for i in rng.integers(0, 2**62, n)],
+        'first_name': 'Test',
+        'last_name': 'Rider',
+        'gender': rng.choice(['female', 'male'], n),
+        'age': rng.integers(16, 85, n),
+        'bmi': rng.normal(25, 4, n).round(1),
+        'postcode': 'E1 6AN',
+        'account_creation': '2020-01-01 00:00:00',
+        'time': [(start + timedelta(seconds=int(s))).strftime('%Y-%m-%d %H:%M:%S') for s in offsets],
+        'bike_model': 'mendoza v9',
+        'resistance_avg': rng.uniform(20, 80, n),
+        'heart_rate_avg': heart_rate_avg,
+        'heart_rate_min': heart_rate_avg - 20,
+        'heart_rate_max': heart_rate_avg + 30,
+        'rpm_avg': rng.uniform(40, 90, n),
+        'rpm_min': 0.0,
+        'rpm_max': rng.uniform(90, 120, n),
+        'power_total': power_avg * duration,
+        'power_avg': power_avg,
+        'power_min': 0.0,
+        'power_max': power_avg * 2,
+        'duration_seconds': duration
+    })
+    return rides_df
+
+def legacy_stats(daily_df: pd.DataFrame) -> dict:
+    """
+    The statistics as create_email used to compute them (one pass per stat)
+
+    Returns:
+    - dictionary of statistics
+    """
+    heart_rate = daily_df[['ride_id', 'gender', 'heart_rate_avg', 'heart_rate_min', 'heart_rate_max']]
+    avg_heart_rate_avg = heart_rate['heart_rate_avg'].mean()
+
+    bmi = daily_df[['ride_id', 'gender', 'bmi']]
+    avg_bmi = bmi['bmi'].mean()
+
+    avg_bmi_gender = bmi.groupby('gender').agg({'bmi':'mean'}).reset_index()
+    avg_female_bmi = avg_bmi_gender[avg_bmi_gender['gender']=='female']['bmi'].max()
+    avg_male_bmi = avg_bmi_gender[avg_bmi_gender['gender']=='male']['bmi'].max()
+
+    power = daily_df[['ride_id', 'gender', 'power_total', 'power_avg', 'power_min', 'power_max']]
+    total_power_total = power['power_total'].sum()
+    avg_power_avg = power['power_avg'].mean()
+
+    total_rides = daily_df['ride_id'].count()
+    total_rides_gender = daily_df[['ride_id', 'gender']].groupby('gender').count()
+
+    total_duration = int(daily_df['duration_seconds'].sum())
+    total_duration_gender = daily_df[['duration_seconds', 'gender']].copy()
+    total_duration_gender['duration_seconds'] = total_duration_gender['duration_seconds'].astype(int)
+    total_duration_gender = total_duration_gender.groupby('gender').sum()
+
+    ages = daily_df[['ride_id', 'gender', 'age']]
+    age_bins = pd.cut(
+        ages['age'],
+        bins=[18, 25, 35, 45, 55, 65, np.inf],
+        labels=['18 - 25', '26 - 35', '36 - 45', '46 - 55', '56 - 65', '65+'])
+    ages_split = ages.groupby(age_bins, observed=False).agg({'ride_id': 'count'})
+    ages_gender_split = ages.groupby(['gender', age_bins], observed=False).agg({'ride_id': 'count'})
+    ages_gender_pivot = ages_gender_split.reset_index().pivot(index='age', columns='gender', values='ride_id')
+
+    return {
+        'total_rides': total_rides,
+        'total_duration': total_duration,
+        'avg_heart_rate_avg': avg_heart_rate_avg,
+        'avg_bmi': avg_bmi,
+        'avg_female_bmi': avg_female_bmi,
+        'avg_male_bmi': avg_male_bmi,
+        'total_power_total': total_power_total,
+        'avg_power_avg': avg_power_avg,
+        'rides_by_gender': total_rides_gender['ride_id'],
+        'duration_by_gender': total_duration_gender['duration_seconds'],
+        'rides_by_age': ages_split['ride_id'],
+        'rides_by_age_gender': ages_gender_pivot
+    }
+
+def time_it(func, repeats: int) -> dict:
+    """
+    Runs func repeatedly
+
+    Returns:
+    - dictionary with the best & median wall time (ms)
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'best_ms': min(timings), 'median_ms': statistics.median(timings)}
+
+def check_equivalent(expected: dict, actual: dict) -> None:
+    """
+    Asserts both stats dictionaries agree
+    """
+    for key in SCALAR_STATS:
+        assert np.isclose(expected[key], actual[key], equal_nan=True), key
+    for key in ['rides_by_gender', 'duration_by_gender', 'rides_by_age']:
+        assert expected[key].tolist() == actual[key].tolist(), key
+    assert expected['rides_by_age_gender'].values.tolist() == actual['rides_by_age_gender'].values.tolist()
+
+def run_sql_benchmark(rides_df: pd.DataFrame, db_url: str, repeats: int) -> dict:
+    """
+    Times a full table read + legacy stats against the single stats query
+
+    Returns:
+    - dictionary of timings
+    """
+    engine = sqlalchemy.create_engine(db_url)
+    with engine.begin() as con:
+        con.execute(f'CREATE SCHEMA IF NOT EXISTS {PRODUCTION_SCHEMA}')
+    rides_df.to_sql('dash_table', con=engine, schema=PRODUCTION_SCHEMA, if_exists='replace', index=False)
+
+    start = rides_df['time'].min()
+    end = '9999-12-31 00:00:00'
+
+    def read_then_aggregate():
+        week_df = pd.read_sql_query(
+            f"SELECT * FROM {PRODUCTION_SCHEMA}.dash_table WHERE time >= %(start)s",
+            con=engine,
+            params={'start': start}
+        )
+        return legacy_stats(week_df)
+
+    check_equivalent(read_then_aggregate(), summarise_stats(query_stats_cells(engine, start, end)))
+
+    return {
+        'sql: select * + legacy stats': time_it(read_then_aggregate, repeats),
+        'sql: stats query + summarise': time_it(lambda: summarise_stats(query_stats_cells(engine, start, end)), repeats)
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rides-per-day', type=int, default=5000)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--db-url', default=None)
+    args = parser.parse_args()
+
+    rides_df = generate_rides(args.rides_per_day)
+    check_equivalent(legacy_stats(rides_df), summarise_stats(compute_stats_cells(rides_df)))
+
+    results = {
+        'pandas: legacy stats': time_it(lambda: legacy_stats(rides_df), args.repeats),
+        'pandas: stats cells + summarise': time_it(lambda: summarise_stats(compute_stats_cells(rides_df)), args.repeats)
+    }
+    if args.db_url:
+        results.update(run_sql_benchmark(rides_df, args.db_url, args.repeats))
+
+    print(f'{len(rides_df)} rides over 7 days')
+    for name, timing in results.items():
+        print(f"{name:<40} best {timing['best_ms']:>9.2f} ms   median {timing['median_ms']:>9.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Transformation benchmark:
+clean_dataframes on synthetic staging data, at each size given:
+- memory: default pd.read_sql_query dtypes against the compact staging
+  schema (tranformation.STAGING_DTYPES)
+- joins: the original string-keyed merges & MultiIndex groupby against the
+  categorical ride keys, named aggregation & indexed joins
+- ride summaries: every ride summarised during ingestion (staging
+  ride_summary), so only user attributes are joined
+
+Usage:
+    python benchmark/bench_transformation.py [--metric-rows N [N ...]] [--repeats N]
+
+Memory is reported per million metric rows:
+- frames: the staging dataframes, deep (strings included)
+- peak: extra memory allocated whilst clean_dataframes runs (tracemalloc)"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'transformation'))
+import tranformation
+
+BIKE_MODELS = ['mendoza v8', 'mendoza v9', 'mendoza v10']
+
+def generate_staging(metric_rows: int, rides: int, users: int, seed: int = 0) -> dict:
+    """
+    Generates staging tables with the dtypes pd.read_sql_query returns
+    (object strings & 64 bit numbers)
+
+    Returns:
+    Dictionary with dataframes:
+    - user dataframe
+    - user_ride dataframe
+    - metrics dataframe
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = np.arange(1, users + 1)
+    birth_days = pd.Timestamp('1950-01-01') + pd.to_timedelta(rng.integers(0, 50 * 365, users), unit='D')
+
+    user_df = pd.DataFrame({
+        'user_id': user_ids,
+        'first_name': 'Test',
+        'last_name': [f'Rider{i}' for i in user_ids],
+        'gender': rng.choice(['female', 'male'], users),
+        'postcode': 'E1 6AN',
+        'date_of_birth': birth_days.strftime('%Y-%m-%d %H:%M:%S'),
+        'email': [f'rider{i}@example.com' for i in user_ids],
+        'height_cm': rng.integers(150, 200, users),
+        'weight_kg': rng.integers(50, 110, users),
+        'account_creation': '2020-01-01 00:00:00'
+    })
+
+    ride_ids = np.array([str(uuid.UUID(int=int(i), version=4)) for i in rng.integers(0, 2**62, rides)], dtype=object)
+    user_ride_df = pd.DataFrame({
+        'user_id': rng.choice(user_ids, rides),
+        'ride_id': ride_ids
+    })
+
+    # consecutive rows per ride, one per second, like the staged logs
+    ride_index = np.sort(rng.integers(0, rides, metric_rows))
+    ride_start = np.concatenate([[True], ride_index[1:] != ride_index[:-1]])
+    starts = np.maximum.accumulate(np.where(ride_start, np.arange(metric_rows), 0))
+    seconds = np.arange(metric_rows) - starts
+    times = pd.Timestamp('2022-10-01') + pd.to_timedelta(ride_index * 3600 + seconds, unit='s')
+
+    metrics_df = pd.DataFrame({
+        'ride_id': ride_ids[ride_index],
+        'time': times.strftime('%Y-%m-%d %H:%M:%S'),
+        'bike_model': np.array(BIKE_MODELS, dtype=object)[ride_index % len(BIKE_MODELS)],
+        'duration_seconds': seconds.astype('float64'),
+        'resistance': rng.integers(10, 100, metric_rows),
+        'heart_rate': rng.integers(60, 190, metric_rows),
+        'rpm': rng.integers(0, 120, metric_rows),
+        'power': rng.gamma(4, 25, metric_rows)
+    })
+
+    return {'user_df': user_df, 'user_ride_df': user_ride_df, 'metrics_df': metrics_df}
+
+def compact_staging(df_dict: dict) -> dict:
+    """
+    Returns:
+    - copies of the staging dataframes in the compact schema
+    """
+    return {
+        'user_df': tranformation.set_staging_dtypes(df_dict['user_df'].copy(), 'user_table'),
+        'user_ride_df': df_dict['user_ride_df'].copy(),
+        'metrics_df': tranformation.set_staging_dtypes(df_dict['metrics_df'].copy(), 'metrics_table')
+    }
+
+def summarise_staging(df_dict: dict) -> dict:
+    """
+    Stands in for the ingestion's streaming ride summaries: every ride has
+    a ride_summary row (dtypes as pd.read_sql_query returns them) & no raw
+    metrics are left to aggregate
+
+    Returns:
+    - copies of the staging dataframes, with a ride_summary dataframe
+    """
+    metrics_df = df_dict['metrics_df']
+    ride_summary_df = tranformation.aggregate_rides(metrics_df).reset_index()
+
+    return {
+        'user_df': tranformation.set_staging_dtypes(df_dict['user_df'].copy(), 'user_table'),
+        'user_ride_df': df_dict['user_ride_df'].copy(),
+        'metrics_df': tranformation.set_staging_dtypes(metrics_df.iloc[:0].copy(), 'metrics_table'),
+        'ride_summary_df': ride_summary_df
+    }
+
+def frames_bytes(df_dict: dict) -> int:
+    """
+    Returns:
+    - deep memory usage of every dataframe (bytes)
+    """
+    return sum(int(df.memory_usage(deep=True).sum()) for df in df_dict.values())
+
+def profile_clean(func, df_dict: dict, repeats: int) -> dict:
+    """
+    Runs a clean_dataframes implementation untraced (time), then traced (peak memory)
+
+    Returns:
+    - dictionary of best seconds, peak bytes & the ride dataframe
+    """
+    ride_df = func(df_dict)
+    seconds = time_best(func, df_dict, repeats)
+
+    tracemalloc.start()
+    func(df_dict)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': seconds, 'peak': peak, 'ride_df': ride_df}
+
+def legacy_clean_dataframes(df_dict: dict) -> pd.DataFrame:
+    """
+    clean_dataframes with its original joins: merges on object ride_id &
+    user_id columns and a MultiIndex groupby copied out column by column
+
+    Returns:
+    - ride dataframe
+    """
+    user_df = df_dict['user_df']
+    metrics_df = df_dict['metrics_df'].assign(ride_id=df_dict['metrics_df']['ride_id'].astype(object))
+
+    updated_user = pd.DataFrame({
+        'user_id': user_df['user_id'],
+        'first_name': user_df['first_name'],
+        'last_name': user_df['last_name'],
+        'gender': user_df['gender'],
+        'age': tranformation.calculate_ages(user_df['date_of_birth']),
+        'bmi': tranformation.calculate_bmis(user_df['weight_kg'], user_df['height_cm']),
+        'postcode': user_df['postcode'],
+        'account_creation': tranformation.format_times(user_df['account_creation'])
+    })
+    user_merge_df = df_dict['user_ride_df'].merge(updated_user, on='user_id', how='left', sort=False)
+
+    grouped_metrics = metrics_df.groupby('ride_id').agg({
+        'time':'first',
+        'bike_model':'first',
+        'resistance':'mean',
+        'heart_rate':['mean','min','max'],
+        'rpm':['mean','min','max'],
+        'power':['sum','mean','min','max'],
+        'duration_seconds':'max'
+    }).reset_index()
+
+    updated_metrics = pd.DataFrame()
+    updated_metrics['ride_id'] = grouped_metrics['ride_id']
+    updated_metrics['time'] = tranformation.format_times(grouped_metrics['time']['first'])
+    updated_metrics['bike_model'] = grouped_metrics['bike_model']['first']
+    for column, aggregations in [('resistance', ['mean']), ('heart_rate', ['mean', 'min', 'max']),
+                                 ('rpm', ['mean', 'min', 'max']), ('power', ['sum', 'mean', 'min', 'max'])]:
+        for aggregation in aggregations:
+            name = {'mean': 'avg', 'sum': 'total'}.get(aggregation, aggregation)
+            updated_metrics[f'{column}_{name}'] = grouped_metrics[column][aggregation]
+    updated_metrics['duration_seconds'] = grouped_metrics['duration_seconds']['max']
+
+    ride_df = user_merge_df.merge(updated_metrics, on='ride_id', how='left', sort=False)
+    return tranformation.restore_output_dtypes(ride_df)
+
+def time_best(func, df_dict: dict, repeats: int) -> float:
+    """
+    Returns:
+    - best wall time of func(df_dict) over the repeats (s)
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(df_dict)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def check_equivalent(expected: pd.DataFrame, actual: pd.DataFrame) -> None:
+    """
+    Asserts both ride dataframes agree (float32 metrics to 1e-6 relative)
+    """
+    expected = expected.sort_values('ride_id').reset_index(drop=True)
+    actual = actual.sort_values('ride_id').reset_index(drop=True)
+    assert list(expected.columns) == list(actual.columns)
+    for column in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[column]):
+            assert np.allclose(expected[column], actual[column], rtol=1e-6, equal_nan=True), column
+        else:
+            assert expected[column].fillna('').equals(actual[column].fillna('')), column
+
+def run_size(metric_rows: int, users: int, repeats: int) -> None:
+    """
+    Prints the memory & join results for one size
+    """
+    rides = max(metric_rows // 1200, 1)
+    default_dict = generate_staging(metric_rows, rides, users)
+    compact_dict = compact_staging(default_dict)
+    summary_dict = summarise_staging(default_dict)
+    default_bytes = frames_bytes(default_dict)
+
+    # the compact schema before categorical ride keys, to isolate the join changes
+    object_key_dict = dict(compact_dict, metrics_df=compact_dict['metrics_df'].assign(ride_id=default_dict['metrics_df']['ride_id']))
+    del default_dict
+
+    runs = [
+        ('original joins, object keys', legacy_clean_dataframes, object_key_dict),
+        ('indexed joins, object keys', tranformation.clean_dataframes, object_key_dict),
+        ('indexed joins, categorical keys', tranformation.clean_dataframes, compact_dict),
+        ('ride summaries, user joins only', tranformation.clean_dataframes, summary_dict)
+    ]
+    results = [profile_clean(func, df_dict, repeats) for _, func, df_dict in runs]
+    for result in results[1:]:
+        check_equivalent(results[0]['ride_df'], result['ride_df'])
+
+    per_million = 1_000_000 / metric_rows / 2**20
+    print(f'\n{metric_rows} metric rows, {rides} rides, {users} users')
+    print(f"staging frames (MB per million metric rows): default dtypes {default_bytes * per_million:.1f}, "
+          f"compact {frames_bytes(object_key_dict) * per_million:.1f}, "
+          f"compact + categorical ride_id {frames_bytes(compact_dict) * per_million:.1f}, "
+          f"ride summaries {frames_bytes(summary_dict) * per_million:.1f}")
+    print(f"{'clean_dataframes':<34}{'seconds':>10}{'speedup':>10}{'peak MB/M':>12}")
+    for (name, _, _), result in zip(runs, results):
+        print(
+            f"{name:<34}{result['seconds']:>10.3f}{results[0]['seconds'] / result['seconds']:>9.1f}x"
+            f"{result['peak'] * per_million:>12.1f}"
+        )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metric-rows', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for metric_rows in args.metric_rows:
+        run_size(metric_rows, args.users, args.repeats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Synthetic Deloton workload:
+Generates realistic Kafka log sequences ([SYSTEM], Ride & Telemetry) for N
+bikes riding back to back over T hours, ending now.
+
+Each bike is its own ordered stream, as a Kafka partition would be.
+
+Usage:
+    python benchmark/generator.py --riders N --hours T --output DIR
+
+Writes DIR/bike_<n>.jsonl recordings, replayable with ingestion/replay.py."""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import random
+
+FIRST_NAMES = ['Alex', 'Sam', 'Jamie', 'Charlie', 'Morgan', 'Riley', 'Jordan', 'Casey', 'Robin', 'Drew']
+LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Wright']
+POSTCODES = ['E1 6AN', 'SW1A 1AA', 'M1 1AE', 'B33 8TH', 'CR2 6XH', 'DN55 1PT', 'W1A 0AX', 'EC1A 1BB']
+BIKE_MODELS = ['mendoza v9', 'mendoza v8', 'mendoza v10']
+
+def log_time(moment: datetime) -> str:
+    """
+    Returns:
+    - timestamp in the Deloton log format (microseconds)
+    """
+    return moment.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def create_user(rng: random.Random, user_id: int, now: datetime) -> dict:
+    """
+    Returns:
+    - user dictionary, as found in the [SYSTEM] data of a ride
+    """
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+    date_of_birth = now - timedelta(days=rng.randint(18 * 365, 80 * 365))
+    account_creation = now - timedelta(days=rng.randint(1, 3 * 365))
+
+    user = {
+        'user_id': user_id,
+        'name': f'{first_name} {last_name}',
+        'gender': rng.choice(['female', 'male']),
+        'address': f'{rng.randint(1, 200)} High Street,London,{rng.choice(POSTCODES)}',
+        'date_of_birth': int(date_of_birth.timestamp() * 1000),
+        'email_address': f'{first_name.lower()}.{last_name.lower()}{user_id}@example.com',
+        'height_cm': rng.randint(150, 200),
+        'weight_kg': rng.randint(50, 110),
+        'account_create_date': int(account_creation.timestamp() * 1000),
+        'bike_serial': f'SN{rng.randint(0, 99999):05d}',
+        'original_source': rng.choice(['offline', 'online'])
+    }
+    return user
+
+def generate_ride(rng: random.Random, bike_model: str, user: dict, start: datetime, seconds: int) -> list:
+    """
+    Generates one ride: start marker, [SYSTEM] user data, a Ride & Telemetry
+    pair per second, then the end of ride marker
+
+    Returns:
+    - list of message values ({"log": ...})
+    """
+    prefix = f'{bike_model}:'
+    logs = [
+        f'{log_time(start)} {prefix} [INFO]: ----------------------- beginning of a new ride ----------------------------',
+        f'{log_time(start + timedelta(milliseconds=500))} {prefix} [SYSTEM] data = {json.dumps(user)}'
+    ]
+
+    age = (start - datetime.utcfromtimestamp(user['date_of_birth'] / 1000)).days // 365
+    heart_rate = rng.uniform(70, 90)
+    target_heart_rate = (220 - age) * rng.uniform(0.45, 0.8)
+    resistance = rng.choice([30, 40, 50, 60, 70])
+
+    for second in range(1, seconds + 1):
+        moment = start + timedelta(seconds=second)
+        heart_rate += (target_heart_rate - heart_rate) * 0.05 + rng.gauss(0, 1.5)
+        if rng.random() < 0.01:
+            resistance = rng.choice([30, 40, 50, 60, 70])
+        rpm = max(0, int(rng.gauss(70, 8)))
+        power = rpm * resistance * 0.05 * rng.uniform(0.9, 1.1)
+        # the sensor occasionally drops out and reports 0
+        recorded_heart_rate = 0 if rng.random() < 0.002 else int(heart_rate)
+
+        logs.append(f'{log_time(moment)} {prefix} [INFO]: Ride - duration = {float(second)}; resistance = {resistance}')
+        logs.append(
+            f'{log_time(moment + timedelta(milliseconds=500))} {prefix} [INFO]: Telemetry - '
+            f'hrt = {recorded_heart_rate}; rpm = {rpm}; power = {power:.11f}'
+        )
+
+    end = start + timedelta(seconds=seconds + 1)
+    logs.append(f'{log_time(end)} {prefix} [INFO]: --------- beginning of main')
+
+    return [{'log': log} for log in logs]
+
+def generate_bike_stream(bike: int, hours: float, users: int = 1000, seed: int = 0, now: datetime = None) -> list:
+    """
+    Generates back to back rides on one bike for the given number of hours,
+    ending now (UTC, like the live stream)
+
+    Returns:
+    - list of message values ({"log": ...}), in order
+    """
+    rng = random.Random(f'{seed}-{bike}')
+    now = now or datetime.utcnow()
+    # bikes don't all start a ride in the same second (nor can one rider be on two bikes)
+    moment = now - timedelta(hours=hours) + timedelta(seconds=rng.randint(0, 300))
+    bike_model = BIKE_MODELS[bike % len(BIKE_MODELS)]
+
+    stream = []
+    while True:
+        seconds = rng.randint(5 * 60, 30 * 60)
+        if moment + timedelta(seconds=seconds + 1) > now:
+            break
+        user = create_user(rng, rng.randint(1, users), now)
+        stream.extend(generate_ride(rng, bike_model, user, moment, seconds))
+        moment += timedelta(seconds=seconds + rng.randint(30, 300))
+
+    return stream
+
+def generate_fleet(riders: int, hours: float, users: int = 1000, seed: int = 0) -> list:
+    """
+    Returns:
+    - list of bike streams (see generate_bike_stream), one per concurrent rider
+    """
+    now = datetime.utcnow()
+    return [generate_bike_stream(bike, hours, users, seed, now) for bike in range(riders)]
+
+def write_fleet(fleet: list, output: str) -> list:
+    """
+    Writes one recording per bike
+
+    Returns:
+    - list of recording paths
+    """
+    os.makedirs(output, exist_ok=True)
+    paths = []
+    for bike, stream in enumerate(fleet):
+        path = os.path.join(output, f'bike_{bike}.jsonl')
+        with open(path, 'w', encoding='utf-8') as recording:
+            recording.writelines(json.dumps(msg_value) + '\n' for msg_value in stream)
+        paths.append(path)
+    return paths
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--riders', type=int, default=10)
+    parser.add_argument('--hours', type=float, default=1)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    fleet = generate_fleet(args.riders, args.hours, args.users, args.seed)
+    paths = write_fleet(fleet, args.output)
+    print(f'{sum(len(stream) for stream in fleet)} messages written to {len(paths)} recordings in {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Lambda harness:
+Runs the transformation or report handler the way AWS Lambda does, to
+compare cold starts against warm invocations locally.
+
+Each container is a fresh Python process: the handler module is imported
+(init), then invoked --invocations times. The first invocation is the cold
+start; the rest reuse the module scope (engine, imports) like warm Lambdas.
+Init is split into the handler's third party imports (each timed on top of
+the ones before it, e.g. pandas without numpy) & the rest of the module.
+
+Usage:
+    python benchmark/lambda_harness.py transformation --db-url URL [--containers N] [--invocations N]
+    python benchmark/lambda_harness.py report --db-url URL [--event '{"period": "weekly"}']
+
+The report is rendered but not sent: TO_EMAIL is cleared and the event has
+no recipients unless --event gives some."""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HANDLERS = {
+    'transformation': os.path.join(ROOT, 'transformation', 'tranformation.py'),
+    'report': os.path.join(ROOT, 'visualisation', 'report.py')
+}
+
+# Third party modules each handler imports at module scope, in import order
+HANDLER_IMPORTS = {
+    'transformation': ['dotenv', 'numpy', 'pandas', 'sqlalchemy'],
+    'report': ['boto3', 'dotenv', 'numpy', 'pandas', 'sqlalchemy']
+}
+
+DEFAULT_EVENTS = {
+    'transformation': {},
+    'report': {'period': 'daily', 'recipients': []}
+}
+
+class LambdaContext:
+    """
+    The parts of the Lambda context object the handlers may use
+    """
+
+    def __init__(self, function_name: str, timeout_seconds: int = 900):
+        self.function_name = function_name
+        self.memory_limit_in_mb = 1024
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+def run_container(service: str, event: dict, invocations: int) -> dict:
+    """
+    Child process: imports the handler module, then invokes it repeatedly
+
+    Returns:
+    - dictionary of init seconds (with each import's) & per-invocation results
+    """
+    path = HANDLERS[service]
+    sys.path.insert(0, os.path.dirname(path))
+
+    imports_seconds = {}
+    for name in HANDLER_IMPORTS[service]:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        imports_seconds[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(service, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    init_seconds = time.perf_counter() - start + sum(imports_seconds.values())
+
+    results = []
+    for _ in range(invocations):
+        start = time.perf_counter()
+        module.handler(dict(event), LambdaContext(service))
+        results.append(time.perf_counter() - start)
+
+    return {'init_s': init_seconds, 'imports_s': imports_seconds, 'invocations_s': results}
+
+def summarise(containers: list) -> dict:
+    """
+    Returns:
+    - dictionary of median init (& per import), cold & warm invocation times (s)
+    """
+    warm = [seconds for container in containers for seconds in container['invocations_s'][1:]]
+    return {
+        'containers': len(containers),
+        'init_s': statistics.median(container['init_s'] for container in containers),
+        'imports_s': {
+            name: statistics.median(container['imports_s'][name] for container in containers)
+            for name in containers[0]['imports_s']
+        },
+        'cold_invocation_s': statistics.median(container['invocations_s'][0] for container in containers),
+        'cold_total_s': statistics.median(container['init_s'] + container['invocations_s'][0] for container in containers),
+        'warm_invocation_s': statistics.median(warm) if warm else None,
+        'warm_invocations': len(warm)
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('service', choices=sorted(HANDLERS))
+    parser.add_argument('--db-url', required=True)
+    parser.add_argument('--containers', type=int, default=3, help='fresh processes, one cold start each')
+    parser.add_argument('--invocations', type=int, default=5, help='invocations per container')
+    parser.add_argument('--event', type=json.loads, default=None)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    event = args.event if args.event is not None else DEFAULT_EVENTS[args.service]
+    if args.child:
+        print(json.dumps(run_container(args.service, event, args.invocations)))
+        return
+
+    from bench_pipeline import set_db_environment
+    set_db_environment(args.db_url)
+    env = dict(os.environ, TO_EMAIL='')
+
+    containers = []
+    for _ in range(args.containers):
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), args.service, '--child', '--db-url', args.db_url,
+             '--invocations', str(args.invocations), '--event', json.dumps(event)],
+            env=env, capture_output=True, text=True, check=True
+        )
+        containers.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    results = summarise(containers)
+    if args.json:
+        print(json.dumps({'summary': results, 'containers': containers}, indent=2))
+        return
+
+    print(f"{args.service}: {results['containers']} containers x {args.invocations} invocations (medians)")
+    print(f"init (imports):    {results['init_s']:.3f}s")
+    for name, seconds in results['imports_s'].items():
+        print(f"  import {name + ':':<11}{seconds:.3f}s")
+    print(f"cold invocation:   {results['cold_invocation_s']:.3f}s  (init + cold: {results['cold_total_s']:.3f}s)")
+    if results['warm_invocation_s'] is not None:
+        print(f"warm invocation:   {results['warm_invocation_s']:.3f}s  ({results['warm_invocations']} invocations)")
+
+if __name__ == '__main__':
+    main()
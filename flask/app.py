@@ -8,7 +8,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, jsonify, request, make_response
 from flask_cors import CORS
 import psycopg2
-from sqlalchemy import desc
+from sqlalchemy import desc, text
+
+from timeline import TIMELINE_METHODS, TIMELINE_QUERY, downsample_timeline
 
 
 # Credentials
@@ -23,6 +25,10 @@ DB_NAME = os.getenv('DB_NAME')
 
 PRODUCTION_SCHEMA = 'zuckerberg_production'
 
+# Points per series returned by /ride/:id/timeline
+TIMELINE_POINTS = int(os.getenv('TIMELINE_POINTS', '500'))
+MAX_TIMELINE_POINTS = int(os.getenv('MAX_TIMELINE_POINTS', '2000'))
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -60,6 +66,31 @@ class Rides(db.Model):
     def __repr__(self):
         return '<Rides %r>' % self.ride_id
 
+# Each rider's latest profile & lifetime totals, updated by the transformation per finished ride
+class RiderSummary(db.Model):
+    __tablename__ = 'rider_summary'
+    __table_args__ = {'schema':PRODUCTION_SCHEMA}
+    user_id = db.Column(db.Integer, primary_key=True, nullable = False)
+    first_name = db. Column(db.Text, nullable = False)
+    last_name = db. Column(db.Text, nullable = False)
+    gender = db. Column(db.Text, nullable = False)
+    age = db. Column(db.Integer, nullable = False)
+    bmi = db. Column(db.Float, nullable = False)
+    postcode = db. Column(db.Text, nullable = False)
+    account_creation = db. Column(db.Text, nullable = False)
+    rides = db. Column(db.Integer, nullable = False)
+    duration_total = db. Column(db.Float, nullable = False)
+    power_total = db. Column(db.Float, nullable = False)
+    power_best = db. Column(db.Float)
+    heart_rate_avg = db. Column(db.Float)
+    heart_rate_avg_sum = db. Column(db.Float, nullable = False)
+    heart_rate_avg_count = db. Column(db.Integer, nullable = False)
+    first_ride = db. Column(db.Text, nullable = False)
+    last_ride = db. Column(db.Text, nullable = False)
+
+    def __repr__(self):
+        return '<RiderSummary %r>' % self.user_id
+
 row_dict = lambda r: {c.name: str(getattr(r, c.name)) for c in r.__table__.columns}
 
 # Home
@@ -75,8 +106,10 @@ def index():
             <li>get ride by ride_id</li>
             <li>delete ride by ride_id</li>
         </ul>
+    - /ride/:id/timeline?points&method
+        <ul><li>get ride heart rate, power, rpm & resistance downsampled to points per series (lttb or minmax)</li></ul>
     - /rider/:id
-        <ul><li>get user by user_id</li></ul>
+        <ul><li>get user & lifetime totals by user_id</li></ul>
     - /rider/:id/rides
         <ul><li>get rides by user_id</li></ul>
     - /daily
@@ -108,19 +141,52 @@ def get_ride(id):
         db.session.query(Rides).filter(Rides.ride_id == id).first().delete()
         return jsonify(ride), 200
 
+# Get downsampled telemetry by ride_id
+@app.route('/ride/<id>/timeline', methods=['GET'])
+def get_ride_timeline(id):
+    try:
+        points = int(request.args.get('points', TIMELINE_POINTS))
+    except ValueError:
+        return jsonify('points must be a number'), 400
+    method = request.args.get('method', 'lttb')
+    if not 3 <= points <= MAX_TIMELINE_POINTS:
+        return jsonify(f'points must be between 3 and {MAX_TIMELINE_POINTS}'), 400
+    if method not in TIMELINE_METHODS:
+        return jsonify(f"method must be one of: {', '.join(TIMELINE_METHODS)}"), 400
+
+    res = db.session.execute(text(TIMELINE_QUERY), {'ride_id': id}).fetchall()
+    if not res:
+        return jsonify(f'No telemetry for ride: {id}'), 404
+    timeline = {
+        'ride_id':id,
+        'method':method,
+        'points':points,
+        'readings':len(res),
+        'series':downsample_timeline(res, points, method)
+    }
+    return jsonify(timeline), 200
+
 # Get user by user_id
 @app.route('/rider/<id>', methods=['GET'])
 def get_user(id):
-    res = db.session.query(Rides).filter(Rides.user_id == id).all()
+    res = db.session.query(RiderSummary).filter(RiderSummary.user_id == id).first()
+    if res is None:
+        return jsonify(f'No rider: {id}'), 404
     user = {
-        'rides':len(res),
-        'user_id':res[0].user_id,
-        'first_name':res[0].first_name,
-        'last_name':res[0].last_name,
-        'gender':res[0].gender,
-        'bmi':res[0].bmi,
-        'postcode':res[0].postcode,
-        'account_creation':res[0].account_creation        
+        'rides':res.rides,
+        'user_id':res.user_id,
+        'first_name':res.first_name,
+        'last_name':res.last_name,
+        'gender':res.gender,
+        'bmi':res.bmi,
+        'postcode':res.postcode,
+        'account_creation':res.account_creation,
+        'duration_total':res.duration_total,
+        'power_total':res.power_total,
+        'power_best':res.power_best,
+        'heart_rate_avg':res.heart_rate_avg,
+        'first_ride':res.first_ride,
+        'last_ride':res.last_ride
     }
     return jsonify(user), 200
 
@@ -0,0 +1,92 @@
+"""Ride timeline:
+Downsamples a ride's telemetry (one reading a second in metrics_table) to
+a fixed number of points, so the payload & render time of a timeline stay
+the same however long the ride was.
+
+- lttb: largest-triangle-three-buckets, keeps the points that shape the
+  line most (peaks & troughs included), good for reading a trace
+- minmax: the lowest & highest reading of each bucket, so no extreme is
+  ever dropped, good for spotting spikes"""
+import numpy as np
+
+STAGING_SCHEMA = 'zuckerberg_staging'
+
+TIMELINE_SERIES = ['heart_rate', 'power', 'rpm', 'resistance']
+TIMELINE_METHODS = ['lttb', 'minmax']
+
+TIMELINE_QUERY = f"""
+    SELECT duration_seconds, {', '.join(TIMELINE_SERIES)}
+    FROM {STAGING_SCHEMA}.metrics_table
+    WHERE ride_id = :ride_id
+    ORDER BY duration_seconds
+"""
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets: keeps the first & last reading, and from
+    each bucket in between the one making the largest triangle with the point
+    kept before it & the mean of the next bucket
+
+    Returns:
+    - indexes of the readings kept, in order
+    """
+    readings = len(x)
+    if points >= readings or points < 3:
+        return np.arange(readings)
+
+    # points - 2 buckets over the readings between the first & last
+    edges = np.linspace(1, readings - 1, points - 1).astype(int)
+    kept = np.empty(points, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = readings - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else readings
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
+
+def min_max(y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Splits the readings into points / 2 buckets & keeps the lowest and
+    highest reading of each
+
+    Returns:
+    - indexes of the readings kept, in order
+    """
+    readings = len(y)
+    buckets = points // 2
+    if points >= readings or buckets < 1:
+        return np.arange(readings)
+
+    edges = np.linspace(0, readings, buckets + 1).astype(int)
+    kept = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        bucket = y[start:end]
+        kept += [start + int(np.argmin(bucket)), start + int(np.argmax(bucket))]
+    return np.unique(kept)
+
+def downsample_timeline(rows: list, points: int, method: str = 'lttb') -> dict:
+    """
+    Downsamples each telemetry series of a ride on its own, against the
+    ride's duration
+    - rows: (duration_seconds, heart_rate, power, rpm, resistance), in order
+
+    Returns:
+    - dictionary of series -> {'duration_seconds': [...], 'value': [...]}
+    """
+    readings = np.array([tuple(row) for row in rows], dtype=np.float64).reshape(-1, len(TIMELINE_SERIES) + 1)
+    x = readings[:, 0]
+    timeline = {}
+    for column, name in enumerate(TIMELINE_SERIES, start=1):
+        y = readings[:, column]
+        kept = lttb(x, y, points) if method == 'lttb' else min_max(y, points)
+        timeline[name] = {'duration_seconds': x[kept].tolist(), 'value': y[kept].tolist()}
+    return timeline
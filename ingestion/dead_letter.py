@@ -0,0 +1,47 @@
+"""Dead-letter file:
+Messages the ingestion could not parse or apply, one JSON record per line,
+so they can be inspected & replayed (replay.py) once the cause is fixed.
+
+Each record holds the reason, error, topic, partition, offset & raw value."""
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+from confluent_kafka import Message
+
+from metrics import DEAD_LETTERS
+
+DEAD_LETTER_PATH = os.getenv('DEAD_LETTER_PATH', 'dead_letter.jsonl')
+
+class DeadLetterFile:
+    """
+    Appends dead-lettered messages to a JSON lines file
+    Shared by the parse workers & sequencer, so writes hold a lock
+    """
+
+    def __init__(self, path: str = DEAD_LETTER_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, reason: str, msg: Message, error: Exception) -> None:
+        """
+        Records a message that will not be staged
+        """
+        DEAD_LETTERS.labels(reason).inc()
+        record = {
+            'reason': reason,
+            'error': f'{type(error).__name__}: {error}',
+            'topic': msg.topic(),
+            'partition': msg.partition(),
+            'offset': msg.offset(),
+            'dead_lettered_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'value': msg.value().decode('utf-8', errors='replace')
+        }
+        logging.warning("Dead-lettered message at offset %s (%s): %s", msg.offset(), reason, error)
+        try:
+            with self.lock, open(self.path, 'a', encoding='utf-8') as dead_letters:
+                dead_letters.write(json.dumps(record) + '\n')
+        except OSError as e:
+            logging.error("Error raised whilst writing dead letter to %s: %s", self.path, e)
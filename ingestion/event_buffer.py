@@ -0,0 +1,324 @@
+"""Ride event buffer:
+Pairs Ride & Telemetry records by their log timestamps rather than their
+arrival order, so reordered or redelivered messages still make the right
+metrics rows.
+
+- records go to the ride whose start (& end) marker brackets their time
+- a Telemetry record pairs with the closest Ride record at most
+  PAIR_SECONDS before it
+- the watermark (latest log time - REORDER_SECONDS, moving on with the
+  clock once the stream goes idle) expires records still without a partner
+  & closes a ride once it passes the ride's end
+- memory is bounded: at most MAX_OPEN_RIDES rides & MAX_PENDING_RECORDS
+  unpaired records per ride, the oldest are dropped beyond that
+
+The buffer counts its own overhead (see stats): records held, time held
+before pairing & time spent in the buffer."""
+from collections import Counter
+from datetime import datetime
+import os
+import time
+
+from dotenv import load_dotenv
+
+from metrics import BUFFER_SECONDS, BUFFERED_RECORDS, MESSAGES_DROPPED
+
+load_dotenv()
+REORDER_SECONDS = float(os.getenv('REORDER_SECONDS', '2.0'))
+PAIR_SECONDS = float(os.getenv('PAIR_SECONDS', '1.0'))
+MAX_OPEN_RIDES = int(os.getenv('MAX_OPEN_RIDES', '4'))
+MAX_PENDING_RECORDS = int(os.getenv('MAX_PENDING_RECORDS', '64'))
+
+EPOCH = datetime(1970, 1, 1)
+
+def event_seconds(event_time: str) -> float:
+    """
+    Returns:
+    - log time as seconds since the epoch
+    - None if the time can't be read
+    """
+    try:
+        return (datetime.fromisoformat(event_time) - EPOCH).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+class BufferedRide:
+    """
+    A ride's event time range, unpaired records & what the ingestion keeps
+    about it (ride id, user info, running summary, fleet monitor slot)
+    """
+
+    def __init__(self, start: float):
+        self.start = start
+        self.end = None
+        self.ride_id = ''
+        self.user_info = {}
+        self.summary = None
+        self.slot = None
+        # unpaired (seconds, arrived, record), in arrival order
+        self.rides = []
+        self.telemetry = []
+        # pairs made before the ride was identified by its [SYSTEM] log
+        self.held = []
+
+    def pending(self) -> int:
+        """
+        Returns:
+        - records held by the ride
+        """
+        return len(self.rides) + len(self.telemetry) + 2 * len(self.held)
+
+class RideEventBuffer:
+    """
+    Event-time buffer of the rides on one stream, oldest ride first
+    Pairs are returned as (ride, ride record, telemetry record)
+    """
+
+    def __init__(self, reorder_seconds: float = REORDER_SECONDS, pair_seconds: float = PAIR_SECONDS,
+                 max_open_rides: int = MAX_OPEN_RIDES, max_pending: int = MAX_PENDING_RECORDS):
+        self.reorder_seconds = reorder_seconds
+        self.pair_seconds = pair_seconds
+        self.max_open_rides = max_open_rides
+        self.max_pending = max_pending
+        self.open_rides = []
+        self.latest = None
+        self.latest_at = None
+        self.stats = Counter()
+
+    def clock(self, idle: bool = False) -> float:
+        """
+        Whilst idle, the time since the latest record counts as log time,
+        so the last ride closes without waiting for the next one
+
+        Returns:
+        - latest log time, as seconds since the epoch (None before the first record)
+        """
+        if self.latest is None:
+            return None
+        return self.latest + (time.monotonic() - self.latest_at if idle else 0.0)
+
+    def watermark(self, idle: bool = False) -> float:
+        """
+        Returns:
+        - log time before which records are late (None before the first record)
+        """
+        clock = self.clock(idle)
+        return None if clock is None else clock - self.reorder_seconds
+
+    def observe(self, seconds: float) -> None:
+        """
+        Moves the latest log time on
+        """
+        if self.latest is None or seconds > self.latest:
+            self.latest = seconds
+            self.latest_at = time.monotonic()
+
+    def drop(self, reason: str, count: int = 1) -> None:
+        """
+        Counts records dropped by the buffer
+        """
+        if count:
+            MESSAGES_DROPPED.labels(reason).inc(count)
+            self.stats[f'dropped_{reason}'] += count
+
+    def find_ride(self, seconds: float) -> BufferedRide:
+        """
+        Returns:
+        - the open ride whose time range holds the log time
+        - None if no open ride does
+        """
+        for ride in reversed(self.open_rides):
+            if ride.start <= seconds:
+                return ride if ride.end is None or seconds <= ride.end else None
+        return None
+
+    def current_ride(self) -> BufferedRide:
+        """
+        Returns:
+        - the most recently started ride, if still open
+        """
+        return self.open_rides[-1] if self.open_rides else None
+
+    def is_open(self) -> bool:
+        """
+        Returns:
+        - True whilst any ride is still open
+        """
+        return bool(self.open_rides)
+
+    def open_ride(self, start_time: str) -> list:
+        """
+        Opens a ride at its start marker; a ride still without an end marker
+        ends here
+
+        Returns:
+        - rides closed to stay within max_open_rides
+        """
+        started = time.perf_counter()
+        seconds = event_seconds(start_time)
+        if seconds is None:
+            seconds = self.latest or 0.0
+        self.observe(seconds)
+
+        current = self.current_ride()
+        if current is not None and current.end is None:
+            current.end = seconds
+        self.open_rides.append(BufferedRide(seconds))
+        self.stats['rides_opened'] += 1
+
+        closed = []
+        while len(self.open_rides) > self.max_open_rides:
+            closed.append(self.close(self.open_rides[0], 'overflow'))
+        self.stats['seconds'] += time.perf_counter() - started
+        return closed
+
+    def identify(self, ride_id: str, user_info: dict) -> list:
+        """
+        Attaches the [SYSTEM] log's ride id & user to the current ride
+
+        Returns:
+        - pairs held until the ride was identified
+        """
+        ride = self.current_ride()
+        if ride is None:
+            return []
+        ride.ride_id = ride_id
+        ride.user_info = user_info
+        held, ride.held = ride.held, []
+        return [(ride, ride_record, telemetry) for ride_record, telemetry in held]
+
+    def end_ride(self, end_time: str) -> None:
+        """
+        Ends the current ride at its end marker
+        """
+        ride = self.current_ride()
+        seconds = event_seconds(end_time)
+        if seconds is None:
+            seconds = self.latest or 0.0
+        self.observe(seconds)
+        if ride is not None and ride.end is None:
+            ride.end = seconds
+
+    def add(self, kind: str, record: dict, event_time: str) -> list:
+        """
+        Buffers a 'ride' or 'telemetry' record until its partner arrives
+
+        Returns:
+        - pairs completed by the record (at most one)
+        """
+        started = time.perf_counter()
+        try:
+            seconds = event_seconds(event_time)
+            if seconds is None:
+                seconds = self.latest or 0.0
+            watermark = self.watermark()
+            self.observe(seconds)
+
+            ride = self.find_ride(seconds)
+            if ride is None:
+                self.drop('outside_ride')
+                return []
+
+            arrived = time.monotonic()
+            if kind == 'ride':
+                partners = [item for item in ride.telemetry if 0 <= item[0] - seconds <= self.pair_seconds]
+                partner = min(partners, key=lambda item: item[0], default=None)
+                unpaired = ride.rides
+            else:
+                partners = [item for item in ride.rides if 0 <= seconds - item[0] <= self.pair_seconds]
+                partner = max(partners, key=lambda item: item[0], default=None)
+                unpaired = ride.telemetry
+
+            if partner is None:
+                if watermark is not None and seconds < watermark:
+                    self.drop('late')
+                    return []
+                unpaired.append((seconds, arrived, record))
+                self.trim(ride)
+                return []
+
+            (ride.telemetry if kind == 'ride' else ride.rides).remove(partner)
+            BUFFER_SECONDS.observe(arrived - partner[1])
+            self.stats['pairs'] += 1
+            pair = (record, partner[2]) if kind == 'ride' else (partner[2], record)
+            if not ride.ride_id:
+                ride.held.append(pair)
+                self.trim(ride)
+                return []
+            return [(ride, *pair)]
+        finally:
+            self.stats['max_buffered'] = max(self.stats['max_buffered'], self.buffered())
+            self.stats['seconds'] += time.perf_counter() - started
+
+    def trim(self, ride: BufferedRide) -> None:
+        """
+        Drops a ride's oldest records beyond max_pending
+        """
+        while ride.pending() > self.max_pending:
+            if ride.held:
+                ride.held.pop(0)
+                self.drop('unidentified_ride', 2)
+            else:
+                records = ride.rides if len(ride.rides) >= len(ride.telemetry) else ride.telemetry
+                records.pop(0)
+                self.drop('buffer_overflow')
+
+    def advance(self, idle: bool = False) -> list:
+        """
+        Expires records the watermark has passed without a partner &
+        closes the rides it has passed the end of
+
+        Returns:
+        - closed rides
+        """
+        started = time.perf_counter()
+        watermark = self.watermark(idle)
+        closed = []
+        if watermark is not None:
+            for ride in list(self.open_rides):
+                if ride.end is not None and ride.end < watermark:
+                    closed.append(self.close(ride, 'closed'))
+                    continue
+                expired = [item for item in ride.rides if item[0] + self.pair_seconds < watermark]
+                if expired:
+                    ride.rides = [item for item in ride.rides if item[0] + self.pair_seconds >= watermark]
+                    self.drop('unpaired_ride', len(expired))
+                expired = [item for item in ride.telemetry if item[0] < watermark]
+                if expired:
+                    ride.telemetry = [item for item in ride.telemetry if item[0] >= watermark]
+                    self.drop('unpaired_telemetry', len(expired))
+
+        BUFFERED_RECORDS.set(self.buffered())
+        self.stats['seconds'] += time.perf_counter() - started
+        return closed
+
+    def close(self, ride: BufferedRide, reason: str) -> BufferedRide:
+        """
+        Removes a ride, dropping whatever it still holds
+
+        Returns:
+        - the ride
+        """
+        self.open_rides.remove(ride)
+        self.drop('unpaired_ride', len(ride.rides))
+        self.drop('unpaired_telemetry', len(ride.telemetry))
+        self.drop('unidentified_ride', 2 * len(ride.held))
+        ride.rides, ride.telemetry, ride.held = [], [], []
+        self.stats[f'rides_{reason}'] += 1
+        return ride
+
+    def close_all(self) -> list:
+        """
+        Closes every open ride, e.g. at the end of a recording
+
+        Returns:
+        - closed rides
+        """
+        return [self.close(ride, 'closed') for ride in list(self.open_rides)]
+
+    def buffered(self) -> int:
+        """
+        Returns:
+        - records held across the open rides
+        """
+        return sum(ride.pending() for ride in self.open_rides)
@@ -0,0 +1,357 @@
+"""Fleet heart rate monitor:
+Keeps the recent heart rates of every active rider in NumPy arrays, next to
+safe bounds worked out once when the rider is identified, and checks the
+whole fleet in one vectorised pass per tick rather than one Python check
+per reading.
+
+- safe range: 50-70% of the rider's maximum heart rate (220 - age), the
+  same rule as ingestion.check_heart_rate
+- each ride has a ring buffer of its last ANOMALY_WINDOW_READINGS non-zero
+  readings & their running sum, rows of NumPy arrays, so the rolling mean
+  costs nothing to read
+- update() only queues the reading (O(1)); the queue is written to the
+  ring buffers in one vectorised pass at the next evaluation, so a tick
+  costs a few array operations however many bikes sent readings
+- evaluate() flags a ride unsafe at once when its latest reading is
+  outside the hard limits (HARD_LOWER_FRACTION-HARD_UPPER_FRACTION of the
+  maximum heart rate), as the per reading check did for the safe range
+- otherwise it flags a ride unsafe when, for long enough:
+  - spike: SPIKE_BPM or more away from the rolling mean of the readings
+    before it, for SPIKE_SECONDS
+  - sustained: out of the safe range for SUSTAINED_SECONDS
+  - no_signal: 0 bpm for NO_SIGNAL_SECONDS, after a heart rate was seen
+  so a single noisy reading inside the hard limits no longer raises an
+  alert, and a zero is only safe until it lasts; a reading just outside
+  the safe range is alerted SUSTAINED_SECONDS later than it used to be
+- only changes are returned: (ride id, 'unsafe' | 'safe', heart rate, reason),
+  so a rider is alerted once per unsafe spell rather than once per reading
+- slots of finished rides are reused & the arrays double when full, so
+  thousands of concurrent bikes fit in a few small arrays"""
+import os
+import time
+
+from dotenv import load_dotenv
+import numpy as np
+
+load_dotenv()
+ALERT_TICK_SECONDS = float(os.getenv('ALERT_TICK_SECONDS', '1.0'))
+ANOMALY_WINDOW_READINGS = int(os.getenv('ANOMALY_WINDOW_READINGS', '30'))
+SUSTAINED_SECONDS = float(os.getenv('SUSTAINED_SECONDS', '20'))
+SPIKE_BPM = float(os.getenv('SPIKE_BPM', '30'))
+SPIKE_SECONDS = float(os.getenv('SPIKE_SECONDS', '1'))
+NO_SIGNAL_SECONDS = float(os.getenv('NO_SIGNAL_SECONDS', '10'))
+HARD_LOWER_FRACTION = float(os.getenv('HARD_LOWER_FRACTION', '0.4'))
+HARD_UPPER_FRACTION = float(os.getenv('HARD_UPPER_FRACTION', '0.85'))
+
+INITIAL_CAPACITY = 1024
+# Readings in the window before its rolling mean is trusted for spikes
+SPIKE_MIN_READINGS = 10
+
+# Queued readings are packed as slot << HEART_RATE_BITS | bpm, one int each
+HEART_RATE_BITS = 16
+MAX_HEART_RATE = (1 << HEART_RATE_BITS) - 1
+
+# Reason codes, in order of precedence
+REASONS = ['', 'limit', 'spike', 'sustained', 'no_signal']
+
+def heart_rate_bounds(ages: np.ndarray) -> tuple:
+    """
+    Safe heart rate range for each age (years)
+
+    Returns:
+    - (lower bounds, upper bounds) in bpm
+    """
+    max_heart_rates = 220 - np.asarray(ages, dtype=np.float64)
+    return max_heart_rates * 0.5, max_heart_rates * 0.7
+
+def hard_heart_rate_limits(ages: np.ndarray) -> tuple:
+    """
+    Heart rate range for each age (years) outside which a single reading is unsafe
+
+    Returns:
+    - (lower limits, upper limits) in bpm
+    """
+    max_heart_rates = 220 - np.asarray(ages, dtype=np.float64)
+    return max_heart_rates * HARD_LOWER_FRACTION, max_heart_rates * HARD_UPPER_FRACTION
+
+def check_heart_rates(heart_rates: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """
+    Vectorised ingestion.check_heart_rate
+
+    Returns:
+    - boolean array, True where safe
+    """
+    return ((lower <= heart_rates) & (heart_rates <= upper)) | (heart_rates == 0)
+
+def held_since(since: np.ndarray, flagged: np.ndarray, now: float, seconds: float) -> np.ndarray:
+    """
+    Moves each start time on: kept whilst flagged, set to now when first
+    flagged, cleared (NaN) otherwise
+
+    Returns:
+    - boolean array, True where flagged for at least seconds
+    """
+    since[:] = np.where(flagged, np.fmin(since, now), np.nan)
+    return now - since >= seconds
+
+class FleetHeartRateMonitor:
+    """
+    Recent heart rates & safe bounds of every active rider, one slot each
+    Not thread safe: used by the sequencer (ride state) thread only
+    """
+
+    def __init__(self, tick_seconds: float = ALERT_TICK_SECONDS, capacity: int = INITIAL_CAPACITY,
+                 window: int = ANOMALY_WINDOW_READINGS, sustained_seconds: float = SUSTAINED_SECONDS,
+                 spike_bpm: float = SPIKE_BPM, spike_seconds: float = SPIKE_SECONDS,
+                 no_signal_seconds: float = NO_SIGNAL_SECONDS):
+        self.tick_seconds = tick_seconds
+        self.sustained_seconds = sustained_seconds
+        self.spike_bpm = spike_bpm
+        self.spike_seconds = spike_seconds
+        self.no_signal_seconds = no_signal_seconds
+        self.window_size = window
+        # per ride: latest reading, ring buffer of non-zero readings, safe bounds
+        self.heart_rates = np.zeros(capacity, dtype=np.float64)
+        self.windows = np.zeros((capacity, window), dtype=np.float64)
+        self.positions = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.sums = np.zeros(capacity, dtype=np.float64)
+        self.lower = np.zeros(capacity, dtype=np.float64)
+        self.upper = np.zeros(capacity, dtype=np.float64)
+        self.hard_lower = np.zeros(capacity, dtype=np.float64)
+        self.hard_upper = np.zeros(capacity, dtype=np.float64)
+        # per ride: when each condition was first seen (NaN whilst it isn't)
+        self.spike_since = np.full(capacity, np.nan)
+        self.out_of_band_since = np.full(capacity, np.nan)
+        self.no_signal_since = np.full(capacity, np.nan)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.reasons = np.zeros(capacity, dtype=np.int8)
+        self.slots = {}
+        self.ride_ids = [None] * capacity
+        self.riders = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        # slots below this have been used; evaluate() only reads these
+        self.used = 0
+        # readings queued by update() since the last flush, in arrival order
+        self.queued = []
+        self.last_evaluated = None
+
+    def grow(self) -> None:
+        """
+        Doubles the capacity of every array
+        """
+        capacity = len(self.heart_rates)
+        for name in ['heart_rates', 'windows', 'positions', 'counts', 'sums', 'lower', 'upper',
+                     'hard_lower', 'hard_upper', 'active', 'reasons']:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        for name in ['spike_since', 'out_of_band_since', 'no_signal_since']:
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(capacity, np.nan)]))
+        self.ride_ids += [None] * capacity
+        self.riders += [None] * capacity
+        self.free += range(2 * capacity - 1, capacity - 1, -1)
+
+    def add_rider(self, ride_id: str, age: int, rider: dict = None) -> int:
+        """
+        Starts monitoring a ride, working out its safe bounds once
+        - rider: whatever the alert needs (e.g. name & email), returned by get_rider
+
+        Returns:
+        - the ride's slot, for update_slot
+        """
+        slot = self.slots.get(ride_id)
+        if slot is None:
+            if not self.free:
+                self.grow()
+            slot = self.free.pop()
+            self.used = max(self.used, slot + 1)
+            self.slots[ride_id] = slot
+            self.ride_ids[slot] = ride_id
+            self.heart_rates[slot] = 0
+            self.windows[slot] = 0
+            self.positions[slot] = 0
+            self.counts[slot] = 0
+            self.sums[slot] = 0
+            self.spike_since[slot] = np.nan
+            self.out_of_band_since[slot] = np.nan
+            self.no_signal_since[slot] = np.nan
+            self.reasons[slot] = 0
+            self.active[slot] = True
+
+        lower, upper = heart_rate_bounds(age)
+        self.lower[slot] = lower
+        self.upper[slot] = upper
+        hard_lower, hard_upper = hard_heart_rate_limits(age)
+        self.hard_lower[slot] = hard_lower
+        self.hard_upper[slot] = hard_upper
+        self.riders[slot] = dict(rider or {}, age=age)
+        return slot
+
+    def remove_rider(self, ride_id: str) -> None:
+        """
+        Stops monitoring a finished ride & frees its slot
+        """
+        slot = self.slots.pop(ride_id, None)
+        if slot is not None:
+            # queued readings belong to this ride, not the next one given the slot
+            self.flush()
+            self.active[slot] = False
+            self.reasons[slot] = 0
+            self.ride_ids[slot] = None
+            self.riders[slot] = None
+            self.free.append(slot)
+
+    def update(self, ride_id: str, heart_rate: int) -> bool:
+        """
+        Queues a rider's latest heart rate, in constant time, for the next
+        flush (see flush)
+
+        Returns:
+        - False if the ride isn't monitored
+        """
+        slot = self.slots.get(ride_id)
+        if slot is None:
+            return False
+        self.update_slot(slot, heart_rate)
+        return True
+
+    def update_slot(self, slot: int, heart_rate: int) -> None:
+        """
+        update for a caller that kept the slot add_rider returned, skipping
+        the ride id lookup (valid until remove_rider)
+        """
+        if heart_rate > MAX_HEART_RATE:
+            heart_rate = MAX_HEART_RATE
+        self.queued.append(slot << HEART_RATE_BITS | heart_rate)
+
+    def flush(self) -> None:
+        """
+        Writes the queued readings to the latest heart rates & ring buffers in
+        one vectorised pass (0 bpm, no signal, is kept out of the window)
+        A ride with several queued readings takes them in rounds, in arrival order
+        """
+        if not self.queued:
+            return
+        # one list of packed ints converts to NumPy far faster than two lists
+        queued = np.fromiter(self.queued, dtype=np.int64, count=len(self.queued))
+        self.queued = []
+        slots = queued >> HEART_RATE_BITS
+        heart_rates = (queued & MAX_HEART_RATE).astype(np.float64)
+
+        if np.bincount(slots).max() == 1:
+            self.write_readings(slots, heart_rates)
+            return
+        # each reading's place among its ride's queued readings
+        order = np.argsort(slots, kind='stable')
+        sorted_slots = slots[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_slots[1:] != sorted_slots[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(slots)])
+        rounds = np.empty(len(slots), dtype=np.int64)
+        rounds[order] = np.arange(len(slots)) - np.repeat(group_starts, group_sizes)
+        for round_ in range(int(group_sizes.max())):
+            in_round = rounds == round_
+            self.write_readings(slots[in_round], heart_rates[in_round])
+
+    def write_readings(self, slots: np.ndarray, heart_rates: np.ndarray) -> None:
+        """
+        Writes one reading per ride to the latest heart rates & ring buffers
+        """
+        self.heart_rates[slots] = heart_rates
+        signal = heart_rates != 0
+        if not signal.all():
+            slots = slots[signal]
+            heart_rates = heart_rates[signal]
+        positions = self.positions[slots]
+        # flat indexes into the ring buffers, cheaper than indexing rows & columns
+        cells = slots * self.window_size + positions
+        windows = self.windows.reshape(-1)
+        self.sums[slots] += heart_rates - windows[cells]
+        windows[cells] = heart_rates
+        self.positions[slots] = (positions + 1) % self.window_size
+        self.counts[slots] = np.minimum(self.counts[slots] + 1, self.window_size)
+
+    def get_rider(self, ride_id: str) -> dict:
+        """
+        Returns:
+        - the rider details given to add_rider (with age)
+        """
+        return self.riders[self.slots[ride_id]]
+
+    def rolling_mean(self, ride_id: str) -> float:
+        """
+        Returns:
+        - mean of the ride's window of non-zero readings (0 if empty)
+        """
+        self.flush()
+        slot = self.slots[ride_id]
+        return float(self.sums[slot] / self.counts[slot]) if self.counts[slot] else 0.0
+
+    def riders_active(self) -> int:
+        """
+        Returns:
+        - rides being monitored
+        """
+        return len(self.slots)
+
+    def riders_unsafe(self) -> int:
+        """
+        Returns:
+        - rides flagged unsafe at the last evaluation
+        """
+        return int(np.count_nonzero(self.reasons))
+
+    def evaluate(self, now: float = None) -> list:
+        """
+        Checks every active rider's recent heart rates at once
+
+        Returns:
+        - [(ride id, 'unsafe' | 'safe', heart rate, reason)] for riders whose
+          state changed (reason is '' when safe again)
+        """
+        now = time.monotonic() if now is None else now
+        self.flush()
+        used = self.used
+        heart_rates = self.heart_rates[:used]
+        counts = self.counts[:used]
+        active = self.active[:used]
+        signal = active & (heart_rates != 0)
+        # mean of the window before the latest reading, which the spike is measured against
+        previous_means = (self.sums[:used] - heart_rates) / np.maximum(counts - 1, 1)
+
+        spike = signal & (counts > SPIKE_MIN_READINGS) & (np.abs(heart_rates - previous_means) >= self.spike_bpm)
+        out_of_band = signal & ~check_heart_rates(heart_rates, self.lower[:used], self.upper[:used])
+        no_signal = active & (heart_rates == 0) & (counts > 0)
+        # unsafe at once, however long it lasts
+        limit = signal & ~check_heart_rates(heart_rates, self.hard_lower[:used], self.hard_upper[:used])
+
+        # reason codes in order of precedence (np.where is cheaper than np.select)
+        reasons = np.where(
+            limit, 1, np.where(
+                held_since(self.spike_since[:used], spike, now, self.spike_seconds), 2, np.where(
+                    held_since(self.out_of_band_since[:used], out_of_band, now, self.sustained_seconds), 3, np.where(
+                        held_since(self.no_signal_since[:used], no_signal, now, self.no_signal_seconds), 4, 0
+                    )
+                )
+            )
+        ).astype(np.int8)
+        changed = np.flatnonzero((reasons != 0) != (self.reasons[:used] != 0))
+        self.reasons[:used] = reasons
+        return [
+            (self.ride_ids[slot], 'unsafe' if reason else 'safe', int(heart_rate), REASONS[reason])
+            for slot, reason, heart_rate in zip(
+                changed.tolist(), reasons[changed].tolist(), heart_rates[changed].tolist()
+            )
+        ]
+
+    def tick(self, now: float = None) -> list:
+        """
+        Evaluates the fleet if tick_seconds have passed since the last evaluation
+
+        Returns:
+        - state changes (see evaluate), empty if not due
+        """
+        now = time.monotonic() if now is None else now
+        if self.last_evaluated is not None and now - self.last_evaluated < self.tick_seconds:
+            return []
+        self.last_evaluated = now
+        return self.evaluate(now)
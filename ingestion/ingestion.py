@@ -1,16 +1,99 @@
+from collections import defaultdict, OrderedDict
+import csv
 from datetime import date, datetime
+import io
 import json
 import logging
 import os
 import re
+import signal
 import uuid
 
 import boto3
 from botocore.exceptions import ClientError
 from confluent_kafka import Consumer, KafkaException
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 import sqlalchemy
 
+from metrics import (
+    ALERT_SECONDS, ALERTS, INSERT_ERRORS, INSERT_SECONDS, MESSAGES, MESSAGES_DROPPED,
+    HEART_RATE_TRANSITIONS, MONITORED_RIDERS, PARSE_SECONDS, RIDES_FINISHED, RIDES_STARTED, ROWS_DUPLICATE,
+    ROWS_WRITTEN, STALE_READINGS, UNSAFE_RIDERS, USER_CACHE, USER_CACHE_ENTRIES, start_metrics_server
+)
+from event_buffer import RideEventBuffer
+from fleet_monitor import FleetHeartRateMonitor
+from publisher import SnsPublisher
+from trigger import TriggerCoalescer, create_trigger_message
+
+load_dotenv()
+REGION = os.getenv('REGION')
+
+KAFKA_SERVER = os.getenv('KAFKA_SERVER')
+KAFKA_USERNAME = os.getenv('KAFKA_USERNAME')
+KAFKA_PASSWORD = os.getenv('KAFKA_PASSWORD')
+KAFKA_TOPIC = os.getenv('KAFKA_TOPIC')
+
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = os.getenv('DB_PORT')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_NAME = os.getenv('DB_NAME')
+
+SES_SENDER_ADDRESS = os.getenv('SES_SENDER_ADDRESS')
+ZUCK_TOPIC = os.getenv('ZUCK_TOPIC')
+STAGING_SCHEMA = 'zuckerberg_staging'
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+# Readings older than this (e.g. whilst catching up after downtime) are too late to alert on
+ALERT_FRESHNESS_SECONDS = float(os.getenv('ALERT_FRESHNESS_SECONDS', '300'))
+
+# Log fields, compiled once rather than per message
+TIME_PATTERN = re.compile(r'(\d|\-|\.)+\s(\d{2}:){2}\d{2}')
+# Full log time (with microseconds), to order & pair events within a second
+EVENT_TIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2}(\.\d+)?')
+BIKE_MODEL_PATTERN = re.compile(r'.\d+\s(\w+\sv\d+)')
+DURATION_PATTERN = re.compile(r'duration = (\d+\.\d*)')
+RESISTANCE_PATTERN = re.compile(r'resistance = (\d+)')
+HEART_RATE_PATTERN = re.compile(r'hrt = (\d+)')
+RPM_PATTERN = re.compile(r'rpm = (\d+)')
+POWER_PATTERN = re.compile(r'power = (\d+\.\d*)')
+SYSTEM_DATA_PATTERN = re.compile(r'data = (.+)')
+# Ride ids are uuid5(user_id & ride start time), so reprocessing a partition
+# reproduces the same ids & the staging keys below reject the repeated rows
+RIDE_ID_NAMESPACE = uuid.UUID('5a0b8f1e-2f3c-4d6e-9a7b-1c2d3e4f5a6b')
+USER_COLUMNS = [
+    'user_id', 'first_name', 'last_name', 'gender', 'postcode', 'date_of_birth',
+    'email', 'height_cm', 'weight_kg', 'account_creation'
+]
+STAGING_KEYS = {
+    'user_ride': ['ride_id'],
+    'metrics_table': ['ride_id', 'duration_seconds']
+}
+
+# Per-ride aggregates kept whilst the ride is in progress (see update_ride_summary)
+SUMMARY_TOTALS = ['resistance', 'heart_rate', 'rpm', 'power']
+SUMMARY_RANGES = ['heart_rate', 'rpm', 'power']
+RIDE_SUMMARY_COLUMNS = [
+    'ride_id', 'time', 'bike_model', 'rows', 'resistance_avg',
+    'heart_rate_avg', 'heart_rate_min', 'heart_rate_max',
+    'rpm_avg', 'rpm_min', 'rpm_max',
+    'power_total', 'power_avg', 'power_min', 'power_max', 'duration_seconds'
+]
+
+USER_INFO_KEYS = frozenset([
+    'user_id', 'name', 'gender', 'address', 'date_of_birth', 'email_address',
+    'height_cm', 'weight_kg', 'account_create_date'
+])
+
+# Connections, created when the consumer starts (or by the replay harness)
+log = logging.getLogger()
+engine = None
+sns_client = None
+publisher = None
+trigger = None
+
 def get_logger(log_level: str) -> logging.Logger:
     """
     Returns:
@@ -91,6 +174,99 @@ def create_user_ride_row(user_id: int, ride_id: str) -> dict:
     }
     return user_ride_dict
 
+class MalformedLogError(ValueError):
+    """
+    Raised when a log line is missing a field its log type requires
+    """
+
+def search_field(pattern: re.Pattern, log: str, field: str, group: int = 0) -> str:
+    """
+    Searches a log line for a field
+
+    Returns:
+    - matched text of the field
+    """
+    match = pattern.search(log)
+    if match is None:
+        raise MalformedLogError(f'missing {field}')
+    return match.group(group)
+
+def search_log_time(log: str) -> str:
+    """
+    Returns:
+    - timestamp at the start of a log line
+    - None if the log has no timestamp
+    """
+    match = TIME_PATTERN.match(log)
+    return match.group() if match else None
+
+def search_event_time(log: str) -> str:
+    """
+    Returns:
+    - timestamp at the start of a log line, with its fraction of a second
+    - None if the log has no timestamp
+    """
+    match = EVENT_TIME_PATTERN.match(log)
+    return match.group() if match else None
+
+def create_ride_id(user_id: int, start_time: str) -> str:
+    """
+    Derives the ride id from the rider & ride start time, so the same ride
+    always gets the same id (replays, restarts & parallel consumers)
+
+    Returns:
+    - ride id (uuid5)
+    """
+    return str(uuid.uuid5(RIDE_ID_NAMESPACE, f'{user_id}|{start_time}'))
+
+def parse_ride_log(log: str) -> dict:
+    """
+    Extracts the metrics of a Ride log
+
+    Returns:
+    - dictionary with time, bike_model, duration_seconds & resistance
+    """
+    ride = {
+        'time': search_field(TIME_PATTERN, log, 'time'),
+        'bike_model': search_field(BIKE_MODEL_PATTERN, log, 'bike_model', 1),
+        'duration_seconds': float(search_field(DURATION_PATTERN, log, 'duration', 1)),
+        'resistance': int(search_field(RESISTANCE_PATTERN, log, 'resistance', 1))
+    }
+    return ride
+
+def parse_telemetry_log(log: str) -> dict:
+    """
+    Extracts the metrics of a Telemetry log
+
+    Returns:
+    - dictionary with heart_rate, rpm & power
+    """
+    telemetry = {
+        'heart_rate': int(search_field(HEART_RATE_PATTERN, log, 'hrt', 1)),
+        'rpm': int(search_field(RPM_PATTERN, log, 'rpm', 1)),
+        'power': float(search_field(POWER_PATTERN, log, 'power', 1))
+    }
+    return telemetry
+
+def build_metrics_row(ride_id: str, ride: dict, telemetry: dict) -> dict:
+    """
+    Combines a parsed Ride & Telemetry pair into a metrics row
+
+    Returns:
+    - metrics dictionary
+    """
+    metrics_dict = {
+        'ride_id': ride_id,
+        'time': ride['time'],
+        'bike_model': ride['bike_model'],
+        'duration_seconds': ride['duration_seconds'],
+        'resistance': ride['resistance'],
+        'heart_rate': telemetry['heart_rate'],
+        'rpm': telemetry['rpm'],
+        'power': telemetry['power']
+    }
+    return metrics_dict
+
 def create_metrics_row(ride_id: str, ride_metrics: dict, telemetry_metrics: dict) -> dict:
     """
     Extracts relevant keys from metrics pairs:
@@ -100,96 +276,352 @@ def create_metrics_row(ride_id: str, ride_metrics: dict, telemetry_metrics: dict
     Returns:
     - updated metrics dictionary
     """
-    time = re.search(r'(\d|\-|\.)+\s(\d{2}:){2}\d{2}', ride_metrics['log']).group()
-    bike_model = re.search(r'.\d+\s(\w+\sv\d+)', ride_metrics['log']).group(1)
-    duration = float(re.search(r'duration = (\d+\.\d*)', ride_metrics['log']).group(1))
-    resistance = int(re.search(r'resistance = (\d+)', ride_metrics['log']).group(1))
-    heart_rate =  int(re.search(r'hrt = (\d+)', telemetry_metrics['log']).group(1))
-    rpm = int(re.search(r'rpm = (\d+)', telemetry_metrics['log']).group(1))
-    power = float(re.search(r'power = (\d+\.\d*)', telemetry_metrics['log']).group(1))
+    ride = parse_ride_log(ride_metrics['log'])
+    telemetry = parse_telemetry_log(telemetry_metrics['log'])
+    return build_metrics_row(ride_id, ride, telemetry)
 
-    metrics_dict = {
-        'ride_id': ride_id,
-        'time': time,
-        'bike_model': bike_model,
-        'duration_seconds': duration,
-        'resistance': resistance,
-        'heart_rate': heart_rate,
-        'rpm': rpm,
-        'power': power
-    }
-    return metrics_dict
+def parse_log(msg_value: dict) -> dict:
+    """
+    Classifies a decoded log message & extracts its fields
+    Pure, so it can run on any parse worker
 
-def insert_user_row(user: dict) -> None:
+    Returns:
+    Dictionary with 'kind' and the kind's fields:
+    - start: time (None if the log has no timestamp), event_time
+    - end: event_time
+    - other: no fields
+    - system: user_info, time
+    - ride: ride (see parse_ride_log), event_time
+    - telemetry: telemetry (see parse_telemetry_log), event_time
+    event_time keeps the fraction of a second (see search_event_time)
+    Raises MalformedLogError if a recognised log is missing a field
     """
-    Insert user dictionary into staging user_table
+    log_line = msg_value.get('log') if isinstance(msg_value, dict) else None
+    if not isinstance(log_line, str):
+        raise MalformedLogError('missing log')
+
+    if 'beginning of a new ride' in log_line:
+        return {'kind': 'start', 'time': search_log_time(log_line), 'event_time': search_event_time(log_line)}
+    elif '[SYSTEM]' in log_line:
+        try:
+            user_info = json.loads(search_field(SYSTEM_DATA_PATTERN, log_line, 'data', 1))
+        except json.JSONDecodeError as e:
+            raise MalformedLogError(f'invalid data: {e}') from e
+        missing = USER_INFO_KEYS.difference(user_info) if isinstance(user_info, dict) else USER_INFO_KEYS
+        if missing:
+            raise MalformedLogError(f"missing data {', '.join(sorted(missing))}")
+        return {'kind': 'system', 'user_info': user_info, 'time': search_log_time(log_line)}
+    elif 'Ride' in log_line:
+        return {'kind': 'ride', 'ride': parse_ride_log(log_line), 'event_time': search_event_time(log_line)}
+    elif 'Telemetry' in log_line:
+        return {'kind': 'telemetry', 'telemetry': parse_telemetry_log(log_line), 'event_time': search_event_time(log_line)}
+    elif 'beginning of main' in log_line:
+        return {'kind': 'end', 'event_time': search_event_time(log_line)}
+    return {'kind': 'other'}
+
+def ensure_staging_keys(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates the unique keys the staging inserts conflict on (STAGING_KEYS)
+    Rows duplicated before a key existed are removed first, keeping the oldest
+    """
+    with engine.begin() as con:
+        for table, columns in STAGING_KEYS.items():
+            index = f"{table}_{'_'.join(columns)}_key"
+            if con.execute(f"SELECT to_regclass('{STAGING_SCHEMA}.{index}')").scalar() is not None:
+                continue
+
+            logging.info('CREATING STAGING KEY %s...', index) # - check
+            matching = ' AND '.join(f'newer.{column} = older.{column}' for column in columns)
+            con.execute(f"""
+                DELETE FROM {STAGING_SCHEMA}.{table} newer
+                USING {STAGING_SCHEMA}.{table} older
+                WHERE newer.ctid > older.ctid AND {matching}
+            """)
+            con.execute(f"CREATE UNIQUE INDEX {index} ON {STAGING_SCHEMA}.{table} ({', '.join(columns)})")
+
+def ensure_ride_summary_table(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates the staging ride_summary table if it doesn't exist yet
+    """
+    with engine.begin() as con:
+        con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {STAGING_SCHEMA}.ride_summary (
+                ride_id TEXT PRIMARY KEY,
+                time TEXT,
+                bike_model TEXT,
+                rows INTEGER NOT NULL,
+                resistance_avg FLOAT,
+                heart_rate_avg FLOAT,
+                heart_rate_min INTEGER,
+                heart_rate_max INTEGER,
+                rpm_avg FLOAT,
+                rpm_min INTEGER,
+                rpm_max INTEGER,
+                power_total FLOAT,
+                power_avg FLOAT,
+                power_min FLOAT,
+                power_max FLOAT,
+                duration_seconds FLOAT
+            )
+            """
+        )
+
+class UserProfileCache:
+    """
+    Bounded LRU of the user rows last staged, by user_id
+    Only used by the writer (one thread), so it takes no lock
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.profiles = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def get(self, user_id: int) -> tuple:
+        """
+        Returns:
+        - user row values last staged (USER_COLUMNS order)
+        - None if the user is not cached
+        """
+        profile = self.profiles.get(user_id)
+        if profile is not None:
+            self.profiles.move_to_end(user_id)
+        return profile
+
+    def put(self, user_id: int, profile: tuple) -> None:
+        """
+        Caches a staged user row, evicting the least recently seen user
+        """
+        self.profiles[user_id] = profile
+        self.profiles.move_to_end(user_id)
+        if len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+user_cache = UserProfileCache()
+USER_CACHE_ENTRIES.set_function(lambda: len(user_cache))
+
+def create_user_upsert(columns: list) -> str:
+    """
+    Upserts user rows, updating only the given columns of existing users
+    & only where they differ (unchanged rows are not rewritten)
+
+    Returns:
+    - SQL statement for execute_values
+    """
+    targets = ', '.join(columns)
+    excluded = ', '.join(f'EXCLUDED.{column}' for column in columns)
+    return f"""
+        INSERT INTO {STAGING_SCHEMA}.user_table ({', '.join(USER_COLUMNS)})
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET ({targets}) = ROW({excluded})
+        WHERE ({', '.join(f'user_table.{column}' for column in columns)}) IS DISTINCT FROM ({excluded})
+    """
+
+def insert_user_rows(users: list) -> None:
+    """
+    Insert user dictionaries into staging user_table
+    Keeps the last row per user_id, as one upsert can't update a row twice
+    - cached & unchanged: skipped
+    - cached & changed: only the changed columns are updated
+    - not cached: full upsert
+    """
+    latest_users = {user['user_id']: tuple(user[column] for column in USER_COLUMNS) for user in users}
+
+    new_profiles = []
+    changed_profiles = defaultdict(list)
+    for user_id, profile in latest_users.items():
+        cached = user_cache.get(user_id)
+        if cached is None:
+            USER_CACHE.labels('miss').inc()
+            new_profiles.append(profile)
+        elif cached == profile:
+            USER_CACHE.labels('hit').inc()
+        else:
+            USER_CACHE.labels('changed').inc()
+            changed = tuple(column for column, old, new in zip(USER_COLUMNS, cached, profile) if old != new)
+            changed_profiles[changed].append(profile)
+
+    if not new_profiles and not changed_profiles:
+        return
+
+    try:
+        with INSERT_SECONDS.labels('user_table').time(), engine.begin() as con:
+            cursor = con.connection.cursor()
+            if new_profiles:
+                execute_values(cursor, create_user_upsert(USER_COLUMNS[1:]), new_profiles)
+            for changed, profiles in changed_profiles.items():
+                execute_values(cursor, create_user_upsert(list(changed)), profiles)
+
+        for user_id, profile in latest_users.items():
+            user_cache.put(user_id, profile)
+        ROWS_WRITTEN.labels('user_table').inc(len(new_profiles) + sum(map(len, changed_profiles.values())))
+    except Exception as e:
+        INSERT_ERRORS.labels('user_table').inc()
+        logging.error(f"Error raised whilst inserting user rows: {e}")
+
+
+def insert_user_ride_rows(user_rides: list) -> None:
+    """
+    Insert user_ride dictionaries into staging user_ride in one statement
+    Rides already staged are skipped
+    """
+    try:
+        with INSERT_SECONDS.labels('user_ride').time(), engine.begin() as con:
+            inserted = execute_values(
+                con.connection.cursor(),
+                'INSERT INTO zuckerberg_staging.user_ride VALUES %s ON CONFLICT (ride_id) DO NOTHING RETURNING 1',
+                [
+                    (
+                        user_ride['user_id'],
+                        user_ride['ride_id']
+                    )
+                    for user_ride in user_rides
+                ],
+                fetch=True
+            )
+        ROWS_WRITTEN.labels('user_ride').inc(len(inserted))
+        ROWS_DUPLICATE.labels('user_ride').inc(len(user_rides) - len(inserted))
+    except Exception as e:
+        INSERT_ERRORS.labels('user_ride').inc()
+        logging.error(f"Error raised whilst inserting user_ride rows: {e}")
+
+
+def insert_metrics_rows(metrics_rows: list) -> None:
+    """
+    Insert metrics dictionaries into staging_schema metrics_table in one statement
+    Metrics already staged (same ride & duration) are skipped
     """
     try:
-        with engine.connect() as con:
-            con.execute(
+        with INSERT_SECONDS.labels('metrics_table').time(), engine.begin() as con:
+            inserted = execute_values(
+                con.connection.cursor(),
                 """
-                INSERT INTO zuckerberg_staging.user_table
-                (user_id, first_name, last_name, gender, postcode, date_of_birth, email, height_cm, weight_kg, account_creation)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET
-                (first_name, last_name, gender, postcode, date_of_birth, email, height_cm, weight_kg, account_creation) =
-                (EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.gender, EXCLUDED.postcode, EXCLUDED.date_of_birth, EXCLUDED.email, EXCLUDED.height_cm, EXCLUDED.weight_kg, EXCLUDED.account_creation)
+                INSERT INTO zuckerberg_staging.metrics_table VALUES %s
+                ON CONFLICT (ride_id, duration_seconds) DO NOTHING
+                RETURNING 1
                 """,
-                (
-                    user['user_id'],
-                    user['first_name'],
-                    user['last_name'],
-                    user['gender'],
-                    user['postcode'],
-                    user['date_of_birth'],
-                    user['email'],
-                    user['height_cm'],
-                    user['weight_kg'],
-                    user['account_creation']
-                )
+                [
+                    (
+                        metrics['ride_id'],
+                        metrics['time'],
+                        metrics['bike_model'],
+                        metrics['duration_seconds'],
+                        metrics['resistance'],
+                        metrics['heart_rate'],
+                        metrics['rpm'],
+                        metrics['power']
+                    )
+                    for metrics in metrics_rows
+                ],
+                page_size=1000,
+                fetch=True
             )
+        ROWS_WRITTEN.labels('metrics_table').inc(len(inserted))
+        ROWS_DUPLICATE.labels('metrics_table').inc(len(metrics_rows) - len(inserted))
     except Exception as e:
-        logging.error(f"Error raised whilst inserting user row: {e}")
+        INSERT_ERRORS.labels('metrics_table').inc()
+        logging.error(f"Error raised whilst inserting metrics rows: {e}")
 
+def copy_metrics_rows(metrics_rows: list) -> None:
+    """
+    Bulk loads metrics dictionaries into staging_schema metrics_table:
+    COPY into a temporary table, then one insert skipping metrics already staged
+    Used for the large batches of catch-up mode (see pipeline.CatchUpMode)
+    """
+    try:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            (
+                metrics['ride_id'],
+                metrics['time'],
+                metrics['bike_model'],
+                metrics['duration_seconds'],
+                metrics['resistance'],
+                metrics['heart_rate'],
+                metrics['rpm'],
+                metrics['power']
+            )
+            for metrics in metrics_rows
+        )
+        buffer.seek(0)
 
-def insert_user_ride_row(user_ride: dict) -> None:
+        with INSERT_SECONDS.labels('metrics_table').time(), engine.begin() as con:
+            cursor = con.connection.cursor()
+            cursor.execute(
+                """
+                CREATE TEMPORARY TABLE metrics_copy
+                (LIKE zuckerberg_staging.metrics_table) ON COMMIT DROP
+                """
+            )
+            cursor.copy_expert(
+                """
+                COPY metrics_copy (ride_id, time, bike_model, duration_seconds, resistance, heart_rate, rpm, power)
+                FROM STDIN WITH (FORMAT csv)
+                """,
+                buffer
+            )
+            cursor.execute(
+                """
+                INSERT INTO zuckerberg_staging.metrics_table SELECT * FROM metrics_copy
+                ON CONFLICT (ride_id, duration_seconds) DO NOTHING
+                """
+            )
+            inserted = cursor.rowcount
+        ROWS_WRITTEN.labels('metrics_table').inc(inserted)
+        ROWS_DUPLICATE.labels('metrics_table').inc(len(metrics_rows) - inserted)
+    except Exception as e:
+        INSERT_ERRORS.labels('metrics_table').inc()
+        logging.error(f"Error raised whilst copying metrics rows: {e}")
+
+def insert_ride_summary_rows(summaries: list) -> None:
     """
-    Insert user_ride dictionary into staging user_ride
+    Insert finished ride summaries into staging ride_summary in one statement
+    Rides already summarised are skipped
     """
     try:
-        with engine.connect() as con:
-            con.execute(
-                'INSERT INTO zuckerberg_staging.user_ride VALUES (%s, %s)',
-                (
-                    user_ride['user_id'],
-                    user_ride['ride_id']
-                )
+        with INSERT_SECONDS.labels('ride_summary').time(), engine.begin() as con:
+            inserted = execute_values(
+                con.connection.cursor(),
+                f"""
+                INSERT INTO zuckerberg_staging.ride_summary ({', '.join(RIDE_SUMMARY_COLUMNS)}) VALUES %s
+                ON CONFLICT (ride_id) DO NOTHING
+                RETURNING 1
+                """,
+                [tuple(summary[column] for column in RIDE_SUMMARY_COLUMNS) for summary in summaries],
+                fetch=True
             )
+        ROWS_WRITTEN.labels('ride_summary').inc(len(inserted))
+        ROWS_DUPLICATE.labels('ride_summary').inc(len(summaries) - len(inserted))
     except Exception as e:
-        logging.error(f"Error raised whilst inserting user_ride row: {e}")
+        INSERT_ERRORS.labels('ride_summary').inc()
+        logging.error(f"Error raised whilst inserting ride_summary rows: {e}")
+
+def insert_user_row(user: dict) -> None:
+    """
+    Insert user dictionary into staging user_table
+    """
+    insert_user_rows([user])
 
+def insert_user_ride_row(user_ride: dict) -> None:
+    """
+    Insert user_ride dictionary into staging user_ride
+    """
+    insert_user_ride_rows([user_ride])
 
 def insert_metrics_row(metrics: dict) -> None:
     """
     Insert metrics dictionary into staging_schema metrics_table
     """
-    try:
-        with engine.connect() as con:
-            con.execute(
-                'INSERT INTO zuckerberg_staging.metrics_table VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
-                (
-                    metrics['ride_id'],
-                    metrics['time'],
-                    metrics['bike_model'],
-                    metrics['duration_seconds'],
-                    metrics['resistance'],
-                    metrics['heart_rate'],
-                    metrics['rpm'],
-                    metrics['power']
-                )
-            )
-    except Exception as e:
-        logging.error(f"Error raised whilst inserting metrics row: {e}")
+    insert_metrics_rows([metrics])
+
+def insert_ride_summary_row(summary: dict) -> None:
+    """
+    Insert a finished ride summary into staging ride_summary
+    """
+    insert_ride_summary_rows([summary])
 
 def calculate_age(date_of_birth: int) -> int:
     """
@@ -229,22 +661,34 @@ def check_heart_rate(age: int, heart_rate: int) -> bool:
     return is_safe
 
 
-def create_heart_rate_alert(user_name: str, heart_rate: int) -> dict:
+def create_heart_rate_alert(user_name: str, heart_rate: int, reason: str = None, rolling_mean: float = None) -> dict:
     """
     Creates personalised SES message for unsafe heart_rate
     Uses HTML formatting
+    - reason: fleet monitor anomaly (limit, spike, sustained, no_signal), if any
 
     Returns:
     - message dictionary
     """
     charset = "UTF-8"
 
+    if reason == 'limit':
+        explanation = "This is far outside the safe range that we've calculated given your age and weight."
+    elif reason == 'spike':
+        explanation = f"This is a sudden change from your recent average of {rolling_mean:.0f} bpm."
+    elif reason == 'sustained':
+        explanation = "This has stayed outside the safe range that we've calculated given your age and weight."
+    elif reason == 'no_signal':
+        explanation = "Your heart rate has stopped being detected."
+    else:
+        explanation = "This is outside the safe range that we've calculated given your age and weight."
+
     html = f"""
             <html>
                 <h2 style="text-align: center;"><span style="color: #ff0000;">Deloton heart rate alert!</span></h2>
                 <p><span style="color: #000000;">Dear {user_name},</span></p>
                 <p><strong>Whilst riding your Deloton bike, you heart rate was recorded as: <span style="color: #ff0000;">{heart_rate} bpm</span></strong></p>
-                <p>This is outside the safe range that we've calculated given your age and weight.</p>
+                <p>{explanation}</p>
                 <p>If you start to feel unwell, call the emergency services.</p>
                 <p>From the Deloton Customer Alerts Team.</p>
                 <p><img src="https://user-images.githubusercontent.com/5181870/188019461-4a27a045-9301-4931-910c-b367f7b2709a.png" alt="fullwidth" width="302" height="112" /></p>
@@ -296,17 +740,35 @@ def sends_heart_rate_alert(message: dict, sender_address: str, recipient_address
         return False
 
 
-def get_heart_rate_info(name: str, age: int, email: str, heart_rate: int) -> None:
+def is_fresh_reading(reading_time: str) -> bool:
+    """
+    Checks a reading against the alert freshness horizon (log times are UTC)
+
+    Returns:
+    - True if recent enough to alert on (or its time can't be read)
+    - False if older than ALERT_FRESHNESS_SECONDS
+    """
+    try:
+        age = (datetime.utcnow() - datetime.fromisoformat(reading_time)).total_seconds()
+    except ValueError:
+        return True
+    return age <= ALERT_FRESHNESS_SECONDS
+
+def get_heart_rate_info(name: str, age: int, email: str, heart_rate: int, send_alert: bool = True,
+                        reason: str = None, rolling_mean: float = None) -> None:
     """
     Calculates safe heart_rate range
-    Sends SES if unsafe
+    Sends SES if unsafe (and send_alert)
+    - reason: fleet monitor anomaly, unsafe whatever the latest reading
     """
     try:
-        log.info("NAME: %s, HRT: %s, AGE: %s", name, heart_rate, age)
+        log.info("NAME: %s, HRT: %s, AGE: %s, ANOMALY: %s", name, heart_rate, age, reason)
         
-        if not check_heart_rate(age, heart_rate):
-            message = create_heart_rate_alert(name, heart_rate)
-            message_sent = sends_heart_rate_alert(message, SES_SENDER_ADDRESS, email)
+        if (reason or not check_heart_rate(age, heart_rate)) and send_alert:
+            message = create_heart_rate_alert(name, heart_rate, reason, rolling_mean)
+            with ALERT_SECONDS.time():
+                message_sent = sends_heart_rate_alert(message, SES_SENDER_ADDRESS, email)
+            ALERTS.labels(sent=message_sent).inc()
             log.info("""
                 HEART-RATE %s FOR AGE %s UNSAFE
                 EMAIL TO %s SENT: %s""",
@@ -333,95 +795,328 @@ def publish_message(topic_arn: str, message: str, subject: str) -> str:
     else:
         return response
 
-if __name__ == '__main__':
-    
-    load_dotenv()
-    REGION = os.getenv('REGION')
+def publish_trigger(message: str) -> None:
+    """
+    Publishes a transformation trigger to SNS, triggering the production script
+    """
+    subject = 'production script'
+    log.info(f'Publishing message to topic: {ZUCK_TOPIC}...')
+    message_id = publish_message(ZUCK_TOPIC, message, subject)
+    log.info(f'Message published to topic: {ZUCK_TOPIC} with message Id - {message_id}')
+
+def publish_ride_end(ride_id: str) -> None:
+    """
+    Publishes the end of a ride, through the trigger coalescer if running,
+    so rides ending close together share one transformation run
+    """
+    if trigger is not None:
+        trigger.add(ride_id)
+    else:
+        publish_trigger(create_trigger_message([ride_id]))
+
+class InlineWriter:
+    """
+    Default writer for apply_log: stages each row & runs each
+    notification as soon as it happens (see pipeline.StagingWriter)
+    """
+
+    def write(self, table: str, row: dict) -> None:
+        """
+        Inserts a row into a staging table
+        """
+        if table == 'user_table':
+            insert_user_row(row)
+        elif table == 'user_ride':
+            insert_user_ride_row(row)
+        elif table == 'ride_summary':
+            insert_ride_summary_row(row)
+        else:
+            insert_metrics_row(row)
+
+    def call(self, func, *args, flush_first: bool = False, **kwargs) -> None:
+        """
+        Runs a notification call
+        """
+        func(*args, **kwargs)
+
+def update_ride_summary(summary: dict, metrics: dict) -> dict:
+    """
+    Adds a metrics row to the running aggregates of its ride, in constant time,
+    so finished rides don't need their raw metrics re-aggregated
+    The streaming form of transformation/tranformation.py aggregate_rides,
+    which defines the values: change both together (then run backfill.py)
+
+    Returns:
+    - the summary (a new one for the ride's first metrics row)
+    """
+    if summary is not None and metrics['time'] < summary['time']:
+        # pairs can complete out of order, the ride starts at its earliest row
+        summary['time'] = metrics['time']
+        summary['bike_model'] = metrics['bike_model']
+    elif summary is None:
+        summary = {
+            'ride_id': metrics['ride_id'],
+            'time': metrics['time'],
+            'bike_model': metrics['bike_model'],
+            'rows': 0,
+            'duration_seconds': metrics['duration_seconds']
+        }
+        for column in SUMMARY_TOTALS:
+            summary[f'{column}_total'] = 0
+        for column in SUMMARY_RANGES:
+            summary[f'{column}_min'] = metrics[column]
+            summary[f'{column}_max'] = metrics[column]
+
+    summary['rows'] += 1
+    summary['duration_seconds'] = max(summary['duration_seconds'], metrics['duration_seconds'])
+    for column in SUMMARY_TOTALS:
+        summary[f'{column}_total'] += metrics[column]
+    for column in SUMMARY_RANGES:
+        summary[f'{column}_min'] = min(summary[f'{column}_min'], metrics[column])
+        summary[f'{column}_max'] = max(summary[f'{column}_max'], metrics[column])
+    return summary
+
+def create_ride_summary_row(summary: dict) -> dict:
+    """
+    Finishes a ride's running aggregates, with the dash_table metric columns
+
+    Returns:
+    - ride_summary dictionary
+    """
+    ride_summary_dict = {column: summary.get(column) for column in RIDE_SUMMARY_COLUMNS}
+    for column in SUMMARY_TOTALS:
+        ride_summary_dict[f'{column}_avg'] = summary[f'{column}_total'] / summary['rows']
+    return ride_summary_dict
+
+def create_ride_state(rides: RideEventBuffer = None, monitor: FleetHeartRateMonitor = None,
+                      fresh_only: bool = True) -> dict:
+    """
+    State carried between log messages of the ride in progress
+    - rides: event buffer of the open rides, kept from ride to ride
+    - monitor: heart rates of the open rides, kept from ride to ride
+    - fresh_only: only readings within ALERT_FRESHNESS_SECONDS of now reach
+      the monitor (live & catch-up consumption); False for recordings, whose
+      readings are all old
+
+    Returns:
+    - empty ride state dictionary
+    """
+    state = {
+        'new_ride': False,
+        'user_info': {},
+        'user_id': '',
+        'ride_id': '',
+        'start_time': None,
+        'open_rides': 0,
+        'rides': rides or RideEventBuffer(),
+        'monitor': monitor or FleetHeartRateMonitor(),
+        'fresh_only': fresh_only
+    }
+    return state
+
+def stage_pairs(pairs: list, state: dict, writer) -> None:
+    """
+    Stages the metrics row of each Ride & Telemetry pair the event buffer
+    completed, adds it to its ride's summary & hands the heart rate to the
+    fleet monitor (checked per tick, see alert_transitions)
+    """
+    for ride, ride_record, telemetry in pairs:
+        if not state['fresh_only'] or is_fresh_reading(ride_record['time']):
+            # the slot add_rider gave the ride, saving a lookup per reading
+            if ride.slot is not None:
+                state['monitor'].update_slot(ride.slot, telemetry['heart_rate'])
+        else:
+            STALE_READINGS.inc()
+
+        metrics_row = build_metrics_row(ride.ride_id, ride_record, telemetry)
+        writer.write('metrics_table', metrics_row)
+        ride.summary = update_ride_summary(ride.summary, metrics_row)
+
+def finish_rides(rides: list, state: dict, notify: bool, writer) -> None:
+    """
+    Stages the summary of each ride the event buffer closed, stops
+    monitoring it & publishes its end to SNS (if notify)
+    """
+    for ride in rides:
+        RIDES_FINISHED.inc()
+        state['monitor'].remove_rider(ride.ride_id)
+        ride.slot = None
+        if ride.summary is not None:
+            writer.write('ride_summary', create_ride_summary_row(ride.summary))
+        if notify and ride.ride_id:
+            # the transformation must see every row of the ride
+            writer.call(publish_ride_end, ride.ride_id, flush_first=True)
+
+def alert_transitions(state: dict, notify: bool, writer, idle: bool = False, force: bool = False) -> None:
+    """
+    Evaluates the whole fleet's heart rates once per ALERT_TICK_SECONDS of
+    log time (or now, if force), so replays of a recording (fresh_only off,
+    see create_ride_state) flag the same anomalies as the live run
+    Riders turning unsafe (spike, sustained or no_signal, see fleet_monitor.py)
+    are alerted (SES if notify), once per unsafe spell
+    """
+    monitor = state['monitor']
+    now = state['rides'].clock(idle)
+    if now is None:
+        return
+    for ride_id, heart_rate_state, heart_rate, reason in (monitor.evaluate(now) if force else monitor.tick(now)):
+        HEART_RATE_TRANSITIONS.labels(heart_rate_state, reason or 'none').inc()
+        rider = monitor.get_rider(ride_id)
+        if heart_rate_state == 'unsafe':
+            writer.call(
+                get_heart_rate_info, rider['name'], rider['age'], rider['email'], heart_rate,
+                send_alert=notify, reason=reason, rolling_mean=monitor.rolling_mean(ride_id)
+            )
+        else:
+            log.info("HEART-RATE %s FOR %s SAFE AGAIN", heart_rate, rider['name'])
+    UNSAFE_RIDERS.set(monitor.riders_unsafe())
+    MONITORED_RIDERS.set(monitor.riders_active())
+
+def apply_log(parsed: dict, state: dict, notify: bool = True, writer=None) -> None:
+    """
+    Applies a parsed log message (see parse_log) to the rides in progress
+    - opens a ride at its start marker, identifies it by its [SYSTEM] log
+    - pairs Ride & Telemetry logs by log time in the event buffer, so
+      reordered messages still pair up (see event_buffer.py)
+    - stages user, user_ride & metrics rows through the writer
+    - keeps running aggregates of each ride & stages its summary once the
+      watermark passes its end marker
+    - keeps the latest heart rate of each ride in the fleet monitor, unless
+      older than ALERT_FRESHNESS_SECONDS (if fresh_only), & alerts riders turning unsafe (SES if notify)
+    - publishes the end of ride to SNS (if notify)
+    Must see messages in offset order, unlike parse_log
+    """
+    writer = writer or InlineWriter()
+    rides = state['rides']
+    kind = parsed['kind']
+
+    if kind == 'start':
+        MESSAGES.labels('start').inc()
+        RIDES_STARTED.inc()
+        finish_rides(rides.open_ride(parsed['event_time']), state, notify, writer)
+        state.update(create_ride_state(rides, state['monitor'], state['fresh_only']), start_time=parsed['time'])
+
+    elif kind == 'system':
+        if rides.current_ride() is None:
+            MESSAGES_DROPPED.labels('outside_ride').inc()
+            return
+        start_time = state['start_time'] or parsed['time']
+        if start_time is None:
+            raise MalformedLogError('missing ride start time')
+
+        MESSAGES.labels('system').inc()
+        user_info = parsed['user_info']
+        state['user_info'] = user_info
+        state['user_id'] = user_info['user_id']
+        state['ride_id'] = create_ride_id(state['user_id'], start_time)
+
+        with PARSE_SECONDS.labels('user').time():
+            user_row = create_user_row(state['user_id'], user_info)
+            user_ride_row = create_user_ride_row(state['user_id'], state['ride_id'])
+
+        writer.write('user_table', user_row)
+        writer.write('user_ride', user_ride_row)
+        rider = {'name': user_info['name'], 'email': user_info['email_address']}
+        rides.current_ride().slot = state['monitor'].add_rider(
+            state['ride_id'], calculate_age(int(user_info['date_of_birth'])), rider
+        )
+        stage_pairs(rides.identify(state['ride_id'], user_info), state, writer)
+
+    elif kind == 'ride':
+        MESSAGES.labels('ride').inc()
+        stage_pairs(rides.add('ride', parsed['ride'], parsed['event_time']), state, writer)
+
+    elif kind == 'telemetry':
+        MESSAGES.labels('telemetry').inc()
+        stage_pairs(rides.add('telemetry', parsed['telemetry'], parsed['event_time']), state, writer)
+
+    elif kind == 'end':
+        MESSAGES.labels('end').inc()
+        rides.end_ride(parsed['event_time'])
+        state.update(create_ride_state(rides, state['monitor'], state['fresh_only']))
+
+    else:
+        MESSAGES_DROPPED.labels('unrecognised').inc()
+
+    finish_rides(rides.advance(), state, notify, writer)
+    alert_transitions(state, notify, writer)
+    state['new_ride'] = rides.is_open()
+    state['open_rides'] = len(rides.open_rides)
 
-    KAFKA_SERVER = os.getenv('KAFKA_SERVER')
-    KAFKA_USERNAME = os.getenv('KAFKA_USERNAME')
-    KAFKA_PASSWORD = os.getenv('KAFKA_PASSWORD')
-    KAFKA_TOPIC = os.getenv('KAFKA_TOPIC')
+def tick_ride_state(state: dict, notify: bool = True, writer=None) -> None:
+    """
+    Moves the watermark on whilst no messages arrive, so the last ride
+    closes (summary & SNS) without waiting for the next one, & keeps
+    evaluating heart rates
+    """
+    writer = writer or InlineWriter()
+    finish_rides(state['rides'].advance(idle=True), state, notify, writer)
+    alert_transitions(state, notify, writer, idle=True)
+    state['new_ride'] = state['rides'].is_open()
+    state['open_rides'] = len(state['rides'].open_rides)
+
+def close_ride_state(state: dict, notify: bool = True, writer=None) -> None:
+    """
+    Closes every open ride, e.g. at the end of a recording
+    """
+    writer = writer or InlineWriter()
+    alert_transitions(state, notify, writer, force=True)
+    finish_rides(state['rides'].close_all(), state, notify, writer)
+    state['new_ride'] = False
+    state['open_rides'] = 0
 
-    DB_HOST = os.getenv('DB_HOST')
-    DB_PORT = os.getenv('DB_PORT')
-    DB_USER = os.getenv('DB_USER')
-    DB_PASSWORD = os.getenv('DB_PASSWORD')
-    DB_NAME = os.getenv('DB_NAME')
+def process_log(msg_value: dict, state: dict, notify: bool = True, writer=None) -> None:
+    """
+    Handles a single decoded log message ({"log": ...}) in order:
+    parse_log, then apply_log
+    """
+    with PARSE_SECONDS.labels('log').time():
+        parsed = parse_log(msg_value)
+    apply_log(parsed, state, notify, writer)
 
-    SES_SENDER_ADDRESS = os.getenv('SES_SENDER_ADDRESS')
-    ZUCK_TOPIC = os.getenv('ZUCK_TOPIC')
-    STAGING_SCHEMA = 'zuckerberg_staging'
+if __name__ == '__main__':
+    from dead_letter import DeadLetterFile
+    from pipeline import IngestionPipeline, StagingWriter
 
     log = get_logger(logging.INFO)
+    start_metrics_server(METRICS_PORT)
     sns_client = boto3.client('sns', REGION)
     engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+    ensure_staging_keys(engine)
+    ensure_ride_summary_table(engine)
 
-try:
+    c = None
+    try:
         c = start_consumer()
         c.subscribe([KAFKA_TOPIC])
+        # triggers are published in the background, so SNS never holds up the writer
+        publisher = SnsPublisher(sns_client, ZUCK_TOPIC, 'production script')
+        publisher.start()
+        trigger = TriggerCoalescer(publisher.publish)
+        trigger.start()
 
-        user_info = {}
-        user_id = ''
-        ride_id = ''
-        metrics_pair = []
-        
-        new_ride = False
-        while True:
-            msg = c.poll()
-            if msg is None:
-                continue
-            elif msg.error():
-                print(f"CONSUMER ERROR: {msg.error()}")
-            
-            elif new_ride == True:
-                msg_value = json.loads(msg.value().decode('utf-8'))
-                
-                if '[SYSTEM]' in msg_value['log']:
-                    user_info = json.loads(re.search(r'data = (.+)', msg_value['log']).group(1))
-                    user_id = user_info['user_id']
-                    ride_id = str(uuid.uuid4())
-
-                    user_row = create_user_row(user_id, user_info)
-                    user_ride_row = create_user_ride_row(user_id, ride_id)
-                    
-                    insert_user_row(user_row)
-                    insert_user_ride_row(user_ride_row)
-                
-                elif 'Ride' in msg_value['log']:
-                    metrics_pair = []
-                    metrics_pair.append(msg_value)
-                
-                elif 'Telemetry' in msg_value['log']:
-                    metrics_pair.append(msg_value)
-
-                    user_name = user_info['name']
-                    user_age = calculate_age(int(user_info['date_of_birth']))
-                    user_email = user_info['email_address']
-                    heart_rate =  int(re.search(r'hrt = (\d+)', msg_value['log']).group(1))
-                    get_heart_rate_info(user_name, user_age, user_email, heart_rate)
-
-                    metrics_row = create_metrics_row(ride_id, metrics_pair[0], metrics_pair[1])
-                    insert_metrics_row(metrics_row)
-                
-                elif 'beginning of main' in msg_value['log']:
-                    new_ride = False
-
-                    user_info = {}
-                    user_id = ''
-                    ride_id = ''
-                    metrics = []
-
-                    message = 'start new ride'
-                    subject = 'production script'
-                    log.info(f'Publishing message to topic: {ZUCK_TOPIC}...')
-                    message_id = publish_message(ZUCK_TOPIC, message, subject)
-                    log.info(f'Message published to topic: {ZUCK_TOPIC} with message Id - {message_id}')
-            else:
-                msg_value = json.loads(msg.value().decode('utf-8'))
-                if 'beginning of a new ride' in msg_value['log']:
-                    new_ride = True
-except KafkaException as e:
-    logging.error(f"Error raised whilst accessing Kafka stream: {e}")
-finally:
-    c.close()
\ No newline at end of file
+        writer = StagingWriter({
+            'user_table': insert_user_rows,
+            'user_ride': insert_user_ride_rows,
+            'metrics_table': insert_metrics_rows,
+            'ride_summary': insert_ride_summary_rows
+        }, bulk_insert_batch={
+            'metrics_table': copy_metrics_rows
+        })
+        pipeline = IngestionPipeline(
+            c, parse_log, apply_log, create_ride_state, writer,
+            dead_letter=DeadLetterFile(), malformed_error=MalformedLogError, tick=tick_ride_state
+        )
+        signal.signal(signal.SIGTERM, pipeline.stop)
+        signal.signal(signal.SIGINT, pipeline.stop)
+        pipeline.run()
+    except KafkaException as e:
+        logging.error(f"Error raised whilst accessing Kafka stream: {e}")
+    finally:
+        if trigger is not None:
+            # the writer has stopped, so every ride end is in the coalescer
+            trigger.stop()
+        if publisher is not None:
+            publisher.stop()
+        if c is not None:
+            c.close()
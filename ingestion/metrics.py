@@ -0,0 +1,177 @@
+"""Ingestion metrics:
+Prometheus counters & histograms for each ingestion stage.
+
+Scraped from http://{HOST}:{METRICS_PORT}/metrics whilst the consumer runs."""
+from confluent_kafka import Consumer, Message, TopicPartition
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Parsing is microseconds, inserts & SES calls are milliseconds to seconds
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+POLL_SECONDS = Histogram(
+    'ingestion_poll_seconds',
+    'Time spent waiting in consumer.poll',
+    buckets=LATENCY_BUCKETS
+)
+POLL_IDLE = Counter(
+    'ingestion_poll_idle_total',
+    'Polls that timed out without a message'
+)
+QUEUE_DEPTH = Gauge(
+    'ingestion_queue_depth',
+    'Items waiting between pipeline stages',
+    ['stage']
+)
+PARSE_SECONDS = Histogram(
+    'ingestion_parse_seconds',
+    'Time spent decoding & parsing a message',
+    ['stage'],
+    buckets=LATENCY_BUCKETS
+)
+INSERT_SECONDS = Histogram(
+    'ingestion_insert_seconds',
+    'Staging insert latency',
+    ['table'],
+    buckets=LATENCY_BUCKETS
+)
+ROWS_WRITTEN = Counter(
+    'ingestion_rows_written_total',
+    'Rows written to the staging tables',
+    ['table']
+)
+ROWS_DUPLICATE = Counter(
+    'ingestion_rows_duplicate_total',
+    'Rows skipped as already staged (replayed or reprocessed messages)',
+    ['table']
+)
+INSERT_ERRORS = Counter(
+    'ingestion_insert_errors_total',
+    'Staging inserts that raised an error',
+    ['table']
+)
+USER_CACHE = Counter(
+    'ingestion_user_cache_total',
+    'User profile cache lookups: hit (write skipped), changed (partial update) or miss',
+    ['result']
+)
+USER_CACHE_ENTRIES = Gauge(
+    'ingestion_user_cache_entries',
+    'User profiles held in the cache'
+)
+ALERT_SECONDS = Histogram(
+    'ingestion_alert_send_seconds',
+    'SES heart rate alert send latency',
+    buckets=LATENCY_BUCKETS
+)
+ALERTS = Counter(
+    'ingestion_alerts_total',
+    'Unsafe heart rate alerts, by whether the email was sent',
+    ['sent']
+)
+MESSAGES = Counter(
+    'ingestion_messages_total',
+    'Messages consumed, by log type',
+    ['kind']
+)
+MESSAGES_DROPPED = Counter(
+    'ingestion_messages_dropped_total',
+    'Messages consumed but not staged',
+    ['reason']
+)
+DEAD_LETTERS = Counter(
+    'ingestion_dead_letters_total',
+    'Messages written to the dead-letter file',
+    ['reason']
+)
+RIDES_STARTED = Counter(
+    'ingestion_rides_started_total',
+    'Rides started'
+)
+RIDES_FINISHED = Counter(
+    'ingestion_rides_finished_total',
+    'Rides finished'
+)
+TRIGGERS = Counter(
+    'ingestion_transformation_triggers_total',
+    'Transformation triggers published (one per coalescing window)'
+)
+TRIGGER_RIDES = Histogram(
+    'ingestion_transformation_trigger_rides',
+    'Finished rides carried by each transformation trigger',
+    buckets=[1, 2, 5, 10, 20, 50, 100, 200, 500]
+)
+PUBLISH_SECONDS = Histogram(
+    'ingestion_publish_seconds',
+    'SNS publish (batch) call latency',
+    buckets=LATENCY_BUCKETS
+)
+PUBLISHED = Counter(
+    'ingestion_published_messages_total',
+    'SNS messages, by result: sent, retried or spooled',
+    ['result']
+)
+PUBLISH_QUEUE = Gauge(
+    'ingestion_publish_queue_messages',
+    'SNS messages waiting to be published'
+)
+BUFFERED_RECORDS = Gauge(
+    'ingestion_buffered_records',
+    'Ride & Telemetry records held by the event buffer, waiting for a partner'
+)
+BUFFER_SECONDS = Histogram(
+    'ingestion_buffer_seconds',
+    'Time a record waited in the event buffer for its partner',
+    buckets=LATENCY_BUCKETS
+)
+STALE_READINGS = Counter(
+    'ingestion_stale_readings_total',
+    'Telemetry older than the alert freshness horizon, not checked for alerts'
+)
+HEART_RATE_TRANSITIONS = Counter(
+    'ingestion_heart_rate_transitions_total',
+    'Riders flagged unsafe (by reason) or safe again by the fleet monitor',
+    ['state', 'reason']
+)
+UNSAFE_RIDERS = Gauge(
+    'ingestion_unsafe_riders',
+    'Monitored riders whose latest heart rate is unsafe'
+)
+MONITORED_RIDERS = Gauge(
+    'ingestion_monitored_riders',
+    'Riders in the fleet heart rate monitor'
+)
+CATCH_UP = Gauge(
+    'ingestion_catch_up',
+    '1 whilst the pipeline is in catch-up mode (bulk writes, no per-message logs)'
+)
+CONSUMER_LAG = Gauge(
+    'ingestion_consumer_lag_messages',
+    'Messages between the last consumed offset & the high watermark',
+    ['partition']
+)
+
+def start_metrics_server(port: int) -> None:
+    """
+    Serves /metrics on a background thread
+    """
+    start_http_server(port)
+
+def update_consumer_lag(consumer: Consumer, msg: Message) -> int:
+    """
+    Sets the lag of the message's partition, using the high watermark
+    cached from the last fetch (no broker round trip)
+
+    Returns:
+    - lag (messages)
+    - None if no watermark is cached yet
+    """
+    partition = TopicPartition(msg.topic(), msg.partition())
+    _, high = consumer.get_watermark_offsets(partition, cached=True)
+    if high < 0:
+        return None
+    lag = max(high - msg.offset() - 1, 0)
+    CONSUMER_LAG.labels(partition=msg.partition()).set(lag)
+    return lag
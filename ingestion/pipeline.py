@@ -0,0 +1,453 @@
+"""Ingestion pipeline:
+Overlaps Kafka polling, log parsing & staging I/O.
+
+    poll thread -> [raw queue] -> parse workers -> [parsed queue]
+        -> sequencer (ride state, in offset order) -> [write queue] -> writer
+
+Every queue is bounded, so a slow stage holds back the stages before it.
+stop() (SIGTERM) stops polling, then drains every stage & flushes the
+writer before run() returns.
+
+Messages that cannot be decoded, parsed or applied go to the dead-letter
+file (see dead_letter.py) and processing carries on.
+
+Offsets are committed every COMMIT_SECONDS once the rows before them are
+written, at the start of the oldest ride still open, so a restart resumes
+where it stopped & replays the whole of an unfinished ride. When consumer lag
+passes CATCH_UP_LAG (e.g. after downtime), the pipeline catches up in bulk
+until the lag is back under CATCH_UP_EXIT_LAG (see CatchUpMode)."""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from confluent_kafka import Consumer, KafkaException, TopicPartition
+
+from dead_letter import DeadLetterFile
+from metrics import (
+    CATCH_UP, MESSAGES_DROPPED, PARSE_SECONDS, POLL_IDLE, POLL_SECONDS, QUEUE_DEPTH,
+    update_consumer_lag
+)
+
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '2'))
+QUEUE_SIZE = int(os.getenv('QUEUE_SIZE', '1000'))
+POLL_TIMEOUT_SECONDS = float(os.getenv('POLL_TIMEOUT_SECONDS', '1.0'))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '500'))
+WRITE_FLUSH_SECONDS = float(os.getenv('WRITE_FLUSH_SECONDS', '1.0'))
+COMMIT_SECONDS = float(os.getenv('COMMIT_SECONDS', '5.0'))
+
+CATCH_UP_LAG = int(os.getenv('CATCH_UP_LAG', '10000'))
+CATCH_UP_EXIT_LAG = int(os.getenv('CATCH_UP_EXIT_LAG', '1000'))
+CATCH_UP_BATCH_SIZE = int(os.getenv('CATCH_UP_BATCH_SIZE', '20000'))
+CATCH_UP_FLUSH_SECONDS = float(os.getenv('CATCH_UP_FLUSH_SECONDS', '10.0'))
+CATCH_UP_LOG_SECONDS = float(os.getenv('CATCH_UP_LOG_SECONDS', '30.0'))
+CATCH_UP_LOG_BUFFER = int(os.getenv('CATCH_UP_LOG_BUFFER', '10000'))
+
+# Tables are flushed in this order, so a ride's user rows land before its metrics
+# & its summary lands after them
+TABLE_ORDER = ['user_table', 'user_ride', 'metrics_table', 'ride_summary']
+
+STOP = object()
+
+class StagingWriter(threading.Thread):
+    """
+    Writer stage: batches staging rows per table & runs notification calls
+    (SES, SNS) off the polling & parsing path
+
+    Rows are flushed when a batch fills up, every flush interval, when the
+    writer goes idle, before a flush_first call and on stop
+
+    In catch-up mode, batches are larger & less frequent, and tables with a
+    bulk insert (bulk_insert_batch, e.g. COPY) use it
+    """
+
+    def __init__(self, insert_batch: dict, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_seconds: float = WRITE_FLUSH_SECONDS, queue_size: int = QUEUE_SIZE,
+                 bulk_insert_batch: dict = None):
+        super().__init__(name='staging-writer', daemon=True)
+        self.insert_batch = insert_batch
+        self.bulk_insert_batch = bulk_insert_batch or {}
+        self.live_batch_size = batch_size
+        self.live_flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.catch_up = False
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = defaultdict(list)
+        self.pending_rows = 0
+        QUEUE_DEPTH.labels('write').set_function(self.queue.qsize)
+
+    def write(self, table: str, row: dict) -> None:
+        """
+        Queues a row for its staging table (blocks whilst the queue is full)
+        """
+        self.queue.put(('row', table, row))
+
+    def call(self, func, *args, flush_first: bool = False, **kwargs) -> None:
+        """
+        Queues a notification call, optionally flushing every queued row first
+        """
+        self.queue.put(('call', func, args, kwargs, flush_first))
+
+    def stop(self) -> None:
+        """
+        Flushes everything queued so far, then ends the thread
+        """
+        self.queue.put(STOP)
+
+    def set_catch_up(self, catch_up: bool) -> None:
+        """
+        Switches between large bulk batches (catch-up) & small frequent ones
+        """
+        self.catch_up = catch_up
+        self.batch_size = CATCH_UP_BATCH_SIZE if catch_up else self.live_batch_size
+        self.flush_seconds = CATCH_UP_FLUSH_SECONDS if catch_up else self.live_flush_seconds
+
+    def flush(self) -> None:
+        """
+        Inserts every pending row, one batch per table
+        """
+        for table in TABLE_ORDER:
+            rows = self.pending.pop(table, None)
+            if rows:
+                insert_batch = self.bulk_insert_batch.get(table) if self.catch_up else None
+                (insert_batch or self.insert_batch[table])(rows)
+        self.pending_rows = 0
+
+    def run(self) -> None:
+        deadline = time.monotonic() + self.flush_seconds
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is STOP:
+                self.flush()
+                return
+
+            if item is not None and item[0] == 'row':
+                _, table, row = item
+                self.pending[table].append(row)
+                self.pending_rows += 1
+            elif item is not None:
+                _, func, args, kwargs, flush_first = item
+                if flush_first:
+                    self.flush()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    logging.error("Error raised whilst running %s: %s", func.__name__, e)
+
+            if item is None or self.pending_rows >= self.batch_size or time.monotonic() >= deadline:
+                self.flush()
+                deadline = time.monotonic() + self.flush_seconds
+
+class CatchUpMode:
+    """
+    Switches the writer & logging between low-latency & catch-up mode on
+    the consumer lag, with hysteresis: on above enter_lag, off below exit_lag
+
+    Whilst catching up, logs are buffered in memory (a MemoryHandler in front
+    of each root handler) rather than written per message, and nothing is
+    lost: the buffers are written out with each progress log (every
+    CATCH_UP_LOG_SECONDS), once CATCH_UP_LOG_BUFFER records are held, on a
+    WARNING or above (in order), and on exit
+    """
+
+    def __init__(self, writer: StagingWriter, enter_lag: int = CATCH_UP_LAG, exit_lag: int = CATCH_UP_EXIT_LAG,
+                 log_seconds: float = CATCH_UP_LOG_SECONDS, log_buffer: int = CATCH_UP_LOG_BUFFER):
+        self.writer = writer
+        self.enter_lag = enter_lag
+        self.exit_lag = exit_lag
+        self.log_seconds = log_seconds
+        self.log_buffer = log_buffer
+        self.active = False
+        self.messages = 0
+        self.started = None
+        self.next_log = None
+        self.root_handlers = []
+        self.buffers = []
+        self.log = logging.getLogger('catch_up')
+        self.log.setLevel(logging.INFO)
+
+    def update(self, lag: int) -> None:
+        """
+        Poll thread: checks the total consumer lag after each message
+        """
+        if not self.active:
+            if lag > self.enter_lag:
+                self.enter(lag)
+            return
+
+        self.messages += 1
+        if lag < self.exit_lag:
+            self.exit(lag)
+        elif time.monotonic() >= self.next_log:
+            self.log.info('CATCHING UP: LAG %s, %s MESSAGES SO FAR', lag, self.messages) # - check
+            self.flush_logs()
+            self.next_log = time.monotonic() + self.log_seconds
+
+    def enter(self, lag: int) -> None:
+        """
+        Switches to catch-up mode
+        """
+        self.active = True
+        self.messages = 0
+        self.started = time.monotonic()
+        self.next_log = self.started + self.log_seconds
+        self.writer.set_catch_up(True)
+        CATCH_UP.set(1)
+        self.log.info('CATCH-UP MODE ON: LAG %s', lag) # - check
+        self.hold_logs()
+
+    def exit(self, lag: int) -> None:
+        """
+        Switches back to low-latency mode
+        """
+        self.active = False
+        self.writer.set_catch_up(False)
+        CATCH_UP.set(0)
+        self.release_logs()
+        self.log.info(
+            'CATCH-UP MODE OFF: LAG %s, %s MESSAGES IN %.0fs',
+            lag, self.messages, time.monotonic() - self.started
+        ) # - check
+
+    def hold_logs(self) -> None:
+        """
+        Puts a MemoryHandler in front of each root handler
+        """
+        root = logging.getLogger()
+        self.root_handlers = root.handlers[:]
+        self.buffers = [
+            logging.handlers.MemoryHandler(self.log_buffer, flushLevel=logging.WARNING, target=handler)
+            for handler in self.root_handlers
+        ]
+        for handler, buffer in zip(self.root_handlers, self.buffers):
+            root.removeHandler(handler)
+            root.addHandler(buffer)
+
+    def flush_logs(self) -> None:
+        """
+        Writes the buffered logs out, in order
+        """
+        for buffer in self.buffers:
+            buffer.flush()
+
+    def release_logs(self) -> None:
+        """
+        Writes the buffered logs out & puts the root handlers back
+        """
+        root = logging.getLogger()
+        for handler, buffer in zip(self.root_handlers, self.buffers):
+            root.removeHandler(buffer)
+            buffer.close()
+            root.addHandler(handler)
+        self.root_handlers = []
+        self.buffers = []
+
+class IngestionPipeline:
+    """
+    Runs the poll thread, parse workers & sequencer feeding a StagingWriter
+    - parse: pure function of a decoded message (ingestion.parse_log)
+    - apply: ordered ride state machine (ingestion.apply_log)
+    - create_state: fresh ride state for apply (ingestion.create_ride_state)
+    - malformed_error: exception parse raises for a malformed log (ingestion.MalformedLogError)
+    - tick: moves the ride state on whilst no messages arrive (ingestion.tick_ride_state)
+    - state['open_rides'] counts the rides still buffered; the offsets of
+      their start messages hold back offset commits
+    """
+
+    def __init__(self, consumer: Consumer, parse, apply, create_state, writer: StagingWriter,
+                 dead_letter: DeadLetterFile = None, malformed_error: type = ValueError, parse_workers: int = PARSE_WORKERS, queue_size: int = QUEUE_SIZE,
+                 poll_timeout: float = POLL_TIMEOUT_SECONDS, catch_up: CatchUpMode = None,
+                 commit_seconds: float = COMMIT_SECONDS, tick=None):
+        self.consumer = consumer
+        self.parse = parse
+        self.apply = apply
+        self.create_state = create_state
+        self.writer = writer
+        self.dead_letter = dead_letter or DeadLetterFile()
+        self.malformed_error = malformed_error
+        self.parse_workers = parse_workers
+        self.poll_timeout = poll_timeout
+        self.raw_queue = queue.Queue(maxsize=queue_size)
+        self.parsed_queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.catch_up = catch_up or CatchUpMode(writer)
+        self.commit_seconds = commit_seconds
+        self.tick = tick
+        self.lag = {}
+        self.positions = {}
+        QUEUE_DEPTH.labels('parse').set_function(self.raw_queue.qsize)
+        QUEUE_DEPTH.labels('sequence').set_function(self.parsed_queue.qsize)
+
+    def stop(self, *_) -> None:
+        """
+        Stops polling; run() returns once in-flight messages are written
+        Usable as a signal handler
+        """
+        logging.info('STOPPING INGESTION PIPELINE...') # - check
+        self.stopping.set()
+
+    def poll(self) -> None:
+        """
+        Poll thread: numbers each message in offset order & queues it
+        """
+        sequence = 0
+        while not self.stopping.is_set():
+            with POLL_SECONDS.time():
+                msg = self.consumer.poll(self.poll_timeout)
+
+            if msg is None:
+                POLL_IDLE.inc()
+            elif msg.error():
+                MESSAGES_DROPPED.labels('consumer_error').inc()
+                logging.error(f"CONSUMER ERROR: {msg.error()}")
+            else:
+                lag = update_consumer_lag(self.consumer, msg)
+                if lag is not None:
+                    self.lag[msg.partition()] = lag
+                    self.catch_up.update(sum(self.lag.values()))
+                self.raw_queue.put((sequence, msg))
+                sequence += 1
+
+        for _ in range(self.parse_workers):
+            self.raw_queue.put(STOP)
+
+    def parse_messages(self) -> None:
+        """
+        Parse worker: decodes & parses messages in any order
+        Unparseable messages are dead-lettered & passed on as None,
+        so the sequence has no gaps
+        """
+        while True:
+            item = self.raw_queue.get()
+            if item is STOP:
+                self.parsed_queue.put(STOP)
+                return
+
+            sequence, msg = item
+            parsed = None
+            try:
+                with PARSE_SECONDS.labels('decode').time():
+                    msg_value = json.loads(msg.value().decode('utf-8'))
+            except ValueError as e:
+                self.dead_letter.write('undecodable', msg, e)
+            else:
+                try:
+                    with PARSE_SECONDS.labels('log').time():
+                        parsed = self.parse(msg_value)
+                except self.malformed_error as e:
+                    self.dead_letter.write('malformed', msg, e)
+                except Exception as e:
+                    self.dead_letter.write('parse_error', msg, e)
+            self.parsed_queue.put((sequence, msg, parsed))
+
+    def commit(self, positions: dict) -> None:
+        """
+        Commits the offsets to resume each partition from
+        """
+        if positions:
+            self.consumer.commit(
+                offsets=[TopicPartition(topic, partition, offset) for (topic, partition), offset in positions.items()],
+                asynchronous=False
+            )
+
+    def update_positions(self, state: dict, ride_starts: dict, next_offsets: dict) -> None:
+        """
+        Resume positions: the start of the oldest ride still open, else after
+        the last message applied
+        Rides close oldest first, so only the last state['open_rides'] starts are kept
+        """
+        open_rides = state.get('open_rides', 0)
+        for partition, next_offset in next_offsets.items():
+            starts = ride_starts[partition]
+            del starts[:max(len(starts) - open_rides, 0)]
+            self.positions[partition] = starts[0] if starts else next_offset
+
+    def sequence_messages(self) -> None:
+        """
+        Sequencer: restores offset order & applies each message to the ride state
+        Every commit_seconds, the resume positions are committed once the
+        writer has flushed the rows before them
+        Whilst no messages arrive, tick(state) closes rides the clock has passed
+        """
+        state = self.create_state()
+        pending = {}
+        next_sequence = 0
+        stopped_workers = 0
+        ride_starts = defaultdict(list)
+        next_offsets = {}
+        next_commit = time.monotonic() + self.commit_seconds
+
+        while stopped_workers < self.parse_workers:
+            try:
+                item = self.parsed_queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                if self.tick is not None:
+                    try:
+                        self.tick(state, writer=self.writer)
+                    except Exception as e:
+                        logging.error(f"Error raised whilst moving the ride state on: {e}")
+                    self.update_positions(state, ride_starts, next_offsets)
+                continue
+            if item is STOP:
+                stopped_workers += 1
+                continue
+
+            sequence, msg, parsed = item
+            pending[sequence] = (msg, parsed)
+            while next_sequence in pending:
+                msg, parsed = pending.pop(next_sequence)
+                next_sequence += 1
+                if parsed is not None:
+                    try:
+                        self.apply(parsed, state, writer=self.writer)
+                    except Exception as e:
+                        self.dead_letter.write('apply_error', msg, e)
+
+                partition = (msg.topic(), msg.partition())
+                if parsed is not None and parsed.get('kind') == 'start':
+                    ride_starts[partition].append(msg.offset())
+                next_offsets[partition] = msg.offset() + 1
+                self.update_positions(state, ride_starts, next_offsets)
+
+            if time.monotonic() >= next_commit:
+                self.writer.call(self.commit, dict(self.positions), flush_first=True)
+                next_commit = time.monotonic() + self.commit_seconds
+
+    def run(self) -> None:
+        """
+        Runs every stage until stop(), then drains & flushes them in order
+        """
+        self.writer.start()
+        threads = [threading.Thread(target=self.poll, name='poll', daemon=True)]
+        threads += [
+            threading.Thread(target=self.parse_messages, name=f'parse-{i}', daemon=True)
+            for i in range(self.parse_workers)
+        ]
+        sequencer = threading.Thread(target=self.sequence_messages, name='sequencer', daemon=True)
+        threads.append(sequencer)
+
+        for thread in threads:
+            thread.start()
+
+        # join with a timeout, so signals still reach the main thread
+        while sequencer.is_alive():
+            sequencer.join(timeout=1.0)
+
+        self.writer.stop()
+        self.writer.join()
+        try:
+            self.commit(self.positions)
+        except KafkaException as e:
+            logging.error(f"Error raised whilst committing offsets: {e}")
+        # logs buffered by catch-up mode are written before stopping
+        self.catch_up.release_logs()
+        logging.info('INGESTION PIPELINE STOPPED') # - check
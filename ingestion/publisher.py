@@ -0,0 +1,190 @@
+"""SNS publisher:
+Publishes transformation triggers from a background thread, so a slow or
+unavailable SNS never holds up the consumer.
+
+- messages are sent in batches of up to 10 (SNS publish_batch), or one by
+  one where the client has no publish_batch
+- failed sends are retried with exponential backoff
+- messages still unsent after PUBLISH_ATTEMPTS are appended to a spool file
+  (PUBLISH_SPOOL_PATH, one JSON record per line), resent after the next
+  successful send & when the consumer restarts"""
+from datetime import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from metrics import PUBLISH_SECONDS, PUBLISHED, PUBLISH_QUEUE
+
+load_dotenv()
+PUBLISH_SPOOL_PATH = os.getenv('PUBLISH_SPOOL_PATH', 'publish_spool.jsonl')
+PUBLISH_ATTEMPTS = int(os.getenv('PUBLISH_ATTEMPTS', '5'))
+PUBLISH_BACKOFF_SECONDS = float(os.getenv('PUBLISH_BACKOFF_SECONDS', '1.0'))
+PUBLISH_MAX_BACKOFF_SECONDS = float(os.getenv('PUBLISH_MAX_BACKOFF_SECONDS', '60.0'))
+
+# SNS publish_batch limit
+PUBLISH_BATCH_SIZE = 10
+
+class SnsPublisher(threading.Thread):
+    """
+    Batches queued messages to an SNS topic, retrying & spooling failures
+    publish() only queues the message, so callers never wait on SNS
+    """
+
+    def __init__(self, client, topic_arn: str, subject: str, spool_path: str = PUBLISH_SPOOL_PATH,
+                 attempts: int = PUBLISH_ATTEMPTS, backoff_seconds: float = PUBLISH_BACKOFF_SECONDS,
+                 max_backoff_seconds: float = PUBLISH_MAX_BACKOFF_SECONDS):
+        super().__init__(name='sns-publisher', daemon=True)
+        self.client = client
+        self.topic_arn = topic_arn
+        self.subject = subject
+        self.spool_path = spool_path
+        self.attempts = attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.spool_lock = threading.Lock()
+        PUBLISH_QUEUE.set_function(self.queue.qsize)
+
+    def publish(self, message: str) -> None:
+        """
+        Queues a message for the topic
+        """
+        self.queue.put(message)
+
+    def stop(self) -> None:
+        """
+        Sends what is queued (one attempt, the rest is spooled), then ends the thread
+        """
+        self.stopping.set()
+        self.join()
+
+    def send(self, messages: list) -> list:
+        """
+        Sends messages in one publish_batch call (or one publish call each)
+
+        Returns:
+        - messages that failed
+        """
+        with PUBLISH_SECONDS.time():
+            if not hasattr(self.client, 'publish_batch'):
+                failed = []
+                for message in messages:
+                    try:
+                        self.client.publish(TopicArn=self.topic_arn, Message=message, Subject=self.subject)
+                    except Exception as e:
+                        logging.warning("Error raised whilst publishing to %s: %s", self.topic_arn, e)
+                        failed.append(message)
+                return failed
+
+            try:
+                response = self.client.publish_batch(
+                    TopicArn=self.topic_arn,
+                    PublishBatchRequestEntries=[
+                        {'Id': str(i), 'Message': message, 'Subject': self.subject}
+                        for i, message in enumerate(messages)
+                    ]
+                )
+            except Exception as e:
+                logging.warning("Error raised whilst publishing %s messages to %s: %s", len(messages), self.topic_arn, e)
+                return messages
+
+        for failure in response.get('Failed', []):
+            logging.warning("SNS rejected message %s: %s", failure['Id'], failure.get('Message'))
+        return [messages[int(failure['Id'])] for failure in response.get('Failed', [])]
+
+    def send_with_retries(self, messages: list) -> bool:
+        """
+        Sends a batch, retrying the failed messages with exponential backoff
+        Messages still failing after the last attempt are spooled
+
+        Returns:
+        - True if every message was sent
+        """
+        attempts = 1 if self.stopping.is_set() else self.attempts
+        for attempt in range(attempts):
+            failed = self.send(messages)
+            PUBLISHED.labels('sent').inc(len(messages) - len(failed))
+            if not failed:
+                return True
+            messages = failed
+            if attempt < attempts - 1:
+                PUBLISHED.labels('retried').inc(len(messages))
+                # stop() cuts the backoff short, the messages are spooled instead
+                if self.stopping.wait(min(self.backoff_seconds * 2 ** attempt, self.max_backoff_seconds)):
+                    break
+
+        self.spool(messages)
+        return False
+
+    def spool(self, messages: list) -> None:
+        """
+        Appends unsent messages to the spool file
+        """
+        PUBLISHED.labels('spooled').inc(len(messages))
+        spooled_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            with self.spool_lock, open(self.spool_path, 'a', encoding='utf-8') as spool:
+                spool.writelines(
+                    json.dumps({'message': message, 'spooled_at': spooled_at}) + '\n' for message in messages
+                )
+        except OSError as e:
+            logging.error("Error raised whilst spooling %s messages to %s: %s", len(messages), self.spool_path, e)
+
+    def reload_spool(self) -> int:
+        """
+        Queues the spooled messages again & empties the spool file
+
+        Returns:
+        - messages reloaded
+        """
+        with self.spool_lock:
+            try:
+                with open(self.spool_path, encoding='utf-8') as spool:
+                    messages = [json.loads(line)['message'] for line in spool if line.strip()]
+                os.remove(self.spool_path)
+            except FileNotFoundError:
+                return 0
+            except (OSError, ValueError, KeyError) as e:
+                logging.error("Error raised whilst reading spool %s: %s", self.spool_path, e)
+                return 0
+
+        for message in messages:
+            self.queue.put(message)
+        if messages:
+            logging.info('RELOADED %s SPOOLED MESSAGES', len(messages)) # - check
+        return len(messages)
+
+    def next_batch(self) -> list:
+        """
+        Returns:
+        - up to PUBLISH_BATCH_SIZE queued messages (empty if none arrive soon)
+        """
+        try:
+            messages = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(messages) < PUBLISH_BATCH_SIZE:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def run(self) -> None:
+        self.reload_spool()
+        while True:
+            stopping = self.stopping.is_set()
+            messages = self.next_batch()
+            if messages:
+                sent = self.send_with_retries(messages)
+                if sent and not stopping and os.path.exists(self.spool_path):
+                    # SNS is reachable again
+                    self.reload_spool()
+            elif stopping:
+                return
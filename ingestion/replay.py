@@ -0,0 +1,300 @@
+"""Ingestion replay:
+Drives the ingestion parsing & staging code from a recorded file of raw
+Deloton log messages, without a live Kafka cluster.
+
+A recording is one Kafka message value per line: {"log": "..."}
+
+Usage:
+    python replay.py record --output rides.jsonl [--limit N]
+    python replay.py replay rides.jsonl [--speed X] [--db-url URL | --skip-db]
+
+--speed 0 (default) replays at full speed, --speed 2 at twice real time.
+No SES alerts or SNS messages are sent whilst replaying: ride ends go
+through the trigger coalescer in log time (--trigger-window) into a local
+queue, to count the transformation runs they would trigger. Every reading
+reaches the heart rate monitor however old the recording, so the alerts
+it would have sent are counted. Malformed
+messages are counted by reason rather than stopping the replay, so a
+dead-letter file can be replayed as a recording."""
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime
+import json
+import re
+import statistics
+import time
+
+import sqlalchemy
+
+import ingestion
+from trigger import TRIGGER_WINDOW_SECONDS, LocalTriggerQueue, TriggerCoalescer
+
+# Stages timed by wrapping the ingestion functions process_log looks up
+PARSE_STAGES = ['parse_log', 'create_user_row', 'build_metrics_row', 'calculate_age']
+ALERT_STAGES = ['alert_transitions', 'get_heart_rate_info']
+WRITE_STAGES = ['insert_user_row', 'insert_user_ride_row', 'insert_metrics_row', 'insert_ride_summary_row']
+
+def read_recording(path: str):
+    """
+    Yields decoded log messages from a recording, skipping blank lines
+    Dead-letter records (see dead_letter.py) yield their raw message value,
+    except undecodable ones
+    """
+    with open(path, encoding='utf-8') as recording:
+        for line in recording:
+            if line.strip():
+                msg_value = json.loads(line)
+                if 'reason' in msg_value and 'value' in msg_value:
+                    if msg_value['reason'] == 'undecodable':
+                        continue
+                    msg_value = json.loads(msg_value['value'])
+                yield msg_value
+
+def get_log_time(msg_value: dict) -> datetime:
+    """
+    Extracts the timestamp at the start of a log line
+
+    Returns:
+    - datetime of the log
+    - None if the log has no timestamp
+    """
+    time_match = re.match(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?)', msg_value['log'])
+    if not time_match:
+        return None
+    return datetime.fromisoformat(time_match.group(1))
+
+def summarise_latencies(timings: list) -> dict:
+    """
+    Returns:
+    - dictionary of call count & latency percentiles (ms)
+    """
+    ordered = sorted(timings)
+    count = len(ordered)
+    return {
+        'calls': count,
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[int(count * 0.50)] * 1000,
+        'p95_ms': ordered[min(int(count * 0.95), count - 1)] * 1000,
+        'p99_ms': ordered[min(int(count * 0.99), count - 1)] * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+def instrument_stages(skip_db: bool) -> tuple:
+    """
+    Wraps the ingestion stage functions to time them & count DB writes
+    With skip_db, the insert functions only count the rows they would write
+
+    Returns:
+    - (dictionary of stage -> call timings, Counter of writes per function,
+       dictionary of the original functions to restore)
+    """
+    timings = defaultdict(list)
+    writes = Counter()
+    originals = {name: getattr(ingestion, name) for name in PARSE_STAGES + ALERT_STAGES + WRITE_STAGES}
+
+    def timed(name, func, is_write):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if is_write:
+                    writes[name] += 1
+                    if skip_db:
+                        return None
+                return func(*args, **kwargs)
+            finally:
+                timings[name].append(time.perf_counter() - start)
+        return wrapper
+
+    for name, func in originals.items():
+        setattr(ingestion, name, timed(name, func, name in WRITE_STAGES))
+
+    return timings, writes, originals
+
+class ReplayWriter(ingestion.InlineWriter):
+    """
+    Stages rows inline like ingestion.InlineWriter, but sends no SES alerts
+    & adds ride ends to the trigger coalescer at the current log time
+    """
+
+    def __init__(self, coalescer: TriggerCoalescer):
+        self.coalescer = coalescer
+        self.log_seconds = 0.0
+        self.rides_finished = 0
+
+    def call(self, func, *args, flush_first: bool = False, **kwargs) -> None:
+        """
+        Runs a notification call, without sending it
+        """
+        if func is ingestion.publish_ride_end:
+            self.rides_finished += 1
+            self.coalescer.add(args[0], self.log_seconds)
+            return
+        if 'send_alert' in kwargs:
+            kwargs['send_alert'] = False
+        func(*args, **kwargs)
+
+def replay(path: str, speed: float = 0, skip_db: bool = False,
+           trigger_window: float = TRIGGER_WINDOW_SECONDS) -> dict:
+    """
+    Feeds every message in the recording through ingestion.process_log
+    - speed 0: as fast as possible
+    - speed X: X times real time, paced by the log timestamps
+    - ride ends are coalesced into triggers by log time (trigger_window seconds)
+
+    Returns:
+    - dictionary of throughput, per-stage latency & DB write counts
+    """
+    timings, writes, originals = instrument_stages(skip_db)
+    # recorded readings are past the alert freshness horizon, but are monitored as they were live
+    state = ingestion.create_ride_state(fresh_only=False)
+    dead_letters = Counter()
+    triggers = LocalTriggerQueue()
+    coalescer = TriggerCoalescer(triggers.publish, trigger_window)
+    writer = ReplayWriter(coalescer)
+    messages = 0
+
+    first_log_time = None
+    start = time.perf_counter()
+    try:
+        log_seconds = 0.0
+        for msg_value in read_recording(path):
+            log_time = get_log_time(msg_value)
+            if log_time is not None:
+                first_log_time = first_log_time or log_time
+                log_seconds = (log_time - first_log_time).total_seconds()
+                writer.log_seconds = log_seconds
+                coalescer.poll(log_seconds)
+
+            if speed and log_time is not None:
+                due = log_seconds / speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            message_start = time.perf_counter()
+            try:
+                ingestion.process_log(msg_value, state, writer=writer)
+            except ingestion.MalformedLogError as e:
+                dead_letters[str(e)] += 1
+            timings['process_log'].append(time.perf_counter() - message_start)
+            messages += 1
+        # the recording ends, not the rides: close whatever is still buffered
+        ingestion.close_ride_state(state, writer=writer)
+        coalescer.flush()
+    finally:
+        for name, func in originals.items():
+            setattr(ingestion, name, func)
+
+    elapsed = time.perf_counter() - start
+    buffer_stats = state['rides'].stats
+    results = {
+        'messages': messages,
+        'rides': buffer_stats['rides_opened'],
+        'rides_finished': writer.rides_finished,
+        'transformation_triggers': len(triggers.drain()),
+        'trigger_window_s': trigger_window,
+        'elapsed_s': elapsed,
+        'messages_per_s': messages / elapsed if elapsed else 0.0,
+        'stages': {name: summarise_latencies(stage) for name, stage in timings.items() if stage},
+        'db_writes': dict(writes),
+        'dead_letters': dict(dead_letters),
+        'event_buffer': {
+            'pairs': buffer_stats['pairs'],
+            'max_buffered': buffer_stats['max_buffered'],
+            'overhead_s': buffer_stats['seconds'],
+            'dropped': {
+                name[len('dropped_'):]: count for name, count in buffer_stats.items() if name.startswith('dropped_')
+            }
+        },
+        'db_skipped': skip_db
+    }
+    return results
+
+def record(output: str, limit: int = None) -> int:
+    """
+    Records raw message values from the live Kafka topic into a file
+
+    Returns:
+    - number of messages recorded
+    """
+    consumer = ingestion.start_consumer()
+    consumer.subscribe([ingestion.KAFKA_TOPIC])
+
+    recorded = 0
+    try:
+        with open(output, 'w', encoding='utf-8') as recording:
+            while limit is None or recorded < limit:
+                msg = consumer.poll(1.0)
+                if msg is None or msg.error():
+                    continue
+                recording.write(msg.value().decode('utf-8').strip() + '\n')
+                recorded += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.close()
+
+    return recorded
+
+def print_results(results: dict) -> None:
+    """
+    Prints a replay summary
+    """
+    print(f"messages: {results['messages']}  rides: {results['rides']}  elapsed: {results['elapsed_s']:.2f}s")
+    print(f"throughput: {results['messages_per_s']:.0f} messages/s")
+    print(f"{'stage':<24}{'calls':>9}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stage in results['stages'].items():
+        print(
+            f"{name:<24}{stage['calls']:>9}{stage['mean_ms']:>10.3f}{stage['p50_ms']:>10.3f}"
+            f"{stage['p95_ms']:>10.3f}{stage['p99_ms']:>10.3f}{stage['max_ms']:>10.3f}"
+        )
+    skipped = ' (skipped, not executed)' if results['db_skipped'] else ''
+    print(f"db writes{skipped}: {results['db_writes']}")
+    print(f"malformed messages: {results['dead_letters']}")
+    print(
+        f"transformation triggers: {results['transformation_triggers']} for {results['rides_finished']} ride ends "
+        f"({results['trigger_window_s']:.0f}s window)"
+    )
+    event_buffer = results['event_buffer']
+    print(
+        f"event buffer: {event_buffer['pairs']} pairs, at most {event_buffer['max_buffered']} records held, "
+        f"{event_buffer['overhead_s'] * 1000:.1f} ms overhead, dropped {event_buffer['dropped']}"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='record the live topic to a file')
+    record_parser.add_argument('--output', required=True)
+    record_parser.add_argument('--limit', type=int, default=None)
+
+    replay_parser = commands.add_parser('replay', help='replay a recording through ingestion')
+    replay_parser.add_argument('recording')
+    replay_parser.add_argument('--speed', type=float, default=0, help='multiple of real time, 0 for full speed')
+    replay_parser.add_argument('--trigger-window', type=float, default=TRIGGER_WINDOW_SECONDS,
+                               help='seconds of ride ends merged into one transformation trigger')
+    replay_parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    target = replay_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--db-url', help='staging database to write to, e.g. a local PostgreSQL')
+    target.add_argument('--skip-db', action='store_true', help='count the staging writes without executing them')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        print(f'recorded {record(args.output, args.limit)} messages to {args.output}')
+        return
+
+    if args.db_url:
+        ingestion.engine = sqlalchemy.create_engine(args.db_url)
+        ingestion.ensure_staging_keys(ingestion.engine)
+        ingestion.ensure_ride_summary_table(ingestion.engine)
+    ingestion.log = ingestion.get_logger('WARNING')
+
+    results = replay(args.recording, args.speed, args.skip_db, args.trigger_window)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Transformation triggers:
+Coalesces ride-end events into transformation runs. Every ride that ends
+within TRIGGER_WINDOW_SECONDS of the first pending one shares a single
+message, carrying the finished ride ids:
+
+    {"table": "dash_table", "ride_ids": ["...", "..."]}
+
+The window only bounds how many runs are triggered; the transformation
+itself holds a lock per target table, so at most one run is in flight and
+runs queued behind it are skipped once a later run has covered them.
+
+LocalTriggerQueue stands in for the SNS topic, to run the coalescer (e.g.
+from replay.py) without AWS."""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from metrics import TRIGGER_RIDES, TRIGGERS
+
+load_dotenv()
+TRIGGER_WINDOW_SECONDS = float(os.getenv('TRIGGER_WINDOW_SECONDS', '30'))
+TRIGGER_TABLE = 'dash_table'
+
+def create_trigger_message(ride_ids: list, table: str = TRIGGER_TABLE) -> str:
+    """
+    Returns:
+    - JSON transformation trigger for the finished rides
+    """
+    return json.dumps({'table': table, 'ride_ids': ride_ids})
+
+class TriggerCoalescer(threading.Thread):
+    """
+    Merges ride-end events into one trigger per window, published by
+    publish(message) from its own thread
+
+    add & poll take an optional clock reading, so the coalescer can also be
+    driven by log time without starting the thread (see replay.py)
+    """
+
+    def __init__(self, publish, window_seconds: float = TRIGGER_WINDOW_SECONDS, table: str = TRIGGER_TABLE):
+        super().__init__(name='trigger-coalescer', daemon=True)
+        self.publish = publish
+        self.window_seconds = window_seconds
+        self.table = table
+        self.condition = threading.Condition()
+        self.pending = []
+        self.deadline = None
+        self.stopped = False
+
+    def add(self, ride_id: str, now: float = None) -> None:
+        """
+        Adds a finished ride, opening a window if none is pending
+        """
+        with self.condition:
+            if self.deadline is None:
+                self.deadline = (time.monotonic() if now is None else now) + self.window_seconds
+            if ride_id and ride_id not in self.pending:
+                self.pending.append(ride_id)
+            self.condition.notify()
+
+    def poll(self, now: float = None) -> str:
+        """
+        Publishes the pending rides once their window has closed
+
+        Returns:
+        - the published message
+        - None if the window is still open (or nothing is pending)
+        """
+        with self.condition:
+            if self.deadline is None or (time.monotonic() if now is None else now) < self.deadline:
+                return None
+        return self.flush()
+
+    def flush(self) -> str:
+        """
+        Publishes the pending rides now
+
+        Returns:
+        - the published message
+        - None if nothing is pending
+        """
+        with self.condition:
+            if self.deadline is None:
+                return None
+            ride_ids, self.pending, self.deadline = self.pending, [], None
+
+        message = create_trigger_message(ride_ids, self.table)
+        try:
+            self.publish(message)
+            TRIGGERS.inc()
+            TRIGGER_RIDES.observe(len(ride_ids))
+        except Exception as e:
+            logging.error("Error raised whilst publishing a trigger for %s rides: %s", len(ride_ids), e)
+        return message
+
+    def stop(self) -> None:
+        """
+        Publishes whatever is pending, then ends the thread
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        else:
+            self.flush()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.stopped and (self.deadline is None or time.monotonic() < self.deadline):
+                    timeout = None if self.deadline is None else self.deadline - time.monotonic()
+                    self.condition.wait(timeout)
+                stopped = self.stopped
+
+            self.flush()
+            if stopped:
+                return
+
+class LocalTriggerQueue:
+    """
+    Local stand-in for the SNS topic: keeps published triggers in a queue
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def publish(self, message: str) -> None:
+        """
+        Queues a trigger message
+        """
+        self.queue.put(json.loads(message))
+
+    def drain(self) -> list:
+        """
+        Returns:
+        - every trigger queued so far, oldest first
+        """
+        triggers = []
+        while not self.queue.empty():
+            triggers.append(self.queue.get_nowait())
+        return triggers
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the services are flat script directories, imported by module name as in their containers
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for service in ['ingestion', 'transformation', 'flask', 'visualisation']:
+    sys.path.insert(0, os.path.join(ROOT, service))
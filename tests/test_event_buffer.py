@@ -0,0 +1,81 @@
+from event_buffer import RideEventBuffer
+
+START = '2022-10-13 10:00:00.000000'
+
+def at(seconds: float) -> str:
+    """
+    Returns:
+    - log time the given seconds after START
+    """
+    whole = int(seconds)
+    return f'2022-10-13 10:{whole // 60:02d}:{whole % 60:02d}.{int(round((seconds - whole) * 1e6)):06d}'
+
+def identified_buffer(**kwargs) -> RideEventBuffer:
+    """
+    Returns:
+    - buffer with one open ride, identified as 'ride-1'
+    """
+    rides = RideEventBuffer(**kwargs)
+    rides.open_ride(START)
+    rides.identify('ride-1', {'user_id': 1})
+    return rides
+
+def test_pairs_telemetry_with_the_closest_earlier_ride_record():
+    rides = identified_buffer(pair_seconds=1.0)
+    assert rides.add('ride', {'n': 1}, at(1.0)) == []
+    assert rides.add('ride', {'n': 2}, at(1.5)) == []
+
+    pairs = rides.add('telemetry', {'t': 1}, at(1.6))
+    assert [(ride.ride_id, ride_record, telemetry) for ride, ride_record, telemetry in pairs] == [
+        ('ride-1', {'n': 2}, {'t': 1})
+    ]
+
+def test_pairs_records_arriving_out_of_order():
+    rides = identified_buffer()
+    assert rides.add('telemetry', {'t': 1}, at(2.5)) == []
+
+    pairs = rides.add('ride', {'n': 1}, at(2.0))
+    assert [(ride_record, telemetry) for _, ride_record, telemetry in pairs] == [({'n': 1}, {'t': 1})]
+    assert rides.buffered() == 0
+
+def test_holds_pairs_until_the_ride_is_identified():
+    rides = RideEventBuffer()
+    rides.open_ride(START)
+    rides.add('ride', {'n': 1}, at(1.0))
+    assert rides.add('telemetry', {'t': 1}, at(1.2)) == []
+
+    held = rides.identify('ride-1', {'user_id': 1})
+    assert [(ride.ride_id, ride_record, telemetry) for ride, ride_record, telemetry in held] == [
+        ('ride-1', {'n': 1}, {'t': 1})
+    ]
+
+def test_drops_records_older_than_the_watermark():
+    rides = identified_buffer(reorder_seconds=2.0)
+    rides.add('ride', {'n': 1}, at(10.0))
+
+    assert rides.add('telemetry', {'t': 1}, at(5.0)) == []
+    assert rides.stats['dropped_late'] == 1
+
+def test_watermark_expires_unpaired_records():
+    rides = identified_buffer(reorder_seconds=2.0, pair_seconds=1.0)
+    rides.add('ride', {'n': 1}, at(1.0))
+    rides.add('ride', {'n': 2}, at(10.0))
+    rides.advance()
+
+    assert rides.stats['dropped_unpaired_ride'] == 1
+    assert rides.buffered() == 1
+
+def test_closes_a_ride_once_the_watermark_passes_its_end():
+    rides = identified_buffer(reorder_seconds=2.0)
+    rides.end_ride(at(10.0))
+    assert rides.advance() == []
+
+    rides.open_ride(at(13.0))
+    closed = rides.advance()
+    assert [ride.ride_id for ride in closed] == ['ride-1']
+    assert len(rides.open_rides) == 1
+
+def test_records_outside_every_ride_are_dropped():
+    rides = RideEventBuffer()
+    assert rides.add('ride', {'n': 1}, at(1.0)) == []
+    assert rides.stats['dropped_outside_ride'] == 1
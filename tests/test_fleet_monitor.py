@@ -0,0 +1,102 @@
+from fleet_monitor import FleetHeartRateMonitor
+
+# age 30: safe range 95 - 133 bpm, hard limits 76 - 161.5 bpm
+AGE = 30
+
+def monitor_with(*ride_ids, **kwargs) -> FleetHeartRateMonitor:
+    """
+    Returns:
+    - monitor of the rides, all riders aged AGE
+    """
+    monitor = FleetHeartRateMonitor(**kwargs)
+    for ride_id in ride_ids:
+        monitor.add_rider(ride_id, AGE, {'name': ride_id})
+    return monitor
+
+def feed(monitor: FleetHeartRateMonitor, readings: dict, start: int, end: int) -> list:
+    """
+    Sends each ride its heart rate once a second, evaluating every second
+
+    Returns:
+    - every transition, with the second it happened at
+    """
+    transitions = []
+    for second in range(start, end):
+        for ride_id, heart_rate in readings.items():
+            monitor.update(ride_id, heart_rate)
+        transitions += [(second, *transition) for transition in monitor.evaluate(float(second))]
+    return transitions
+
+def test_safe_readings_raise_nothing():
+    monitor = monitor_with('a')
+    assert feed(monitor, {'a': 110}, 0, 60) == []
+    assert monitor.riders_unsafe() == 0
+
+def test_outside_hard_limits_is_unsafe_at_once():
+    monitor = monitor_with('a')
+    feed(monitor, {'a': 110}, 0, 5)
+    assert feed(monitor, {'a': 170}, 5, 6) == [(5, 'a', 'unsafe', 170, 'limit')]
+
+def test_out_of_safe_range_is_unsafe_after_sustained_seconds():
+    monitor = monitor_with('a', sustained_seconds=20)
+    feed(monitor, {'a': 140}, 0, 1)
+    transitions = feed(monitor, {'a': 140}, 1, 30)
+    assert transitions == [(20, 'a', 'unsafe', 140, 'sustained')]
+
+def test_safe_again_once_back_in_range():
+    monitor = monitor_with('a', sustained_seconds=5)
+    feed(monitor, {'a': 140}, 0, 10)
+    assert feed(monitor, {'a': 110}, 10, 12) == [(10, 'a', 'safe', 110, '')]
+    assert monitor.riders_unsafe() == 0
+
+def test_spike_from_the_rolling_mean():
+    monitor = monitor_with('a', spike_bpm=20, spike_seconds=1)
+    feed(monitor, {'a': 100}, 0, 15)
+    transitions = feed(monitor, {'a': 125}, 15, 18)
+    assert transitions == [(16, 'a', 'unsafe', 125, 'spike')]
+
+def test_no_signal_after_a_heart_rate_was_seen():
+    monitor = monitor_with('a', no_signal_seconds=10)
+    assert feed(monitor, {'a': 0}, 0, 15) == []
+    feed(monitor, {'a': 110}, 15, 16)
+    assert feed(monitor, {'a': 0}, 16, 30) == [(26, 'a', 'unsafe', 0, 'no_signal')]
+
+def test_rolling_mean_skips_zero_readings():
+    monitor = monitor_with('a', window=4)
+    for heart_rate in [100, 0, 110, 120, 130, 140]:
+        monitor.update('a', heart_rate)
+    assert monitor.rolling_mean('a') == 125.0
+
+def test_update_slot_matches_update_by_ride_id():
+    by_id = monitor_with('a', 'b')
+    by_slot = FleetHeartRateMonitor()
+    slots = {ride_id: by_slot.add_rider(ride_id, AGE, {'name': ride_id}) for ride_id in ['a', 'b']}
+    readings = {'a': 140, 'b': 170}
+
+    expected = feed(by_id, readings, 0, 25)
+    transitions = []
+    for second in range(25):
+        for ride_id, heart_rate in readings.items():
+            by_slot.update_slot(slots[ride_id], heart_rate)
+        transitions += [(second, *transition) for transition in by_slot.evaluate(float(second))]
+    assert transitions == expected
+
+def test_freed_slots_start_clean_and_arrays_grow():
+    monitor = monitor_with('a', 'b', capacity=2)
+    feed(monitor, {'a': 170, 'b': 110}, 0, 2)
+    monitor.remove_rider('a')
+    assert not monitor.update('a', 110)
+
+    monitor.add_rider('c', AGE, {'name': 'c'})
+    monitor.add_rider('d', AGE, {'name': 'd'})
+    assert monitor.riders_active() == 3
+    assert monitor.rolling_mean('c') == 0.0
+    assert feed(monitor, {'b': 110, 'c': 110, 'd': 170}, 2, 3) == [(2, 'd', 'unsafe', 170, 'limit')]
+
+def test_tick_evaluates_once_per_tick_seconds():
+    monitor = monitor_with('a', tick_seconds=5)
+    monitor.update('a', 170)
+    assert monitor.tick(0.0) == [('a', 'unsafe', 170, 'limit')]
+    monitor.update('a', 110)
+    assert monitor.tick(3.0) == []
+    assert monitor.tick(5.0) == [('a', 'safe', 110, '')]
@@ -0,0 +1,15 @@
+import uuid
+
+from ingestion import create_ride_id
+
+def test_create_ride_id_is_deterministic():
+    assert create_ride_id(42, '2022-10-13 10:00:00') == create_ride_id(42, '2022-10-13 10:00:00')
+    assert uuid.UUID(create_ride_id(42, '2022-10-13 10:00:00')).version == 5
+
+def test_create_ride_id_differs_by_rider_and_start():
+    ride_ids = {
+        create_ride_id(42, '2022-10-13 10:00:00'),
+        create_ride_id(43, '2022-10-13 10:00:00'),
+        create_ride_id(42, '2022-10-13 10:00:01')
+    }
+    assert len(ride_ids) == 3
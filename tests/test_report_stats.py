@@ -0,0 +1,40 @@
+import pandas as pd
+
+from report_stats import CELL_COLUMNS, merge_stats_cells
+
+def cells_for(day: str, rides: int) -> pd.DataFrame:
+    """
+    Returns:
+    - stats cells of one day: a female & a male cell of the 26 - 35 band
+    """
+    cells = pd.DataFrame({
+        'day': [day, day],
+        'gender': ['female', 'male'],
+        'age_band': ['26 - 35', '26 - 35']
+    })
+    for column in CELL_COLUMNS[3:]:
+        cells[column] = [rides, 2 * rides]
+    return cells[CELL_COLUMNS]
+
+def test_merge_sums_each_cell_under_the_first_day():
+    merged = merge_stats_cells([cells_for('2022-10-14', 1), cells_for('2022-10-13', 3)])
+
+    assert list(merged.columns) == CELL_COLUMNS
+    assert merged['day'].tolist() == ['2022-10-13', '2022-10-13']
+    merged = merged.set_index('gender')
+    assert merged.loc['female', 'rides'] == 4
+    assert merged.loc['male', 'power_total_sum'] == 8
+
+def test_merge_keeps_cells_without_a_gender():
+    cells = cells_for('2022-10-13', 1)
+    cells.loc[1, 'gender'] = None
+    merged = merge_stats_cells([cells, cells])
+
+    assert len(merged) == 2
+    assert merged['rides'].sum() == 6
+
+def test_merge_of_no_cells_is_empty():
+    merged = merge_stats_cells([cells_for('2022-10-13', 1).iloc[:0]])
+    assert merged.empty
+    assert list(merged.columns) == CELL_COLUMNS
+    assert merge_stats_cells([]).empty
@@ -0,0 +1,44 @@
+import numpy as np
+
+from timeline import downsample_timeline, lttb, min_max
+
+def test_lttb_keeps_the_ends_and_the_peak():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.sin(x / 50)
+    y[437] = 10
+
+    kept = lttb(x, y, 50)
+    assert len(kept) == 50
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 437 in kept
+    assert np.all(np.diff(kept) > 0)
+
+def test_lttb_returns_every_reading_when_there_are_few():
+    x = np.arange(10, dtype=np.float64)
+    assert lttb(x, x, 50).tolist() == list(range(10))
+    assert lttb(x, x, 2).tolist() == list(range(10))
+
+def test_min_max_keeps_every_bucket_extreme():
+    rng = np.random.default_rng(0)
+    y = rng.normal(size=1000)
+    y[123], y[876] = 50, -50
+
+    kept = min_max(y, 100)
+    assert len(kept) <= 100
+    assert 123 in kept and 876 in kept
+    for bucket in np.array_split(np.arange(1000), 50):
+        assert bucket[np.argmax(y[bucket])] in kept
+        assert bucket[np.argmin(y[bucket])] in kept
+
+def test_min_max_returns_every_reading_when_there_are_few():
+    assert min_max(np.arange(5, dtype=np.float64), 10).tolist() == list(range(5))
+
+def test_downsample_timeline_keeps_each_series_against_duration():
+    rows = [(second, 100 + second % 7, 2.0 * second, 60, 5) for second in range(600)]
+
+    timeline = downsample_timeline(rows, 40, 'lttb')
+    assert sorted(timeline) == ['heart_rate', 'power', 'resistance', 'rpm']
+    for series in timeline.values():
+        assert len(series['duration_seconds']) == len(series['value']) == 40
+        assert series['duration_seconds'][0] == 0 and series['duration_seconds'][-1] == 599
+    assert downsample_timeline([], 40, 'minmax')['heart_rate'] == {'duration_seconds': [], 'value': []}
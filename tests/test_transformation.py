@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+import tranformation
+
+def staging_frames() -> dict:
+    """
+    Returns:
+    Dictionary with staging dataframes, dtypes as pd.read_sql_query returns them:
+    - three users, two rides each, the last ride of each without metrics
+    """
+    user_df = pd.DataFrame({
+        'user_id': [1, 2, 3],
+        'first_name': ['Ada', 'Ben', 'Cy'],
+        'last_name': ['One', 'Two', 'Three'],
+        'gender': ['female', 'male', 'female'],
+        'postcode': ['E1 6AN', 'N1 9GU', 'SW1A 1AA'],
+        'date_of_birth': ['1990-01-01 00:00:00', '1985-12-31 00:00:00', '2000-06-15 00:00:00'],
+        'email': ['ada@example.com', 'ben@example.com', 'cy@example.com'],
+        'height_cm': [170, 182, 0],
+        'weight_kg': [60, 80, 70],
+        'account_creation': ['2020-01-01 00:00:00', '2021-05-05 10:30:00', '2022-02-02 12:00:00']
+    })
+    user_ride_df = pd.DataFrame({
+        'user_id': [1, 1, 2, 2, 3, 3],
+        'ride_id': ['r1', 'r2', 'r3', 'r4', 'r5', 'r6']
+    })
+
+    rng = np.random.default_rng(0)
+    ride_ids = np.repeat(['r1', 'r2', 'r3', 'r5'], 30)
+    seconds = np.tile(np.arange(30), 4)
+    metrics_df = pd.DataFrame({
+        'ride_id': ride_ids,
+        'time': (pd.Timestamp('2022-10-13 10:00:00') + pd.to_timedelta(seconds, unit='s')).strftime('%Y-%m-%d %H:%M:%S'),
+        'bike_model': 'mendoza v8',
+        'duration_seconds': seconds.astype('float64') + 0.5,
+        'resistance': rng.integers(10, 100, len(seconds)),
+        'heart_rate': rng.integers(60, 190, len(seconds)),
+        'rpm': rng.integers(0, 120, len(seconds)),
+        'power': rng.gamma(4, 25, len(seconds))
+    })
+
+    return {'user_df': user_df, 'user_ride_df': user_ride_df, 'metrics_df': metrics_df}
+
+def baseline_clean_dataframes(df_dict: dict) -> pd.DataFrame:
+    """
+    clean_dataframes as first written: row by row ages & BMIs, object key
+    merges & a MultiIndex groupby
+
+    Returns:
+    - ride dataframe
+    """
+    user_df = df_dict['user_df']
+    metrics_df = df_dict['metrics_df']
+
+    updated_user = pd.DataFrame()
+    updated_user['user_id'] = user_df['user_id']
+    updated_user['first_name'] = user_df['first_name']
+    updated_user['last_name'] = user_df['last_name']
+    updated_user['gender'] = user_df['gender']
+    updated_user['age'] = user_df['date_of_birth'].apply(tranformation.calculate_age)
+    updated_user['bmi'] = user_df.apply(lambda row: tranformation.calculate_bmi(row.weight_kg, row.height_cm), axis=1)
+    updated_user['postcode'] = user_df['postcode']
+    updated_user['account_creation'] = user_df['account_creation']
+    user_merge_df = df_dict['user_ride_df'].merge(updated_user, on='user_id', how='left', sort=False)
+
+    grouped_metrics = metrics_df.groupby('ride_id').agg({
+        'time':'first',
+        'bike_model':'first',
+        'resistance':'mean',
+        'heart_rate':['mean','min','max'],
+        'rpm':['mean','min','max'],
+        'power':['sum','mean','min','max'],
+        'duration_seconds':'max'
+    }).reset_index()
+
+    updated_metrics = pd.DataFrame()
+    updated_metrics['ride_id'] = grouped_metrics['ride_id']
+    updated_metrics['time'] = grouped_metrics['time']['first']
+    updated_metrics['bike_model'] = grouped_metrics['bike_model']['first']
+    updated_metrics['resistance_avg'] = grouped_metrics['resistance']['mean']
+    updated_metrics['heart_rate_avg'] = grouped_metrics['heart_rate']['mean']
+    updated_metrics['heart_rate_min'] = grouped_metrics['heart_rate']['min']
+    updated_metrics['heart_rate_max'] = grouped_metrics['heart_rate']['max']
+    updated_metrics['rpm_avg'] = grouped_metrics['rpm']['mean']
+    updated_metrics['rpm_min'] = grouped_metrics['rpm']['min']
+    updated_metrics['rpm_max'] = grouped_metrics['rpm']['max']
+    updated_metrics['power_total'] = grouped_metrics['power']['sum']
+    updated_metrics['power_avg'] = grouped_metrics['power']['mean']
+    updated_metrics['power_min'] = grouped_metrics['power']['min']
+    updated_metrics['power_max'] = grouped_metrics['power']['max']
+    updated_metrics['duration_seconds'] = grouped_metrics['duration_seconds']['max']
+
+    return user_merge_df.merge(updated_metrics, on='ride_id', how='left', sort=False)
+
+def assert_equivalent(expected: pd.DataFrame, actual: pd.DataFrame) -> None:
+    """
+    Asserts both ride dataframes agree (float32 metrics to 1e-6 relative)
+    """
+    expected = expected.sort_values('ride_id').reset_index(drop=True)
+    actual = actual.sort_values('ride_id').reset_index(drop=True)
+    assert list(expected.columns) == list(actual.columns)
+    for column in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[column]):
+            assert np.allclose(expected[column], actual[column], rtol=1e-6, equal_nan=True), column
+        else:
+            assert expected[column].fillna('').equals(actual[column].fillna('')), column
+
+def compact(df_dict: dict) -> dict:
+    """
+    Returns:
+    - copies of the staging dataframes in the compact schema
+    """
+    return {
+        'user_df': tranformation.set_staging_dtypes(df_dict['user_df'].copy(), 'user_table'),
+        'user_ride_df': df_dict['user_ride_df'].copy(),
+        'metrics_df': tranformation.set_staging_dtypes(df_dict['metrics_df'].copy(), 'metrics_table')
+    }
+
+def test_clean_dataframes_matches_the_baseline():
+    df_dict = staging_frames()
+    assert_equivalent(baseline_clean_dataframes(df_dict), tranformation.clean_dataframes(df_dict))
+
+def test_clean_dataframes_matches_the_baseline_on_compact_frames():
+    df_dict = staging_frames()
+    assert_equivalent(baseline_clean_dataframes(df_dict), tranformation.clean_dataframes(compact(df_dict)))
+
+def test_clean_dataframes_joins_ride_summaries():
+    df_dict = staging_frames()
+    metrics_df = df_dict['metrics_df']
+    summarised = metrics_df['ride_id'].isin(['r1', 'r3'])
+    summary_dict = dict(
+        compact(dict(df_dict, metrics_df=metrics_df[~summarised])),
+        ride_summary_df=tranformation.aggregate_rides(metrics_df[summarised]).reset_index()
+    )
+
+    ride_df = tranformation.clean_dataframes(summary_dict)
+    assert_equivalent(baseline_clean_dataframes(df_dict), ride_df)
+    assert ride_df.set_index('ride_id').loc[['r4', 'r6'], 'heart_rate_avg'].isna().all()
+
+def test_aggregate_rides_counts_rows():
+    ride_summary_df = tranformation.aggregate_rides(staging_frames()['metrics_df'])
+    assert list(ride_summary_df.reset_index().columns) == tranformation.RIDE_SUMMARY_COLUMNS
+    assert ride_summary_df['rows'].tolist() == [30, 30, 30, 30]
+
+def test_bmis_match_calculate_bmi():
+    weight_kg = pd.Series([60, 80, 70, None, 90], dtype='float32')
+    height_cm = pd.Series([170, 182, 0, 175, None], dtype='float32')
+
+    bmis = tranformation.calculate_bmis(weight_kg, height_cm)
+    assert bmis.tolist() == [tranformation.calculate_bmi(60, 170), tranformation.calculate_bmi(80, 182), 0.0, 0.0, 0.0]
+
+def test_ages_match_calculate_age():
+    dates = pd.Series(['1990-01-01 00:00:00', '1985-12-31 00:00:00', '2000-06-15 00:00:00'])
+    assert tranformation.calculate_ages(dates).tolist() == dates.apply(tranformation.calculate_age).tolist()
@@ -0,0 +1,260 @@
+"""Telemetry archive:
+Compacts finished rides' raw metrics from the staging schema into Parquet
+files, partitioned by ride date & bike model, so historical queries & full
+rebuilds read local (or S3) columnar files instead of Aurora.
+
+    {ARCHIVE_PATH}/date=2022-10-13/bike_model=mendoza%20v9/part-{batch}-0.parquet
+
+Archived rides are tracked in zuckerberg_production.archived_rides, so each
+run only archives rides finished since the last one: rides the ingestion
+has summarised (staging ride_summary) but not archived yet, found by their
+primary keys, so a run never scans the rest of staging.
+
+A batch is written before its rides are recorded, so a run that fails in
+between leaves files that the retry writes again; read_archived_metrics
+drops these duplicate rows.
+
+Usage:
+    python archive.py [--idle-minutes N]"""
+import argparse
+from datetime import datetime, timedelta
+import logging
+import os
+import uuid
+
+from dotenv import load_dotenv
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import sqlalchemy
+
+load_dotenv()
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = os.getenv('DB_PORT')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_NAME = os.getenv('DB_NAME')
+
+STAGING_SCHEMA = 'zuckerberg_staging'
+PRODUCTION_SCHEMA = 'zuckerberg_production'
+
+# Local directory or S3 URI (s3://bucket/prefix)
+ARCHIVE_PATH = os.getenv('ARCHIVE_PATH', 'archive')
+# A ride is finished once its bike has logged nothing for this long
+ARCHIVE_IDLE_MINUTES = int(os.getenv('ARCHIVE_IDLE_MINUTES', '60'))
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('date', pa.string()), ('bike_model', pa.string())]),
+    flavor='hive'
+)
+
+# Compact file schema: 1 byte per resistance, 2 bytes per heart rate & rpm
+ARCHIVE_SCHEMA = pa.schema([
+    ('ride_id', pa.string()),
+    ('time', pa.timestamp('s')),
+    ('duration_seconds', pa.float32()),
+    ('resistance', pa.int8()),
+    ('heart_rate', pa.int16()),
+    ('rpm', pa.int16()),
+    ('power', pa.float32()),
+    ('date', pa.string()),
+    ('bike_model', pa.string())
+])
+
+# Summarised rides not archived yet (both keyed by ride_id), then only their
+# metrics, through the staging (ride_id, duration_seconds) key
+FINISHED_METRICS_QUERY = f"""
+    WITH pending AS (
+        SELECT s.ride_id FROM {STAGING_SCHEMA}.ride_summary s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {PRODUCTION_SCHEMA}.archived_rides a WHERE a.ride_id = s.ride_id
+        )
+    ),
+    rides AS (
+        SELECT m.ride_id, MIN(m.time) AS start_time, MAX(m.time) AS end_time
+        FROM pending
+        JOIN {STAGING_SCHEMA}.metrics_table m USING (ride_id)
+        GROUP BY m.ride_id
+    )
+    SELECT m.ride_id, m.time, m.bike_model, m.duration_seconds, m.resistance,
+        m.heart_rate, m.rpm, m.power, LEFT(rides.start_time, 10) AS date
+    FROM rides
+    JOIN {STAGING_SCHEMA}.metrics_table m USING (ride_id)
+    WHERE rides.end_time < %(cutoff)s
+    ORDER BY m.ride_id, m.time
+"""
+
+# Unique key of a metrics row (the staging metrics_table key)
+METRICS_KEY = ['ride_id', 'duration_seconds']
+
+def get_logger(log_level: str) -> logging.Logger:
+    """
+    Returns:
+    - formatted logger
+    """
+    logging.basicConfig(
+        level=log_level,
+        format='%(asctime)s: %(levelname)s: %(message)s'
+    )
+    logger = logging.getLogger()
+    return logger
+
+def ensure_archive_table(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates the archived rides table if it doesn't exist yet
+    """
+    with engine.begin() as con:
+        con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {PRODUCTION_SCHEMA}.archived_rides (
+                ride_id TEXT PRIMARY KEY,
+                date DATE NOT NULL,
+                bike_model TEXT,
+                rows INTEGER NOT NULL,
+                batch TEXT NOT NULL,
+                archived_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+            )
+            """
+        )
+
+def get_archive_cutoff(engine: sqlalchemy.engine.Engine, idle_minutes: int) -> str:
+    """
+    Measured from the latest staged log rather than the clock, so the cutoff
+    doesn't depend on the log timezone
+
+    Returns:
+    - time before which a ride's last log means it has finished
+    - None if staging is empty
+    """
+    with engine.connect() as con:
+        latest = con.execute(f'SELECT MAX(time) FROM {STAGING_SCHEMA}.metrics_table').scalar()
+    if latest is None:
+        return None
+    cutoff = datetime.strptime(latest[:19], TIME_FORMAT) - timedelta(minutes=idle_minutes)
+    return cutoff.strftime(TIME_FORMAT)
+
+def extract_finished_metrics(engine: sqlalchemy.engine.Engine, cutoff: str) -> pd.DataFrame:
+    """
+    Reads the raw metrics of finished rides that aren't archived yet
+    (none before the ingestion has created staging ride_summary)
+
+    Returns:
+    - metrics dataframe, with the ride start date
+    """
+    with engine.connect() as con:
+        if con.execute(f"SELECT to_regclass('{STAGING_SCHEMA}.ride_summary')").scalar() is None:
+            return pd.DataFrame()
+    return pd.read_sql_query(FINISHED_METRICS_QUERY, con=engine, params={'cutoff': cutoff})
+
+def to_archive_table(metrics_df: pd.DataFrame) -> pa.Table:
+    """
+    Converts staged metrics to the compact archive schema
+
+    Returns:
+    - arrow table
+    """
+    archive_df = metrics_df.assign(time=pd.to_datetime(metrics_df['time'], format=TIME_FORMAT))
+    return pa.Table.from_pandas(archive_df[ARCHIVE_SCHEMA.names], schema=ARCHIVE_SCHEMA, preserve_index=False)
+
+def write_archive(table: pa.Table, path: str = ARCHIVE_PATH) -> str:
+    """
+    Writes an archive batch into the date & bike model partitions
+    Each batch adds its own files, so earlier batches are never rewritten
+
+    Returns:
+    - batch id
+    """
+    batch = uuid.uuid4().hex
+    ds.write_dataset(
+        table,
+        path,
+        format='parquet',
+        partitioning=PARTITIONING,
+        basename_template=f'part-{batch}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd')
+    )
+    return batch
+
+def record_archived_rides(engine: sqlalchemy.engine.Engine, metrics_df: pd.DataFrame, batch: str) -> None:
+    """
+    Records the rides of an archive batch, so they're skipped next time
+    """
+    rides = metrics_df.groupby('ride_id', sort=False).agg(
+        date=('date', 'first'),
+        bike_model=('bike_model', 'first'),
+        rows=('time', 'size')
+    ).reset_index()
+
+    with engine.begin() as con:
+        con.execute(
+            f"""
+            INSERT INTO {PRODUCTION_SCHEMA}.archived_rides (ride_id, date, bike_model, rows, batch)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (ride_id) DO NOTHING
+            """,
+            [(row.ride_id, row.date, row.bike_model, int(row.rows), batch) for row in rides.itertuples()]
+        )
+
+def archive_finished_rides(engine: sqlalchemy.engine.Engine, path: str = ARCHIVE_PATH,
+                           idle_minutes: int = ARCHIVE_IDLE_MINUTES) -> dict:
+    """
+    Archives every finished ride not archived yet
+
+    Returns:
+    - dictionary of rides & rows archived, and the batch id
+    """
+    ensure_archive_table(engine)
+    cutoff = get_archive_cutoff(engine, idle_minutes)
+    metrics_df = extract_finished_metrics(engine, cutoff) if cutoff else pd.DataFrame()
+    if metrics_df.empty:
+        logging.info('ARCHIVE: NO FINISHED RIDES') # - check
+        return {'rides': 0, 'rows': 0, 'batch': None}
+
+    batch = write_archive(to_archive_table(metrics_df), path)
+    record_archived_rides(engine, metrics_df, batch)
+
+    archived = {'rides': metrics_df['ride_id'].nunique(), 'rows': len(metrics_df), 'batch': batch}
+    logging.info('ARCHIVED: %s', archived) # - check
+    return archived
+
+def read_archive(columns: list = None, filters=None, path: str = ARCHIVE_PATH) -> pd.DataFrame:
+    """
+    Reads archived metrics, only touching the files & columns needed
+    - columns: e.g. ['ride_id', 'heart_rate'] (default: all)
+    - filters: e.g. [('date', '>=', '2022-10-01'), ('bike_model', '=', 'mendoza v9'), ('heart_rate', '>', 180)]
+      date & bike_model filters skip whole partitions, others use row group statistics
+    Rows of a retried batch appear twice (see read_archived_metrics)
+
+    Returns:
+    - metrics dataframe
+    """
+    table = pq.read_table(path, columns=columns, filters=filters, partitioning=PARTITIONING)
+    return table.to_pandas()
+
+def read_archived_metrics(filters=None, path: str = ARCHIVE_PATH) -> pd.DataFrame:
+    """
+    Reads archived metrics in the staging metrics_table layout,
+    e.g. to rebuild dash_table with clean_dataframes
+    Rows written twice (a batch retried after failing to record its rides)
+    are dropped
+
+    Returns:
+    - metrics dataframe
+    """
+    metrics_df = read_archive(filters=filters, path=path)
+    metrics_df = metrics_df.drop_duplicates(subset=METRICS_KEY, ignore_index=True)
+    metrics_df['time'] = metrics_df['time'].dt.strftime(TIME_FORMAT)
+    return metrics_df[['ride_id', 'time', 'bike_model', 'duration_seconds', 'resistance', 'heart_rate', 'rpm', 'power']]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--idle-minutes', type=int, default=ARCHIVE_IDLE_MINUTES)
+    args = parser.parse_args()
+
+    log = get_logger(logging.INFO)
+    engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+    archive_finished_rides(engine, ARCHIVE_PATH, args.idle_minutes)
@@ -0,0 +1,336 @@
+"""dash_table backfill:
+Rebuilds dash_table from the Parquet archive (see archive.py) after the
+clean_dataframes aggregation changes, one ride date per worker process.
+
+- archived rides: one chunk per ride date, read from the archive partitions
+- rides not archived yet: one chunk, read from the staging schema
+- each chunk's rides are aggregated with tranformation.aggregate_rides &
+  written to {work_dir}/{chunk}.parquet (dash_table rows) &
+  {work_dir}/{chunk}.summary.parquet (ride_summary rows), so a failed
+  backfill resumes from the chunks already done
+- the chunks are bulk loaded (COPY) into a new table, swapped in for
+  dash_table in a single transaction, & rider_summary is recounted from it
+- the staged ride_summary rows are rewritten in the same transaction, so
+  the transformation's next rebuild of dash_table keeps the new aggregates
+
+Usage:
+    python backfill.py [--work-dir DIR] [--workers N] [--restart]"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import io
+import logging
+import os
+import shutil
+
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import sqlalchemy
+
+from archive import ARCHIVE_PATH, PRODUCTION_SCHEMA, STAGING_SCHEMA, get_logger, read_archived_metrics
+import tranformation
+from rider_summary import rebuild_rider_summary
+from views import drop_views, ensure_views
+
+load_dotenv()
+DB_HOST = os.getenv('DB_HOST')
+DB_PORT = os.getenv('DB_PORT')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_NAME = os.getenv('DB_NAME')
+
+BACKFILL_WORK_DIR = os.getenv('BACKFILL_WORK_DIR', 'backfill')
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', str(os.cpu_count() or 1)))
+
+STAGING_CHUNK = 'unarchived'
+
+ARCHIVED_RIDES_TABLE = f'{PRODUCTION_SCHEMA}.archived_rides'
+
+ALL_METRICS_QUERY = f'SELECT * FROM {STAGING_SCHEMA}.metrics_table'
+UNARCHIVED_METRICS_QUERY = f"""
+    SELECT m.* FROM {STAGING_SCHEMA}.metrics_table m
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {PRODUCTION_SCHEMA}.archived_rides a WHERE a.ride_id = m.ride_id
+    )
+"""
+
+# Rider data every worker needs, set once per process by init_worker
+worker_data = {}
+
+def extract_rider_data(engine: sqlalchemy.engine.Engine) -> dict:
+    """
+    Reads the staged users & ride owners, shared by every chunk
+
+    Returns:
+    Dictionary with dataframes:
+    - user dataframe
+    - user_ride dataframe
+    """
+    user_df = tranformation.set_staging_dtypes(
+        pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_table', con=engine),
+        'user_table'
+    )
+    user_ride_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_ride', con=engine)
+    return {'user_df': user_df, 'user_ride_df': user_ride_df}
+
+def has_archive(con) -> bool:
+    """
+    Returns:
+    - True if archive.py has created archived_rides (i.e. ever run)
+    """
+    return con.execute(f"SELECT to_regclass('{ARCHIVED_RIDES_TABLE}')").scalar() is not None
+
+def list_archived_days(engine: sqlalchemy.engine.Engine) -> list:
+    """
+    Returns:
+    - ride dates in the archive, oldest first (YYYY-MM-DD), none if never archived
+    """
+    with engine.connect() as con:
+        if not has_archive(con):
+            return []
+        rows = con.execute(f'SELECT DISTINCT date FROM {ARCHIVED_RIDES_TABLE} ORDER BY date').fetchall()
+    return [row.date.isoformat() for row in rows]
+
+def transform_chunk(metrics_df: pd.DataFrame, user_ride_df: pd.DataFrame, user_df: pd.DataFrame) -> tuple:
+    """
+    Aggregates the rides of one chunk (see tranformation.aggregate_rides) &
+    runs clean_dataframes on the aggregates
+
+    Returns:
+    - (dash_table rows, ride_summary rows) of the chunk
+    """
+    ride_summary_df = tranformation.aggregate_rides(metrics_df).reset_index()
+    df_dict = {
+        'user_df': user_df,
+        'user_ride_df': user_ride_df,
+        'metrics_df': metrics_df.iloc[:0],
+        'ride_summary_df': ride_summary_df
+    }
+    return tranformation.clean_dataframes(df_dict), ride_summary_df
+
+def summary_checkpoint(checkpoint: str) -> str:
+    """
+    Returns:
+    - path of the ride_summary rows written with a chunk's checkpoint
+    """
+    return f'{os.path.splitext(checkpoint)[0]}.summary.parquet'
+
+def write_checkpoint(ride_df: pd.DataFrame, path: str) -> None:
+    """
+    Writes a finished chunk, renamed into place so a crash never leaves
+    a partial checkpoint behind
+    """
+    partial_path = f'{path}.partial'
+    ride_df.to_parquet(partial_path, index=False)
+    os.replace(partial_path, path)
+
+def init_worker(rider_data: dict, archive_path: str) -> None:
+    """
+    Keeps the rider data & archive location for every chunk of this process
+    """
+    worker_data.update(rider_data, archive_path=archive_path)
+
+def backfill_day(day: str, checkpoint: str) -> tuple:
+    """
+    Worker: transforms the archived rides of one ride date
+
+    Returns:
+    - (day, rides written)
+    """
+    metrics_df = read_archived_metrics(filters=[('date', '=', day)], path=worker_data['archive_path'])
+    user_ride_df = worker_data['user_ride_df']
+    day_rides = user_ride_df[user_ride_df['ride_id'].isin(metrics_df['ride_id'].unique())]
+
+    ride_df, ride_summary_df = transform_chunk(metrics_df, day_rides, worker_data['user_df'])
+    # the dash_table checkpoint is written last, as it marks the chunk done
+    write_checkpoint(ride_summary_df, summary_checkpoint(checkpoint))
+    write_checkpoint(ride_df, checkpoint)
+    return day, len(ride_df)
+
+def backfill_unarchived(engine: sqlalchemy.engine.Engine, rider_data: dict, checkpoint: str) -> int:
+    """
+    Transforms every ride not archived yet (including rides without metrics)
+    from the staging schema. Always rerun, as these rides are still changing
+
+    Returns:
+    - rides written
+    """
+    with engine.connect() as con:
+        archived = set()
+        if has_archive(con):
+            archived = {row.ride_id for row in con.execute(f'SELECT ride_id FROM {ARCHIVED_RIDES_TABLE}')}
+    query = UNARCHIVED_METRICS_QUERY if archived else ALL_METRICS_QUERY
+    metrics_df = tranformation.set_staging_dtypes(pd.read_sql_query(query, con=engine), 'metrics_table')
+    user_ride_df = rider_data['user_ride_df']
+    unarchived_rides = user_ride_df[~user_ride_df['ride_id'].isin(archived)]
+
+    ride_df, ride_summary_df = transform_chunk(metrics_df, unarchived_rides, rider_data['user_df'])
+    write_checkpoint(ride_summary_df, summary_checkpoint(checkpoint))
+    write_checkpoint(ride_df, checkpoint)
+    return len(ride_df)
+
+def unify_dtypes(chunk_dtypes: list) -> dict:
+    """
+    Widens each column to a dtype every chunk fits in, e.g. int64 in a chunk
+    where every ride has metrics, float64 in one with a ride without
+
+    Returns:
+    - dictionary of column -> dtype
+    """
+    dtypes = {}
+    for chunk in chunk_dtypes:
+        for column, dtype in chunk.items():
+            if column not in dtypes or dtypes[column] == dtype:
+                dtypes[column] = dtype
+                continue
+            try:
+                dtypes[column] = np.result_type(dtypes[column], dtype)
+            except TypeError:
+                dtypes[column] = np.dtype(object)
+    return dtypes
+
+def copy_checkpoint(cursor, ride_df: pd.DataFrame, table: str, columns: list) -> None:
+    """
+    Bulk loads a checkpoint's rows into table with COPY
+    """
+    buffer = io.StringIO()
+    ride_df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+def rewrite_ride_summaries(con, checkpoints: list) -> int:
+    """
+    Overwrites the staged ride_summary rows with the chunks' aggregates, so
+    the transformation's next rebuild of dash_table joins the same values
+    Only rides already summarised are touched (rides still in progress are
+    summarised by the ingestion when they finish), and only from aggregates
+    over at least as many rows, in case a ride finished after its chunk was read
+
+    Returns:
+    - ride_summary rows rewritten
+    """
+    if con.execute(f"SELECT to_regclass('{STAGING_SCHEMA}.ride_summary')").scalar() is None:
+        return 0
+    columns = tranformation.RIDE_SUMMARY_COLUMNS
+    con.execute(
+        f'CREATE TEMPORARY TABLE ride_summary_backfill (LIKE {STAGING_SCHEMA}.ride_summary) ON COMMIT DROP'
+    )
+    cursor = con.connection.cursor()
+    for checkpoint in checkpoints:
+        copy_checkpoint(cursor, pd.read_parquet(checkpoint)[columns], 'ride_summary_backfill', columns)
+
+    assignments = ', '.join(f'{column} = b.{column}' for column in columns if column != 'ride_id')
+    return con.execute(
+        f"""
+        UPDATE {STAGING_SCHEMA}.ride_summary s SET {assignments}
+        FROM ride_summary_backfill b
+        WHERE s.ride_id = b.ride_id AND b.rows >= s.rows
+        """
+    ).rowcount
+
+def load_checkpoints(engine: sqlalchemy.engine.Engine, checkpoints: list) -> int:
+    """
+    Bulk loads the chunks into a new table with COPY & swaps it in for
+    dash_table, all in one transaction (dash_table is untouched on failure)
+    The transaction holds the transformation's lock on dash_table (see
+    tranformation.sql_conversion), so no rebuild from staging runs meanwhile,
+    and the staged ride_summary rows are rewritten with the chunks'
+    aggregates, so the next rebuild keeps them
+    The materialized views on dash_table & rider_summary are rebuilt from the
+    new table, and cached report snapshots are cleared, as they were built
+    from the old table
+
+    Returns:
+    - rides loaded
+    """
+    chunk_dtypes = [
+        pq.read_schema(checkpoint).empty_table().to_pandas().dtypes.to_dict()
+        for checkpoint in checkpoints
+    ]
+    dtypes = unify_dtypes(chunk_dtypes)
+    columns = list(dtypes)
+    loaded = 0
+
+    with engine.begin() as con:
+        con.execute('SELECT pg_advisory_xact_lock(hashtext(%(target)s))', {'target': tranformation.TARGET_TABLE})
+        con.execute(f'DROP TABLE IF EXISTS {PRODUCTION_SCHEMA}.dash_table_backfill')
+        pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()}).to_sql(
+            'dash_table_backfill',
+            con=con,
+            schema=PRODUCTION_SCHEMA,
+            index=False
+        )
+
+        cursor = con.connection.cursor()
+        for checkpoint in checkpoints:
+            ride_df = pd.read_parquet(checkpoint).reindex(columns=columns).astype(dtypes)
+            copy_checkpoint(cursor, ride_df, f'{PRODUCTION_SCHEMA}.dash_table_backfill', columns)
+            loaded += len(ride_df)
+
+        drop_views(con)
+        con.execute(f'DROP TABLE IF EXISTS {PRODUCTION_SCHEMA}.dash_table')
+        con.execute(f'ALTER TABLE {PRODUCTION_SCHEMA}.dash_table_backfill RENAME TO dash_table')
+        ensure_views(con)
+        rebuild_rider_summary(con)
+        summaries = rewrite_ride_summaries(con, [summary_checkpoint(checkpoint) for checkpoint in checkpoints])
+        logging.info('REWROTE %s RIDE SUMMARIES', summaries) # - check
+        if con.execute(f"SELECT to_regclass('{PRODUCTION_SCHEMA}.report_snapshot')").scalar() is not None:
+            con.execute(f'DELETE FROM {PRODUCTION_SCHEMA}.report_snapshot')
+
+    return loaded
+
+def backfill(engine: sqlalchemy.engine.Engine, work_dir: str = BACKFILL_WORK_DIR,
+             workers: int = BACKFILL_WORKERS, archive_path: str = ARCHIVE_PATH) -> dict:
+    """
+    Rebuilds dash_table chunk by chunk, skipping days already checkpointed
+    in work_dir, then removes the checkpoints once loaded
+
+    Returns:
+    - dictionary of days transformed, days resumed & rides loaded
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    rider_data = extract_rider_data(engine)
+    days = list_archived_days(engine)
+
+    checkpoints = {day: os.path.join(work_dir, f'{day}.parquet') for day in days}
+    pending_days = [
+        day for day, checkpoint in checkpoints.items()
+        if not (os.path.exists(checkpoint) and os.path.exists(summary_checkpoint(checkpoint)))
+    ]
+    logging.info('BACKFILL DAYS: %s, RESUMED: %s', len(pending_days), len(days) - len(pending_days)) # - check
+
+    if pending_days:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(rider_data, archive_path)
+        ) as executor:
+            futures = [executor.submit(backfill_day, day, checkpoints[day]) for day in pending_days]
+            for future in as_completed(futures):
+                day, rides = future.result()
+                logging.info('BACKFILLED %s: %s RIDES', day, rides) # - check
+
+    checkpoints[STAGING_CHUNK] = os.path.join(work_dir, f'{STAGING_CHUNK}.parquet')
+    backfill_unarchived(engine, rider_data, checkpoints[STAGING_CHUNK])
+
+    loaded = load_checkpoints(engine, list(checkpoints.values()))
+    shutil.rmtree(work_dir)
+
+    backfilled = {'days': len(pending_days), 'resumed': len(days) - len(pending_days), 'rides': loaded}
+    logging.info('BACKFILL COMPLETE: %s', backfilled) # - check
+    return backfilled
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--work-dir', default=BACKFILL_WORK_DIR)
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--restart', action='store_true', help='discard checkpoints from a failed backfill')
+    args = parser.parse_args()
+
+    log = get_logger(logging.INFO)
+    if args.restart and os.path.isdir(args.work_dir):
+        shutil.rmtree(args.work_dir)
+
+    engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+    backfill(engine, args.work_dir, args.workers, ARCHIVE_PATH)
@@ -0,0 +1,166 @@
+"""Rider summary:
+Each rider's latest profile & lifetime totals, kept in the production
+rider_summary table & updated by every transformation with the rides that
+finished since the last one, so the API reads one row per rider however
+long their history is.
+
+- the table is seeded from every ride in dash_table with a time (rides
+  without metrics have none) when it is created & when backfill.py rebuilds
+  it, so riders staged before ride summaries keep their whole history
+- after that, runs only add finished rides: rides the ingestion staged a
+  ride_summary for, or named by the SNS trigger (see parse_trigger)
+- rider_summary_ride records the rides already counted, so a ride is added
+  once however many runs see it; staged ride summaries are anti-joined
+  with it first, so a run only reads dash_table rows for rides not counted
+  yet rather than probing every summarised ride
+- totals are additive (rides, duration, power, heart rate sum & count), so
+  an update only reads the new rides; best power, first & last ride are
+  kept with GREATEST / LEAST
+- the profile is taken from the rider's latest ride
+- backfill.py rebuilds the table from scratch, once dash_table is swapped"""
+
+PRODUCTION_SCHEMA = 'zuckerberg_production'
+STAGING_SCHEMA = 'zuckerberg_staging'
+
+PROFILE_COLUMNS = ['first_name', 'last_name', 'gender', 'age', 'bmi', 'postcode', 'account_creation']
+
+# Rides added by each run: finished since the last one, i.e. summarised
+# (both tables keyed by ride_id) & not counted yet
+FINISHED_RIDES = f"""(d.ride_id = ANY(%(ride_ids)s) OR d.ride_id IN (
+        SELECT s.ride_id FROM {STAGING_SCHEMA}.ride_summary s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {PRODUCTION_SCHEMA}.rider_summary_ride c WHERE c.ride_id = s.ride_id
+        )
+    ))"""
+
+RIDER_SUMMARY_UPDATE = f"""
+    WITH new_rides AS (
+        INSERT INTO {PRODUCTION_SCHEMA}.rider_summary_ride (ride_id)
+        SELECT d.ride_id FROM {PRODUCTION_SCHEMA}.dash_table d
+        WHERE d.time IS NOT NULL AND {{rides}}
+        ON CONFLICT (ride_id) DO NOTHING
+        RETURNING ride_id
+    ),
+    rides AS (
+        SELECT d.* FROM {PRODUCTION_SCHEMA}.dash_table d JOIN new_rides USING (ride_id)
+    ),
+    latest AS (
+        SELECT DISTINCT ON (user_id) user_id, {', '.join(PROFILE_COLUMNS)}
+        FROM rides
+        ORDER BY user_id, time DESC
+    ),
+    totals AS (
+        SELECT
+            user_id,
+            COUNT(ride_id) AS rides,
+            COALESCE(SUM(duration_seconds), 0) AS duration_total,
+            COALESCE(SUM(power_total), 0) AS power_total,
+            MAX(power_max) AS power_best,
+            COALESCE(SUM(heart_rate_avg), 0) AS heart_rate_avg_sum,
+            COUNT(heart_rate_avg) AS heart_rate_avg_count,
+            MIN(time) AS first_ride,
+            MAX(time) AS last_ride
+        FROM rides
+        GROUP BY user_id
+    )
+    INSERT INTO {PRODUCTION_SCHEMA}.rider_summary AS r (
+        user_id, {', '.join(PROFILE_COLUMNS)}, rides, duration_total, power_total, power_best,
+        heart_rate_avg, heart_rate_avg_sum, heart_rate_avg_count, first_ride, last_ride
+    )
+    SELECT
+        user_id, {', '.join(PROFILE_COLUMNS)}, rides, duration_total, power_total, power_best,
+        heart_rate_avg_sum / NULLIF(heart_rate_avg_count, 0), heart_rate_avg_sum, heart_rate_avg_count,
+        first_ride, last_ride
+    FROM latest JOIN totals USING (user_id)
+    ON CONFLICT (user_id) DO UPDATE SET
+        {', '.join(
+            f'{column} = CASE WHEN EXCLUDED.last_ride >= r.last_ride THEN EXCLUDED.{column} ELSE r.{column} END'
+            for column in PROFILE_COLUMNS
+        )},
+        rides = r.rides + EXCLUDED.rides,
+        duration_total = r.duration_total + EXCLUDED.duration_total,
+        power_total = r.power_total + EXCLUDED.power_total,
+        power_best = GREATEST(r.power_best, EXCLUDED.power_best),
+        heart_rate_avg = (r.heart_rate_avg_sum + EXCLUDED.heart_rate_avg_sum)
+            / NULLIF(r.heart_rate_avg_count + EXCLUDED.heart_rate_avg_count, 0),
+        heart_rate_avg_sum = r.heart_rate_avg_sum + EXCLUDED.heart_rate_avg_sum,
+        heart_rate_avg_count = r.heart_rate_avg_count + EXCLUDED.heart_rate_avg_count,
+        first_ride = LEAST(r.first_ride, EXCLUDED.first_ride),
+        last_ride = GREATEST(r.last_ride, EXCLUDED.last_ride)
+"""
+
+def ensure_rider_summary(con) -> bool:
+    """
+    Creates the rider_summary table & its ledger of counted rides
+
+    Returns:
+    - True if they were created (& need seeding)
+    """
+    if con.execute(f"SELECT to_regclass('{PRODUCTION_SCHEMA}.rider_summary')").scalar() is not None:
+        return False
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {PRODUCTION_SCHEMA}.rider_summary (
+            user_id BIGINT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            gender TEXT,
+            age BIGINT,
+            bmi DOUBLE PRECISION,
+            postcode TEXT,
+            account_creation TEXT,
+            rides BIGINT NOT NULL,
+            duration_total DOUBLE PRECISION NOT NULL,
+            power_total DOUBLE PRECISION NOT NULL,
+            power_best DOUBLE PRECISION,
+            heart_rate_avg DOUBLE PRECISION,
+            heart_rate_avg_sum DOUBLE PRECISION NOT NULL,
+            heart_rate_avg_count BIGINT NOT NULL,
+            first_ride TEXT NOT NULL,
+            last_ride TEXT NOT NULL
+        )
+        """
+    )
+    con.execute(
+        f'CREATE TABLE IF NOT EXISTS {PRODUCTION_SCHEMA}.rider_summary_ride (ride_id TEXT PRIMARY KEY)'
+    )
+    return True
+
+def seed_rider_summary(con) -> int:
+    """
+    Counts every ride in dash_table with a time not counted yet, finished or
+    not, into an empty (or truncated) rider_summary
+
+    Returns:
+    - riders summarised
+    """
+    return con.execute(RIDER_SUMMARY_UPDATE.format(rides='TRUE'), {'ride_ids': []}).rowcount
+
+def update_rider_summary(con, ride_ids: list = None) -> int:
+    """
+    Adds the finished rides in dash_table not counted yet to their riders'
+    summaries, in the caller's transaction (seeding the table from every
+    ride if it was just created)
+    - ride_ids: rides the trigger reported finished, on top of those with a
+      staging ride_summary
+
+    Returns:
+    - riders updated
+    """
+    if ensure_rider_summary(con):
+        return seed_rider_summary(con)
+    return con.execute(
+        RIDER_SUMMARY_UPDATE.format(rides=FINISHED_RIDES), {'ride_ids': list(ride_ids or [])}
+    ).rowcount
+
+def rebuild_rider_summary(con) -> int:
+    """
+    Empties rider_summary & seeds it again from every ride in dash_table
+    with a time, e.g. once a backfill has changed their aggregates
+
+    Returns:
+    - riders summarised
+    """
+    if not ensure_rider_summary(con):
+        con.execute(f'TRUNCATE {PRODUCTION_SCHEMA}.rider_summary, {PRODUCTION_SCHEMA}.rider_summary_ride')
+    return seed_rider_summary(con)
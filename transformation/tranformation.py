@@ -1,12 +1,18 @@
 from datetime import date, datetime
+import json
 import logging
 import os
+import time
 from time import strptime
 
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 import sqlalchemy
 
+from rider_summary import update_rider_summary
+from views import ensure_views, refresh_views
+
 # Credentials
 load_dotenv()
 DB_HOST = os.getenv('DB_HOST')
@@ -18,6 +24,68 @@ DB_NAME = os.getenv('DB_NAME')
 STAGING_SCHEMA = 'zuckerberg_staging'
 PRODUCTION_SCHEMA = 'zuckerberg_production'
 
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Compact in-memory schema of the staging tables (defaults: object strings & 64 bit numbers)
+STAGING_DTYPES = {
+    'user_table': {
+        'gender': 'category',
+        'height_cm': 'float32',
+        'weight_kg': 'float32'
+    },
+    'metrics_table': {
+        'ride_id': 'category',
+        'bike_model': 'category',
+        'duration_seconds': 'float32',
+        'resistance': 'int16',
+        'heart_rate': 'int16',
+        'rpm': 'int16',
+        'power': 'float32'
+    }
+}
+STAGING_TIMES = {
+    'user_table': ['date_of_birth', 'account_creation'],
+    'metrics_table': ['time']
+}
+
+# Rides summarised by the ingestion (staging ride_summary) need no raw metrics;
+# only rides without a summary (in progress, or staged before summaries) are aggregated
+UNSUMMARISED_METRICS_QUERY = f"""
+    SELECT m.* FROM {STAGING_SCHEMA}.metrics_table m
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {STAGING_SCHEMA}.ride_summary s WHERE s.ride_id = m.ride_id
+    )
+"""
+
+# Staging ride_summary layout (see aggregate_rides), dash_table takes all but ride_id & rows
+RIDE_SUMMARY_COLUMNS = [
+    'ride_id', 'time', 'bike_model', 'rows', 'resistance_avg',
+    'heart_rate_avg', 'heart_rate_min', 'heart_rate_max',
+    'rpm_avg', 'rpm_min', 'rpm_max',
+    'power_total', 'power_avg', 'power_min', 'power_max', 'duration_seconds'
+]
+RIDE_METRIC_COLUMNS = [column for column in RIDE_SUMMARY_COLUMNS if column not in ('ride_id', 'rows')]
+
+# Table rebuilt by each run: one run at a time holds its lock (see sql_conversion)
+TARGET_TABLE = 'dash_table'
+
+# One row per ride date of the target table, with a hash of its rows, so the report
+# snapshots of days a run rewrote can be found (see invalidate_report_snapshots)
+DASH_DAYS_QUERY = f"""
+    SELECT LEFT(d.time, 10) AS day, COUNT(*) AS rides, SUM(hashtext(d::text)::bigint) AS rows_hash
+    FROM {PRODUCTION_SCHEMA}.{TARGET_TABLE} d
+    WHERE d.time IS NOT NULL
+    GROUP BY 1
+"""
+
+# Parquet archive of finished rides' raw metrics (see archive.py), off if unset
+ARCHIVE_PATH = os.getenv('ARCHIVE_PATH')
+
+# Kept at module scope, so warm invocations reuse the connection
+log = logging.getLogger()
+engine = None
+invocations = 0
+
 def get_logger(log_level: str) -> logging.Logger:
     """
     Returns:
@@ -30,26 +98,61 @@ def get_logger(log_level: str) -> logging.Logger:
     logger = logging.getLogger()                    
     return logger
 
-def extract_staging_data() -> dict:
+def set_staging_dtypes(df: pd.DataFrame, table: str) -> pd.DataFrame:
     """
-    Writes SQL table into dataframe
+    Converts a staging dataframe to the compact schema (STAGING_DTYPES & STAGING_TIMES)
+    One column at a time, so only one column is ever held twice
+
+    Returns:
+    - the same dataframe, converted
+    """
+    for column, dtype in STAGING_DTYPES.get(table, {}).items():
+        df[column] = df[column].astype(dtype)
+    for column in STAGING_TIMES.get(table, []):
+        df[column] = pd.to_datetime(df[column], format=TIME_FORMAT)
+    return df
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """
+    Creates the engine on the first invocation of a container
+
+    Returns:
+    - module engine
+    """
+    global engine
+    if engine is None:
+        engine = sqlalchemy.create_engine(
+            f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
+            pool_size=1,
+            max_overflow=0,
+            pool_pre_ping=True
+        )
+    return engine
+
+def extract_staging_data(con=None) -> dict:
+    """
+    Writes SQL table into dataframe, through con if given (default: engine)
 
     Returns:
     Dictionary with dataframes:
     - user dataframe
     - user_ride dataframe
-    - metrics dataframe
+    - metrics dataframe, of rides without a summary
+    - ride_summary dataframe
     """
     logging.info('EXTRACTING DATA...') # - check
+    con = engine if con is None else con
     
-    user_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_table',con=engine)
-    user_ride_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_ride',con=engine)
-    metrics_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.metrics_table',con=engine)
+    user_df = set_staging_dtypes(pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_table',con=con), 'user_table')
+    user_ride_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.user_ride',con=con)
+    metrics_df = set_staging_dtypes(pd.read_sql_query(UNSUMMARISED_METRICS_QUERY,con=con), 'metrics_table')
+    ride_summary_df = pd.read_sql_query(f'SELECT * FROM {STAGING_SCHEMA}.ride_summary',con=con)
 
     dfs_dict = {
         "user_df": user_df,
         "user_ride_df": user_ride_df,
-        "metrics_df": metrics_df
+        "metrics_df": metrics_df,
+        "ride_summary_df": ride_summary_df
     }
 
     return dfs_dict
@@ -95,9 +198,99 @@ def calculate_bmi(weight_kg: int, height_cm: int) -> float:
     
     return bmi
 
+def calculate_ages(date_of_birth: pd.Series) -> pd.Series:
+    """
+    Vectorised calculate_age, for datetimes or '%Y-%m-%d %H:%M:%S' strings
+
+    Returns:
+    - ages (years)
+    """
+    today = date.today()
+    dob = pd.to_datetime(date_of_birth, format=TIME_FORMAT)
+    is_before_birthday = (dob.dt.month > today.month) | ((dob.dt.month == today.month) & (dob.dt.day > today.day))
+    return today.year - dob.dt.year - is_before_birthday
+
+def calculate_bmis(weight_kg: pd.Series, height_cm: pd.Series) -> pd.Series:
+    """
+    Vectorised calculate_bmi: 0.0 without a weight or height (0 or NULL)
+
+    Returns:
+    - BMIs (1 decimal place)
+    """
+    weight = weight_kg.astype('float64').fillna(0)
+    height = height_cm.astype('float64').fillna(0) / 100
+    bmi = (weight / height**2).round(1)
+    return bmi.where((weight != 0) & (height != 0), 0.0)
+
+def format_times(times: pd.Series) -> pd.Series:
+    """
+    Returns:
+    - times as '%Y-%m-%d %H:%M:%S' strings, the dash_table format
+    """
+    if pd.api.types.is_datetime64_any_dtype(times):
+        return times.dt.strftime(TIME_FORMAT)
+    return times
+
+def restore_output_dtypes(ride_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Widens compact columns back to 64 bit numbers & strings,
+    so dash_table keeps its column types
+
+    Returns:
+    - the same dataframe, converted
+    """
+    for column in ride_df.columns:
+        dtype = ride_df[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            ride_df[column] = ride_df[column].astype(object)
+        elif pd.api.types.is_float_dtype(dtype) and dtype != np.float64:
+            ride_df[column] = ride_df[column].astype('float64')
+        elif pd.api.types.is_integer_dtype(dtype) and dtype != np.int64:
+            ride_df[column] = ride_df[column].astype('int64')
+    return ride_df
+
+def aggregate_rides(metrics_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The per-ride aggregation of raw metrics, in the staging ride_summary
+    layout: the one definition of dash_table's ride metrics
+    ingestion.update_ride_summary computes the same values as a ride streams
+    in; after changing this, change that to match & run backfill.py, which
+    rewrites every staged ride_summary row with this function
+
+    Returns:
+    - dataframe of RIDE_SUMMARY_COLUMNS, indexed by ride_id
+    """
+    # grouped by integer ride codes
+    ride_ids = metrics_df['ride_id']
+    if not isinstance(ride_ids.dtype, pd.CategoricalDtype):
+        ride_ids = ride_ids.astype('category')
+
+    ride_summary_df = metrics_df.groupby(ride_ids, observed=True, sort=False).agg(
+        time=('time', 'first'),
+        bike_model=('bike_model', 'first'),
+        rows=('time', 'size'),
+        resistance_avg=('resistance', 'mean'),
+        heart_rate_avg=('heart_rate', 'mean'),
+        heart_rate_min=('heart_rate', 'min'),
+        heart_rate_max=('heart_rate', 'max'),
+        rpm_avg=('rpm', 'mean'),
+        rpm_min=('rpm', 'min'),
+        rpm_max=('rpm', 'max'),
+        power_total=('power', 'sum'),
+        power_avg=('power', 'mean'),
+        power_min=('power', 'min'),
+        power_max=('power', 'max'),
+        duration_seconds=('duration_seconds', 'max')
+    )
+    ride_summary_df.index = ride_summary_df.index.astype(object)
+    ride_summary_df['time'] = format_times(ride_summary_df['time'])
+    return ride_summary_df
+
 def clean_dataframes(df_dict: dict) -> pd:
     """
     Combines & Transforms staging dataframes
+    Rides in ride_summary_df (optional) are joined as summarised by the
+    ingestion, the rest are aggregated from metrics_df (see aggregate_rides)
 
     Returns:
     - Single transformed dataframe
@@ -106,76 +299,178 @@ def clean_dataframes(df_dict: dict) -> pd:
     user_df = df_dict.get("user_df")
     user_ride = df_dict.get("user_ride_df")
     metrics_df = df_dict.get("metrics_df")
+    ride_summary_df = df_dict.get("ride_summary_df")
 
     # extract relevant information from user_df
-    updated_user = pd.DataFrame()
-    updated_user['user_id'] = user_df['user_id']
-    updated_user['first_name'] = user_df['first_name']
-    updated_user['last_name'] = user_df['last_name']
-    updated_user['gender'] = user_df['gender']
-    updated_user['age'] = user_df['date_of_birth'].apply(calculate_age)
-    updated_user['bmi'] = user_df.apply(lambda row: calculate_bmi(row.weight_kg, row.height_cm), axis=1)
-    updated_user['postcode'] = user_df['postcode']
-    updated_user['account_creation'] = user_df['account_creation']
-
-    # merge updated_user + user_ride
-    user_merge_df = user_ride.merge(updated_user, on='user_id', how='left', sort=False)
-    
+    updated_user = pd.DataFrame({
+        'user_id': user_df['user_id'],
+        'first_name': user_df['first_name'],
+        'last_name': user_df['last_name'],
+        'gender': user_df['gender'],
+        'age': calculate_ages(user_df['date_of_birth']),
+        'bmi': calculate_bmis(user_df['weight_kg'], user_df['height_cm']),
+        'postcode': user_df['postcode'],
+        'account_creation': format_times(user_df['account_creation'])
+    })
+
+    updated_user = updated_user.set_index('user_id')
+
+    # merge updated_user + user_ride, on the user_id index
+    user_merge_df = user_ride.join(updated_user, on='user_id')
+    del updated_user
+
     # extract relevant information from metrics_df
-    grouped_metrics = metrics_df.groupby('ride_id').agg({
-        'time':'first',
-        'bike_model':'first',
-        'resistance':'mean',
-        'heart_rate':['mean','min','max'],
-        'rpm':['mean','min','max'],
-        'power':['sum','mean','min','max'],
-        'duration_seconds':'max'
-    }).reset_index()
-
-    updated_metrics = pd.DataFrame()
-    updated_metrics['ride_id'] = grouped_metrics['ride_id']
-    updated_metrics['time'] = grouped_metrics['time']['first']
-    updated_metrics['bike_model'] = grouped_metrics['bike_model']['first']
-    updated_metrics['resistance_avg'] = grouped_metrics['resistance']['mean']
-    updated_metrics['heart_rate_avg'] = grouped_metrics['heart_rate']['mean']
-    updated_metrics['heart_rate_min'] = grouped_metrics['heart_rate']['min']
-    updated_metrics['heart_rate_max'] = grouped_metrics['heart_rate']['max']
-    updated_metrics['rpm_avg'] = grouped_metrics['rpm']['mean']
-    updated_metrics['rpm_min'] = grouped_metrics['rpm']['min']
-    updated_metrics['rpm_max'] = grouped_metrics['rpm']['max']
-    updated_metrics['power_total'] = grouped_metrics['power']['sum']
-    updated_metrics['power_avg'] = grouped_metrics['power']['mean']
-    updated_metrics['power_min'] = grouped_metrics['power']['min']
-    updated_metrics['power_max'] = grouped_metrics['power']['max']
-    updated_metrics['duration_seconds'] = grouped_metrics['duration_seconds']['max']
-    
-    # merge user_df + updated_metrics
-    ride_df = user_merge_df.merge(updated_metrics, on='ride_id', how='left', sort=False)
+    updated_metrics = aggregate_rides(metrics_df)[RIDE_METRIC_COLUMNS]
+
+    # add the rides summarised during ingestion, already aggregated
+    if ride_summary_df is not None and not ride_summary_df.empty:
+        summaries = ride_summary_df.set_index('ride_id')[RIDE_METRIC_COLUMNS]
+        updated_metrics = pd.concat([summaries, updated_metrics]) if len(updated_metrics) else summaries
+
+    # merge user_df + updated_metrics, on the ride_id index
+    ride_df = restore_output_dtypes(user_merge_df.join(updated_metrics, on='ride_id'))
     log.info('CREATED RIDE DATAFRAME') # - check
 
     return ride_df
 
-def sql_conversion() -> None:
+def parse_trigger(event: dict) -> list:
+    """
+    Reads the finished rides from the SNS trigger(s) of an invocation
+    (see ingestion/trigger.py); older plain text triggers carry none
+
+    Returns:
+    - list of ride ids
+    """
+    ride_ids = []
+    for record in event.get('Records', []):
+        try:
+            message = json.loads(record['Sns']['Message'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if isinstance(message, dict):
+            ride_ids.extend(message.get('ride_ids', []))
+    return ride_ids
+
+def ensure_transformation_runs(con) -> None:
+    """
+    Creates the table of the last run started per target table
+    """
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {PRODUCTION_SCHEMA}.transformation_run (
+            target TEXT PRIMARY KEY,
+            started_at TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+
+def record_dash_days(con) -> bool:
+    """
+    Keeps the target table's DASH_DAYS_QUERY rows for the rest of the
+    transaction, if there are report snapshots (see visualisation/report_snapshots.py)
+
+    Returns:
+    - True if recorded, False if there's nothing to invalidate
+    """
+    if con.execute(f"SELECT to_regclass('{PRODUCTION_SCHEMA}.report_snapshot')").scalar() is None:
+        return False
+    con.execute(f'CREATE TEMPORARY TABLE dash_days ON COMMIT DROP AS {DASH_DAYS_QUERY}')
+    return True
+
+def invalidate_report_snapshots(con) -> int:
+    """
+    Deletes the report snapshots of days whose rows were added, removed or
+    changed since record_dash_days, so the next report aggregates them again
+
+    Returns:
+    - snapshots deleted
+    """
+    return con.execute(
+        f"""
+        DELETE FROM {PRODUCTION_SCHEMA}.report_snapshot
+        WHERE day::text IN (
+            SELECT day FROM (
+                (SELECT * FROM dash_days EXCEPT {DASH_DAYS_QUERY})
+                UNION ALL
+                ({DASH_DAYS_QUERY} EXCEPT SELECT * FROM dash_days)
+            ) changed
+        )
+        """
+    ).rowcount
+
+def sql_conversion(ride_ids: list = None) -> bool:
     """
     Write dataframe into SQL table
+    Runs hold a lock on the target table for their whole transaction, so at
+    most one is in flight. A run that waited for the lock is skipped if a run
+    started after it arrived: that run already read every row staged before
+    this one was triggered
+    The table is truncated & reloaded rather than replaced, so the
+    materialized views built on it (see views.py) survive the load
+    Rides finished since the last run (ride_ids: from the trigger) are added
+    to rider_summary in the same transaction (see rider_summary.py), and the
+    report snapshots of days whose rows changed are deleted
+
+    Returns:
+    - True if the table was rebuilt, False if skipped
     """
 
     logging.info('SCHEMA: %s', PRODUCTION_SCHEMA) # - check
-    df_dict = extract_staging_data()
-    clean_df = clean_dataframes(df_dict)
-    clean_df.to_sql(
-        'dash_table',
-        con=engine,
-        schema=PRODUCTION_SCHEMA,
-        if_exists='replace',
-        index=False
-    )
+    with engine.begin() as con:
+        arrived_at = con.execute('SELECT now()').scalar()
+        con.execute('SELECT pg_advisory_xact_lock(hashtext(%(target)s))', {'target': TARGET_TABLE})
+        ensure_transformation_runs(con)
+
+        last_started_at = con.execute(
+            f'SELECT started_at FROM {PRODUCTION_SCHEMA}.transformation_run WHERE target = %(target)s',
+            {'target': TARGET_TABLE}
+        ).scalar()
+        if last_started_at is not None and last_started_at > arrived_at:
+            logging.info('SKIPPED: %s REBUILT SINCE %s', TARGET_TABLE, arrived_at) # - check
+            return False
+
+        con.execute(
+            f"""
+            INSERT INTO {PRODUCTION_SCHEMA}.transformation_run (target, started_at)
+            VALUES (%(target)s, clock_timestamp())
+            ON CONFLICT (target) DO UPDATE SET started_at = EXCLUDED.started_at
+            """,
+            {'target': TARGET_TABLE}
+        )
+        df_dict = extract_staging_data(con)
+        clean_df = clean_dataframes(df_dict)
+        exists = con.execute(f"SELECT to_regclass('{PRODUCTION_SCHEMA}.{TARGET_TABLE}')").scalar() is not None
+        snapshots = exists and record_dash_days(con)
+        if exists:
+            con.execute(f'TRUNCATE {PRODUCTION_SCHEMA}.{TARGET_TABLE}')
+        clean_df.to_sql(
+            TARGET_TABLE,
+            con=con,
+            schema=PRODUCTION_SCHEMA,
+            if_exists='append' if exists else 'replace',
+            index=False
+        )
+        ensure_views(con)
+        riders = update_rider_summary(con, ride_ids)
+        logging.info('UPDATED %s RIDER SUMMARIES', riders) # - check
+        if snapshots:
+            logging.info('INVALIDATED %s REPORT SNAPSHOTS', invalidate_report_snapshots(con)) # - check
     logging.info('...COMPLETE!') # - check
+    return True
 
 def handler(event, context):
     """
     AWS Handler for Lambda Function
+    The engine is kept at module scope, so warm invocations reuse its connection
+
+    Returns:
+    - dictionary of whether this was a cold start, the rides it was
+      triggered for, whether it rebuilt dash_table & its duration
     """
+    global invocations
+    start = time.perf_counter()
+    cold_start = invocations == 0
+    invocations += 1
 
     # Make logger
     log = get_logger(logging.INFO)
@@ -186,5 +481,20 @@ def handler(event, context):
     full_date = datetime.now()
     log.info('DATE: %s', full_date) # - check
 
-    engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')    
-    sql_conversion()
\ No newline at end of file
+    ride_ids = parse_trigger(event)
+    log.info('TRIGGERED FOR %s FINISHED RIDES', len(ride_ids)) # - check
+
+    get_engine()
+    rebuilt = sql_conversion(ride_ids)
+    if rebuilt:
+        # after the load commits: readers keep the previous view rows until each refresh commits
+        refresh_views(engine)
+
+    if ARCHIVE_PATH:
+        # pyarrow is only imported when archiving
+        from archive import archive_finished_rides
+        archive_finished_rides(engine, ARCHIVE_PATH)
+
+    seconds = time.perf_counter() - start
+    log.info('COLD START: %s, INVOCATION: %s, SECONDS: %.2f', cold_start, invocations, seconds) # - check
+    return {'cold_start': cold_start, 'rides': len(ride_ids), 'rebuilt': rebuilt, 'seconds': seconds}
@@ -0,0 +1,134 @@
+"""Dashboard views:
+Materialized views of dash_table for the queries the dashboard, API &
+report run most, so readers get a few pre-grouped rows rather than
+grouping dash_table themselves.
+
+- recent_hourly_rides: rides of the last 12 hours by hour, gender, age
+  band & duration band (the dashboard's Recent Rides tab)
+- daily_ride_totals: the report's stats cells, by day, gender & age band
+  (see visualisation/report_stats.py)
+
+Each view has a unique index, so it is refreshed CONCURRENTLY after every
+load: readers keep the previous rows until the refresh commits, and are
+never blocked by it."""
+import logging
+import time
+
+import sqlalchemy
+
+PRODUCTION_SCHEMA = 'zuckerberg_production'
+
+RECENT_HOURLY_RIDES = f"""
+    SELECT
+        date_trunc('hour', time::timestamp) AS hour,
+        gender,
+        CASE
+            WHEN age > 18 AND age <= 25 THEN '18-25'
+            WHEN age > 25 AND age <= 35 THEN '25-35'
+            WHEN age > 35 AND age <= 45 THEN '35-45'
+            WHEN age > 45 AND age <= 55 THEN '45-55'
+            WHEN age > 55 AND age <= 65 THEN '55-65'
+            WHEN age > 65 THEN '65 or Above'
+        END AS age_band,
+        CASE
+            WHEN duration_seconds > 0 AND duration_seconds <= 300 THEN '0-300'
+            WHEN duration_seconds > 300 AND duration_seconds <= 400 THEN '300-400'
+            WHEN duration_seconds > 400 AND duration_seconds <= 500 THEN '400-500'
+            WHEN duration_seconds > 500 AND duration_seconds <= 600 THEN '500-600'
+            WHEN duration_seconds > 600 THEN '600 or Above'
+        END AS duration_band,
+        COUNT(ride_id) AS rides,
+        COALESCE(SUM(duration_seconds), 0) AS duration_total,
+        COUNT(duration_seconds) AS duration_count,
+        COALESCE(SUM(power_total), 0) AS power_total_sum,
+        COALESCE(SUM(power_avg), 0) AS power_avg_sum,
+        COUNT(power_avg) AS power_avg_count,
+        COALESCE(SUM(heart_rate_avg), 0) AS heart_rate_avg_sum,
+        COUNT(heart_rate_avg) AS heart_rate_avg_count,
+        COALESCE(SUM(rpm_avg), 0) AS rpm_avg_sum,
+        COUNT(rpm_avg) AS rpm_avg_count,
+        COALESCE(SUM(bmi), 0) AS bmi_sum,
+        COUNT(bmi) AS bmi_count
+    FROM {PRODUCTION_SCHEMA}.dash_table
+    WHERE time::timestamp >= (now() at time zone 'utc') - interval '12 hours'
+    GROUP BY 1, 2, 3, 4
+"""
+
+DAILY_RIDE_TOTALS = f"""
+    SELECT
+        LEFT(time, 10) AS day,
+        gender,
+        CASE
+            WHEN age > 18 AND age <= 25 THEN '18 - 25'
+            WHEN age > 25 AND age <= 35 THEN '26 - 35'
+            WHEN age > 35 AND age <= 45 THEN '36 - 45'
+            WHEN age > 45 AND age <= 55 THEN '46 - 55'
+            WHEN age > 55 AND age <= 65 THEN '56 - 65'
+            WHEN age > 65 THEN '65+'
+        END AS age_band,
+        COUNT(ride_id) AS rides,
+        COALESCE(SUM(duration_seconds), 0) AS duration_total,
+        COALESCE(SUM(TRUNC(duration_seconds)), 0) AS duration_whole_total,
+        COALESCE(SUM(heart_rate_avg), 0) AS heart_rate_avg_sum,
+        COUNT(heart_rate_avg) AS heart_rate_avg_count,
+        COALESCE(SUM(bmi), 0) AS bmi_sum,
+        COUNT(bmi) AS bmi_count,
+        COALESCE(SUM(power_total), 0) AS power_total_sum,
+        COALESCE(SUM(power_avg), 0) AS power_avg_sum,
+        COUNT(power_avg) AS power_avg_count
+    FROM {PRODUCTION_SCHEMA}.dash_table
+    GROUP BY 1, 2, 3
+"""
+
+# view -> (query, unique key columns, required by REFRESH ... CONCURRENTLY)
+VIEWS = {
+    'recent_hourly_rides': (RECENT_HOURLY_RIDES, ['hour', 'gender', 'age_band', 'duration_band']),
+    'daily_ride_totals': (DAILY_RIDE_TOTALS, ['day', 'gender', 'age_band'])
+}
+
+# Views no longer built, dropped wherever they're left (rider_totals: now the rider_summary table),
+# as they would block dropping dash_table
+RETIRED_VIEWS = ['rider_totals']
+
+def ensure_views(con) -> None:
+    """
+    Creates (& populates) the views & their unique indexes, if they don't exist yet,
+    & drops retired views
+    dash_table must exist
+    """
+    for view in RETIRED_VIEWS:
+        con.execute(f'DROP MATERIALIZED VIEW IF EXISTS {PRODUCTION_SCHEMA}.{view}')
+    for view, (query, key) in VIEWS.items():
+        con.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {PRODUCTION_SCHEMA}.{view} AS {query}')
+        con.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {view}_key ON {PRODUCTION_SCHEMA}.{view} ({', '.join(key)})"
+        )
+
+def drop_views(con) -> None:
+    """
+    Drops the views (& retired views), e.g. before dash_table is swapped for a new table
+    """
+    for view in [*VIEWS, *RETIRED_VIEWS]:
+        con.execute(f'DROP MATERIALIZED VIEW IF EXISTS {PRODUCTION_SCHEMA}.{view}')
+
+def refresh_views(engine: sqlalchemy.engine.Engine) -> dict:
+    """
+    Refreshes each view CONCURRENTLY, in its own transaction
+    A view that fails to refresh keeps its previous rows
+
+    Returns:
+    - dictionary of view -> refresh seconds (None if it failed)
+    """
+    seconds = {}
+    for view in VIEWS:
+        start = time.perf_counter()
+        try:
+            with engine.begin() as con:
+                con.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {PRODUCTION_SCHEMA}.{view}')
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error("Error raised whilst refreshing %s: %s", view, e)
+            seconds[view] = None
+            continue
+        seconds[view] = time.perf_counter() - start
+        logging.info('REFRESHED %s IN %.2fs', view, seconds[view]) # - check
+    return seconds
@@ -1,16 +1,19 @@
 import base64
 from datetime import date, datetime, timedelta
 import logging
+import multiprocessing
 import os
+import time
 
 import boto3
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-import numpy as np
 import pandas as pd
-import plotly.express as px
 import sqlalchemy
 
+from report_snapshots import PERIOD_DAYS, ensure_snapshot_table, get_period_cells
+from report_stats import summarise_stats
+
 load_dotenv()
 REGION = os.getenv('REGION')
 
@@ -28,6 +31,27 @@ TO_EMAIL = os.getenv('TO_EMAIL')
 
 PRODUCTION_SCHEMA = 'zuckerberg_production'
 
+# Kept at module scope, so warm invocations reuse the connection
+engine = None
+invocations = 0
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """
+    Creates the engine on the first invocation of a container
+
+    Returns:
+    - module engine
+    """
+    global engine
+    if engine is None:
+        engine = sqlalchemy.create_engine(
+            f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
+            pool_size=1,
+            max_overflow=0,
+            pool_pre_ping=True
+        )
+    return engine
+
 def get_logger(log_level: str) -> logging.Logger:
     """
     Returns:
@@ -40,68 +64,125 @@ def get_logger(log_level: str) -> logging.Logger:
     logger = logging.getLogger()                    
     return logger
 
-def extract_production_data() -> pd.DataFrame:
+def extract_production_stats(period: str) -> pd.DataFrame:
     """
-    Writes SQL table into dataframe
+    Aggregates production rides for the report period
+    - daily: since midnight
+    - weekly / monthly: the last 7 / 30 days, from cached daily snapshots
 
     Returns:
-    - Dataframe containing the last 24hrs of ride data
+    - stats cells dataframe (see report_stats)
     """
-    logging.info('EXTRACTING DATA...') # - check
+    logging.info('EXTRACTING %s STATS...', period.upper()) # - check
 
-    daily = date.strftime(date.today(), '%Y-%m-%d %H:%M:%S')
-    daily_df = pd.read_sql_query(
-        f"""
-            SELECT * FROM {PRODUCTION_SCHEMA}.dash_table
-            WHERE time >= '{daily}'
-        """
-    ,con=engine)
+    ensure_snapshot_table(engine)
+    cells = get_period_cells(engine, period)
 
-    return daily_df
+    return cells
 
-def create_image_file_base64_string(filepath: str) -> str:
+def create_image_base64_string(image: bytes) -> str:
     """
-    Converts png into a string
+    Converts png bytes into a string
     
     Returns:
     - image html uri
     """
-    data_uri = base64.b64encode(open(filepath, 'rb').read()).decode('utf-8')
+    data_uri = base64.b64encode(image).decode('utf-8')
     return data_uri
 
-def create_email() -> dict:
+def render_figure(figure, connection) -> None:
     """
-    Visualises data
-    Creates HTML format SES message
+    Renders a single figure as png bytes (runs in a child process)
+    Sends the bytes, or the raised error, back through the pipe
+    """
+    try:
+        connection.send(figure.to_image(format='png'))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+def render_figures(figures: dict) -> dict:
+    """
+    Renders plotly figures into png bytes concurrently
+    - one forked process (and kaleido instance) per figure
+    - Pipe instead of Pool/Queue, as Lambda has no /dev/shm
+
+    - every child is joined before returning, or stopped if a figure fails
 
     Returns:
-    - message dictionary
+    - dictionary of figure name -> png bytes
     """
-    daily_df = extract_production_data()
+    start = time.perf_counter()
+    context = multiprocessing.get_context('fork')
 
-    # stat: average heart rate
-    heart_rate = daily_df[['ride_id', 'gender', 'heart_rate_avg', 'heart_rate_min', 'heart_rate_max']]
-    avg_heart_rate_avg = heart_rate['heart_rate_avg'].mean()
+    jobs = {}
+    images = {}
+    try:
+        for name, figure in figures.items():
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=render_figure, args=(figure, sender))
+            process.start()
+            sender.close()
+            jobs[name] = (process, receiver)
+
+        for name, (process, receiver) in jobs.items():
+            try:
+                result = receiver.recv()
+            except EOFError as e:
+                # the child died before sending (e.g. killed for memory)
+                process.join()
+                raise RuntimeError(f'Rendering the {name} figure exited with code {process.exitcode} and no image') from e
+            if isinstance(result, Exception):
+                raise result
+            images[name] = result
+    finally:
+        for process, receiver in jobs.values():
+            receiver.close()
+            if len(images) < len(jobs):
+                process.terminate()
+            process.join()
+
+    logging.info('RENDERED %s FIGURES IN %.2fs', len(images), time.perf_counter() - start) # - check
+    return images
+
+def get_recipients(event: dict) -> list:
+    """
+    Recipients from the Lambda event (a list, or a comma separated string),
+    falling back to the comma separated TO_EMAIL environment variable
 
-    # stat: average bmi
-    bmi = daily_df[['ride_id', 'gender', 'bmi']]
-    avg_bmi = bmi['bmi'].mean()
+    Returns:
+    - list of email addresses
+    """
+    recipients = event.get('recipients') or TO_EMAIL or ''
+    if isinstance(recipients, str):
+        recipients = recipients.split(',')
+    return [recipient.strip() for recipient in recipients if recipient.strip()]
 
-    # stat: average bmi (by gender)
-    avg_bmi_gender = bmi.groupby('gender').agg({'bmi':'mean'}).reset_index()
-    avg_female_bmi = avg_bmi_gender[avg_bmi_gender['gender']=='female']['bmi'].max()
-    avg_male_bmi = avg_bmi_gender[avg_bmi_gender['gender']=='male']['bmi'].max()
+def create_email(period: str = 'daily') -> dict:
+    """
+    Visualises data for the report period
+    Creates HTML format SES message
 
-    # stat: average power
-    power = daily_df[['ride_id', 'gender', 'power_total', 'power_avg', 'power_min', 'power_max']]
-    total_power_total = power['power_total'].sum()
-    avg_power_avg = power['power_avg'].mean()
+    Returns:
+    - message dictionary
+    """
+    # plotly is only imported once a report is rendered (then cached by warm invocations)
+    import plotly.express as px
 
-    # visual: number of rides (by gender)
-    total_rides = daily_df['ride_id'].count()
+    title = f'{period.title()} Report'
+    stats = summarise_stats(extract_production_stats(period))
 
-    total_rides_gender = daily_df[['ride_id', 'gender']]
-    total_rides_gender = total_rides_gender.groupby('gender').count()
+    avg_heart_rate_avg = stats['avg_heart_rate_avg']
+    avg_bmi = stats['avg_bmi']
+    avg_female_bmi = stats['avg_female_bmi']
+    avg_male_bmi = stats['avg_male_bmi']
+    total_power_total = stats['total_power_total']
+    avg_power_avg = stats['avg_power_avg']
+
+    # visual: number of rides (by gender)
+    total_rides = stats['total_rides']
+    total_rides_gender = stats['rides_by_gender'].to_frame('ride_id')
 
     fig_total_rides = px.pie(
         total_rides_gender,
@@ -119,14 +200,10 @@ def create_email() -> dict:
         text=total_rides_gender['ride_id'].map('{:}'.format),
         textinfo='percent+text'
     )
-    fig_total_rides.write_image('/tmp/total_rides.png')
     
     # visual: total duration (by gender)
-    total_duration = int(daily_df['duration_seconds'].sum())
-
-    total_duration_gender = daily_df[['duration_seconds', 'gender']]
-    total_duration_gender['duration_seconds'] = total_duration_gender['duration_seconds'].astype(int)
-    total_duration_gender = total_duration_gender.groupby('gender').sum()
+    total_duration = stats['total_duration']
+    total_duration_gender = stats['duration_by_gender'].to_frame('duration_seconds')
 
     fig_total_duration = px.pie(
         total_duration_gender,
@@ -144,23 +221,9 @@ def create_email() -> dict:
         text=total_duration_gender['duration_seconds'].map('{:}'.format),
         textinfo='percent+text'
     )
-    fig_total_duration.write_image('/tmp/total_duration.png')
 
     # visual: ages
-    ages = daily_df[['ride_id', 'gender', 'age']]
-
-    age_bins = pd.cut(
-        ages['age'],
-        bins=[18, 25, 35, 45, 55, 65, np.Infinity],
-        labels=[
-            '18 - 25',
-            '26 - 35',
-            '36 - 45',
-            '46 - 55',
-            '56 - 65',
-            '65+'])
-
-    ages_split = ages.groupby(age_bins).agg({'ride_id': 'count'})
+    ages_split = stats['rides_by_age'].to_frame('ride_id')
 
     color = dict(enumerate([f'{row}' for row in ages_split.index],start=1))
 
@@ -185,12 +248,9 @@ def create_email() -> dict:
         # paper_bgcolor='rgba(0,0,0,0)',
         # plot_bgcolor='rgba(0,0,0,0)'
         legend_title_text='Ages')
-    fig_ages.write_image('/tmp/ages.png')
 
     # visual: ages (by gender)
-    ages_gender_split = ages.groupby(['gender', age_bins]).agg({'ride_id': 'count'})
-    ages_gender_pivot = ages_gender_split.reset_index()
-    ages_gender_pivot = ages_gender_pivot.pivot(index='age', columns='gender', values='ride_id')
+    ages_gender_pivot = stats['rides_by_age_gender']
 
     fig_ages_gender = px.bar(
         ages_gender_pivot,
@@ -213,7 +273,14 @@ def create_email() -> dict:
         # paper_bgcolor='rgba(0,0,0,0)',
         # plot_bgcolor='rgba(0,0,0,0)'
         legend_title_text='Gender')
-    fig_ages_gender.write_image('/tmp/ages_gender.png')
+
+    # render all figures at once
+    images = render_figures({
+        'total_rides': fig_total_rides,
+        'total_duration': fig_total_duration,
+        'ages': fig_ages,
+        'ages_gender': fig_ages_gender
+    })
 
     # email
     charset = 'UTF-8'
@@ -223,7 +290,7 @@ def create_email() -> dict:
                 <p>&nbsp;</p>
                 <div>
                 <h2 style="text-align: center;"><span style="color: #ff0000;"><img style="color: #000000; font-size: 14px;" src="https://user-images.githubusercontent.com/5181870/188019461-4a27a045-9301-4931-910c-b367f7b2709a.png" alt="fullwidth" width="380" height="141" /></span></h2>
-                <h2 style="text-align: center;"><span style="color: #ff0000;">Daily Report!</span></h2>
+                <h2 style="text-align: center;"><span style="color: #ff0000;">{title}!</span></h2>
                 </div>
                 <div>&nbsp;</div>
                 <div>
@@ -255,22 +322,22 @@ def create_email() -> dict:
                 <p>&nbsp;</p>
                 <p>Number of Rides (by gender)</p>
                 </div>
-                <img src="data:image/png;base64,{create_image_file_base64_string('/tmp/total_rides.png')}" width="400px" align ="left">
+                <img src="data:image/png;base64,{create_image_base64_string(images['total_rides'])}" width="400px" align ="left">
                 <div>
                 <p>&nbsp;</p>
                 <p>Total Duration (by gender)</p>
                 </div>
-                <img src="data:image/png;base64,{create_image_file_base64_string('/tmp/total_duration.png')}" width="400px" align ="left">
+                <img src="data:image/png;base64,{create_image_base64_string(images['total_duration'])}" width="400px" align ="left">
                 <div>
                 <p>&nbsp;</p>
                 <p>Ages</p>
                 </div>
-                <img src="data:image/png;base64,{create_image_file_base64_string('/tmp/ages.png')}" width="400px" align ="left">
+                <img src="data:image/png;base64,{create_image_base64_string(images['ages'])}" width="400px" align ="left">
                 <div>
                 <p>&nbsp;</p>
                 <p>Age (by gender)</p>
                 </div>
-                <img src="data:image/png;base64,{create_image_file_base64_string('/tmp/ages_gender.png')}" width="400px" align ="left">
+                <img src="data:image/png;base64,{create_image_base64_string(images['ages_gender'])}" width="400px" align ="left">
             </html>
         """
     
@@ -283,47 +350,65 @@ def create_email() -> dict:
                 },
                 "Subject": {
                     "Charset": charset,
-                    "Data": "Daily Report",
+                    "Data": title,
                 },
             }
     
     return message
 
-def send_report() -> bool:
+def send_report(period: str, recipients: list) -> dict:
     """
     Connects to SES via boto3 client
-    Sends SES message for daily report
+    Renders the report once, then sends it to each recipient
 
     Returns:
+    Dictionary of recipient ->
     - True if successfully sent
     - False if error occurred in attempting to send email
     """
-    message = create_email()
-    try:
-        ses_client = boto3.client('ses', REGION)
-
-        ses_client.send_email(
-            Destination={
-                "ToAddresses": [
-                    TO_EMAIL,
-                ],
-            },
-            Message=message,
-            Source=FROM_EMAIL,
-        )
-        return True
-    except Exception as e:
-        logging.error("""
-            Error occurred whilst trying to send email FROM %s
-            TO %s with SES:
-            %s
-            """, FROM_EMAIL, TO_EMAIL, e)
-        return False
+    message = create_email(period)
+    ses_client = boto3.client('ses', REGION)
+
+    sent = {}
+    for recipient in recipients:
+        try:
+            ses_client.send_email(
+                Destination={
+                    "ToAddresses": [
+                        recipient,
+                    ],
+                },
+                Message=message,
+                Source=FROM_EMAIL,
+            )
+            sent[recipient] = True
+        except Exception as e:
+            logging.error("""
+                Error occurred whilst trying to send email FROM %s
+                TO %s with SES:
+                %s
+                """, FROM_EMAIL, recipient, e)
+            sent[recipient] = False
+
+    return sent
     
 def handler(event, context):
     """
     AWS Handler for Lambda Function
+
+    Event (all optional):
+    - period: 'daily' (default), 'weekly' or 'monthly'
+    - recipients: list of email addresses (default TO_EMAIL)
+    The engine is kept at module scope, so warm invocations reuse its connection
+
+    Returns:
+    - dictionary of recipient -> sent, whether this was a cold start & its duration
     """
+    global invocations
+    start = time.perf_counter()
+    cold_start = invocations == 0
+    invocations += 1
+
     log = get_logger(logging.INFO)
 
     # Run Script
@@ -331,5 +416,17 @@ def handler(event, context):
     full_date = datetime.now()
     log.info('DATE: %s', full_date) # - check
 
-    engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')    
-    send_report()
\ No newline at end of file
+    event = event or {}
+    period = event.get('period', 'daily')
+    if period not in PERIOD_DAYS:
+        raise ValueError(f'Unknown report period: {period}')
+    recipients = get_recipients(event)
+    log.info('PERIOD: %s, RECIPIENTS: %s', period, len(recipients)) # - check
+
+    get_engine()
+    sent = send_report(period, recipients)
+    log.info('SENT: %s/%s', sum(sent.values()), len(sent)) # - check
+
+    seconds = time.perf_counter() - start
+    log.info('COLD START: %s, INVOCATION: %s, SECONDS: %.2f', cold_start, invocations, seconds) # - check
+    return {'sent': sent, 'cold_start': cold_start, 'seconds': seconds}
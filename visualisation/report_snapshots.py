@@ -0,0 +1,122 @@
+"""Report snapshots:
+Caches each finished day's stats cells in the production schema, so weekly &
+monthly reports merge precomputed days instead of rescanning dash_table."""
+from datetime import date, timedelta
+import logging
+
+import pandas as pd
+import sqlalchemy
+
+from report_stats import CELL_COLUMNS, PRODUCTION_SCHEMA, merge_stats_cells, query_stats_cells
+
+PERIOD_DAYS = {
+    'daily': 1,
+    'weekly': 7,
+    'monthly': 30
+}
+
+def ensure_snapshot_table(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Creates the snapshot table if it doesn't exist yet
+    """
+    with engine.begin() as con:
+        con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {PRODUCTION_SCHEMA}.report_snapshot (
+                day DATE PRIMARY KEY,
+                cells JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+            )
+            """
+        )
+
+def load_snapshots(engine: sqlalchemy.engine.Engine, first_day: date, last_day: date) -> dict:
+    """
+    Reads cached snapshots between first_day & last_day (inclusive)
+
+    Returns:
+    - dictionary of day -> stats cells dataframe
+    """
+    with engine.connect() as con:
+        rows = con.execute(
+            f"""
+            SELECT day, cells FROM {PRODUCTION_SCHEMA}.report_snapshot
+            WHERE day BETWEEN %s AND %s
+            """,
+            (first_day, last_day)
+        ).fetchall()
+
+    snapshots = {
+        row.day: pd.DataFrame(row.cells, columns=CELL_COLUMNS)
+        for row in rows
+    }
+    return snapshots
+
+def save_snapshots(engine: sqlalchemy.engine.Engine, snapshots: dict) -> None:
+    """
+    Writes day -> stats cells snapshots, replacing any existing ones
+    """
+    if not snapshots:
+        return
+
+    with engine.begin() as con:
+        con.execute(
+            f"""
+            INSERT INTO {PRODUCTION_SCHEMA}.report_snapshot (day, cells)
+            VALUES (%s, %s::jsonb)
+            ON CONFLICT (day) DO UPDATE SET
+            (cells, created_at) = (EXCLUDED.cells, EXCLUDED.created_at)
+            """,
+            [(day, cells.to_json(orient='records')) for day, cells in snapshots.items()]
+        )
+
+def split_cells_by_day(cells: pd.DataFrame, days: list) -> dict:
+    """
+    Splits stats cells into one dataframe per day
+    Days without any rides get an empty snapshot, so they are cached too
+
+    Returns:
+    - dictionary of day -> stats cells dataframe
+    """
+    by_day = {
+        day: cells[cells['day'] == day.isoformat()].reset_index(drop=True)
+        for day in days
+    }
+    return by_day
+
+def get_period_cells(engine: sqlalchemy.engine.Engine, period: str, today: date = None) -> pd.DataFrame:
+    """
+    Builds the stats cells for a report period ending today
+    - finished days come from the snapshot cache
+    - uncached finished days are aggregated in one query and cached
+    - today is always aggregated live, as rides are still coming in
+
+    Returns:
+    - merged stats cells dataframe
+    """
+    today = today or date.today()
+    first_day = today - timedelta(days=PERIOD_DAYS[period] - 1)
+    finished_days = [first_day + timedelta(days=i) for i in range((today - first_day).days)]
+
+    snapshots = load_snapshots(engine, first_day, today - timedelta(days=1)) if finished_days else {}
+    missing_days = [day for day in finished_days if day not in snapshots]
+    logging.info('SNAPSHOTS CACHED: %s, MISSING: %s', len(snapshots), len(missing_days)) # - check
+
+    if missing_days:
+        missing_cells = query_stats_cells(
+            engine,
+            date.strftime(missing_days[0], '%Y-%m-%d %H:%M:%S'),
+            date.strftime(missing_days[-1] + timedelta(days=1), '%Y-%m-%d %H:%M:%S')
+        )
+        new_snapshots = split_cells_by_day(missing_cells, missing_days)
+        save_snapshots(engine, new_snapshots)
+        snapshots.update(new_snapshots)
+
+    today_cells = query_stats_cells(
+        engine,
+        date.strftime(today, '%Y-%m-%d %H:%M:%S'),
+        date.strftime(today + timedelta(days=1), '%Y-%m-%d %H:%M:%S')
+    )
+
+    period_cells = merge_stats_cells([*snapshots.values(), today_cells])
+    return period_cells
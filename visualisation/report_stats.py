@@ -0,0 +1,191 @@
+"""Report statistics:
+Computes every metric the report email needs in a single aggregation pass.
+
+Rides are reduced to a handful of additive cells (one per day, gender & age band),
+which every statistic & graph in the report can be derived from.
+Cells are additive, so days can be cached and merged into longer periods."""
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+PRODUCTION_SCHEMA = 'zuckerberg_production'
+
+AGE_BINS = [18, 25, 35, 45, 55, 65, np.inf]
+AGE_LABELS = ['18 - 25', '26 - 35', '36 - 45', '46 - 55', '56 - 65', '65+']
+GENDERS = ['female', 'male']
+
+CELL_KEYS = ['day', 'gender', 'age_band']
+
+CELL_COLUMNS = [
+    'day',
+    'gender',
+    'age_band',
+    'rides',
+    'duration_total',
+    'duration_whole_total',
+    'heart_rate_avg_sum',
+    'heart_rate_avg_count',
+    'bmi_sum',
+    'bmi_count',
+    'power_total_sum',
+    'power_avg_sum',
+    'power_avg_count'
+]
+
+STATS_QUERY = f"""
+    SELECT
+        LEFT(time, 10) AS day,
+        gender,
+        CASE
+            WHEN age > 18 AND age <= 25 THEN '18 - 25'
+            WHEN age > 25 AND age <= 35 THEN '26 - 35'
+            WHEN age > 35 AND age <= 45 THEN '36 - 45'
+            WHEN age > 45 AND age <= 55 THEN '46 - 55'
+            WHEN age > 55 AND age <= 65 THEN '56 - 65'
+            WHEN age > 65 THEN '65+'
+        END AS age_band,
+        COUNT(ride_id) AS rides,
+        COALESCE(SUM(duration_seconds), 0) AS duration_total,
+        COALESCE(SUM(TRUNC(duration_seconds)), 0) AS duration_whole_total,
+        COALESCE(SUM(heart_rate_avg), 0) AS heart_rate_avg_sum,
+        COUNT(heart_rate_avg) AS heart_rate_avg_count,
+        COALESCE(SUM(bmi), 0) AS bmi_sum,
+        COUNT(bmi) AS bmi_count,
+        COALESCE(SUM(power_total), 0) AS power_total_sum,
+        COALESCE(SUM(power_avg), 0) AS power_avg_sum,
+        COUNT(power_avg) AS power_avg_count
+    FROM {PRODUCTION_SCHEMA}.dash_table
+    WHERE time >= %(start)s AND time < %(end)s
+    GROUP BY 1, 2, 3
+"""
+
+# the same cells, pre-grouped by day in the transformation's daily_ride_totals view
+DAILY_TOTALS_QUERY = f"""
+    SELECT {', '.join(CELL_COLUMNS)}
+    FROM {PRODUCTION_SCHEMA}.daily_ride_totals
+    WHERE day >= %(start)s AND day < %(end)s
+"""
+
+def query_stats_cells(engine: sqlalchemy.engine.Engine, start: str, end: str) -> pd.DataFrame:
+    """
+    Aggregates rides between start & end (inclusive, exclusive) in one SQL query
+    - start, end: '%Y-%m-%d %H:%M:%S' strings
+    Whole days are read from the daily_ride_totals view; dash_table is only
+    grouped for part days, or if the view hasn't been created yet
+
+    Returns:
+    - stats cells dataframe (one row per day, gender & age band)
+    """
+    if start[10:] in ('', ' 00:00:00') and end[10:] in ('', ' 00:00:00'):
+        try:
+            return pd.read_sql_query(DAILY_TOTALS_QUERY, con=engine, params={'start': start[:10], 'end': end[:10]})
+        except sqlalchemy.exc.ProgrammingError:
+            pass
+    cells = pd.read_sql_query(STATS_QUERY, con=engine, params={'start': start, 'end': end})
+    return cells[CELL_COLUMNS]
+
+def compute_stats_cells(rides_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates a dash_table dataframe in one groupby pass
+    Equivalent to query_stats_cells, for rides already in memory
+
+    Returns:
+    - stats cells dataframe (one row per day, gender & age band)
+    """
+    age_band = pd.cut(rides_df['age'], bins=AGE_BINS, labels=AGE_LABELS).astype(object)
+
+    cells = rides_df.assign(
+        day=rides_df['time'].str[:10],
+        age_band=age_band,
+        duration_whole=np.trunc(rides_df['duration_seconds'])
+    ).groupby(CELL_KEYS, dropna=False).agg(
+        rides=('ride_id', 'count'),
+        duration_total=('duration_seconds', 'sum'),
+        duration_whole_total=('duration_whole', 'sum'),
+        heart_rate_avg_sum=('heart_rate_avg', 'sum'),
+        heart_rate_avg_count=('heart_rate_avg', 'count'),
+        bmi_sum=('bmi', 'sum'),
+        bmi_count=('bmi', 'count'),
+        power_total_sum=('power_total', 'sum'),
+        power_avg_sum=('power_avg', 'sum'),
+        power_avg_count=('power_avg', 'count')
+    ).reset_index()
+
+    return cells[CELL_COLUMNS]
+
+def merge_stats_cells(cells_list: list) -> pd.DataFrame:
+    """
+    Merges stats cells (e.g. several daily snapshots) into one set of cells,
+    summing the additive columns per gender & age band
+
+    Returns:
+    - stats cells dataframe, with day set to the first day merged
+    """
+    cells_list = [cells for cells in cells_list if not cells.empty]
+    if not cells_list:
+        return pd.DataFrame(columns=CELL_COLUMNS)
+
+    cells = pd.concat(cells_list, ignore_index=True)
+
+    first_day = cells['day'].min()
+    merged = cells.drop(columns='day').groupby(['gender', 'age_band'], dropna=False).sum().reset_index()
+    merged['day'] = first_day
+
+    return merged[CELL_COLUMNS]
+
+def safe_divide(total: float, count: int) -> float:
+    """
+    Returns:
+    - total / count
+    - NaN if count is 0 (matches the pandas mean of an empty column)
+    """
+    return total / count if count else np.nan
+
+def summarise_stats(cells: pd.DataFrame) -> dict:
+    """
+    Derives the report statistics from the stats cells
+
+    Returns:
+    Dictionary with:
+    - scalar statistics (averages & totals)
+    - rides_by_gender, duration_by_gender (series indexed by gender)
+    - rides_by_age (series indexed by age band)
+    - rides_by_age_gender (dataframe indexed by age band, a column per gender)
+    """
+    totals = cells.drop(columns=CELL_KEYS).sum()
+    by_gender = cells.drop(columns=['day', 'age_band']).groupby('gender').sum()
+    by_age = cells.dropna(subset=['age_band'])
+
+    bmi_gender = {
+        gender: safe_divide(by_gender['bmi_sum'].get(gender, 0), by_gender['bmi_count'].get(gender, 0))
+        for gender in GENDERS
+    }
+
+    rides_by_age = by_age.groupby('age_band')['rides'].sum().reindex(AGE_LABELS, fill_value=0)
+    rides_by_age.index.name = 'age'
+
+    rides_by_age_gender = by_age.pivot_table(
+        index='age_band',
+        columns='gender',
+        values='rides',
+        aggfunc='sum'
+    ).reindex(index=AGE_LABELS, columns=GENDERS).fillna(0).astype(int)
+    rides_by_age_gender.index.name = 'age'
+    rides_by_age_gender.columns.name = 'gender'
+
+    stats = {
+        'total_rides': int(totals['rides']),
+        'total_duration': int(totals['duration_total']),
+        'avg_heart_rate_avg': safe_divide(totals['heart_rate_avg_sum'], totals['heart_rate_avg_count']),
+        'avg_bmi': safe_divide(totals['bmi_sum'], totals['bmi_count']),
+        'avg_female_bmi': bmi_gender['female'],
+        'avg_male_bmi': bmi_gender['male'],
+        'total_power_total': totals['power_total_sum'],
+        'avg_power_avg': safe_divide(totals['power_avg_sum'], totals['power_avg_count']),
+        'rides_by_gender': by_gender['rides'].astype(int),
+        'duration_by_gender': by_gender['duration_whole_total'].astype(int),
+        'rides_by_age': rides_by_age.astype(int),
+        'rides_by_age_gender': rides_by_age_gender
+    }
+
+    return stats
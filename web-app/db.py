@@ -23,33 +23,49 @@ TEST2_SCHEMA = 'zuckerberg_test_2'
 engine = sqlalchemy.create_engine(f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
 
 daily = datetime.strftime(datetime.today(), '%Y-%m-%d %H:%M:%S')
-twelve_hours = datetime.strftime(datetime.now() - timedelta(hours=12), '%Y-%m-%d %H:%M:%S')
 
-df = pd.read_sql_query(
+AGE_LABELS = ['18-25', '25-35', '35-45', '45-55', '55-65', '65 or Above']
+DURATION_LABELS = ['0-300', '300-400', '400-500', '500-600', '600 or Above']
+
+# last 12 hours of rides, pre-grouped by the transformation (hour, gender, age & duration band)
+recent_df = pd.read_sql_query(
     f"""
-        SELECT * FROM {PRODUCTION_SCHEMA}.dash_table
-        WHERE time >= '{twelve_hours}'
+        SELECT * FROM {PRODUCTION_SCHEMA}.recent_hourly_rides
     """
 ,con=engine)
 
-# changing account creation and time to datetime format
-df['account_creation'] = pd.to_datetime(df['account_creation'])
-df['time'] = pd.to_datetime(df['time'])
+recent_df['hour'] = pd.to_datetime(recent_df['hour']).dt.hour
+age_group_bins = pd.Categorical(recent_df['age_band'], categories=AGE_LABELS, ordered=True)
+duration_bins = pd.Categorical(recent_df['duration_band'], categories=DURATION_LABELS, ordered=True)
 
-# creating bins for age groups and ride duration in seconds
-age_group_bins = pd.cut(df['age'], bins = [18, 25, 35, 45, 55, 65, np.inf], labels = ['18-25', '25-35', '35-45', '45-55', '55-65', '65 or Above'])
-duration_bins = pd.cut(df['duration_seconds'], bins = [0, 300, 400, 500, 600, np.inf],
-labels=['0-300', '300-400', '400-500', '500-600', '600 or Above'])
+def sum_rides(keys) -> pd.DataFrame:
+    '''
+    Sums the view's rides & durations over the keys,
+    named like the dash_table columns they were counted from
+    '''
+    grouped = recent_df.groupby(keys)[['rides', 'duration_total', 'duration_count']].sum()
+    return grouped.rename(columns={'rides': 'ride_id', 'duration_total': 'duration_seconds'})
 
 # dataframes for age insights
-rides_by_age_df = df.groupby([age_group_bins])[['ride_id']].count()
-duration_by_age_df = df.groupby([age_group_bins])[['duration_seconds']].sum()
+rides_by_age = sum_rides(pd.Series(age_group_bins, name='age'))
+rides_by_age_df = rides_by_age[['ride_id']]
+duration_by_age_df = rides_by_age[['duration_seconds']]
 
-duration_rides_df = df.groupby([duration_bins])[['ride_id']].count()
+duration_rides_df = sum_rides(pd.Series(duration_bins, name='duration_seconds'))[['ride_id']]
 
 # dataframes for gender insights
-rides_by_gender_df = df.groupby(['gender'])[['ride_id']].count()
-duration_by_gender_df = df.groupby(['gender'])[['duration_seconds']].sum()
+rides_by_gender = sum_rides('gender')
+rides_by_gender_df = rides_by_gender[['ride_id']]
+duration_by_gender_df = rides_by_gender[['duration_seconds']]
+average_duration_by_gender = rides_by_gender['duration_seconds'] / rides_by_gender['duration_count']
+
+# averages for power insights
+totals = recent_df.sum(numeric_only=True)
+total_power = totals['power_total_sum']
+average_power = totals['power_avg_sum'] / totals['power_avg_count']
+average_heart_rate = totals['heart_rate_avg_sum'] / totals['heart_rate_avg_count']
+average_rpm = totals['rpm_avg_sum'] / totals['rpm_avg_count']
+average_bmi = totals['bmi_sum'] / totals['bmi_count']
 
 def get_indexes(df):
     '''
@@ -62,6 +78,6 @@ def get_indexes(df):
         second_index_list.append(index[1])
     return first_index_list, second_index_list
 
-df['hour'] = df['time'].dt.hour
-rides_by_hour_df = df.groupby(['hour', 'gender'])[['ride_id']].count()
-duration_by_hour_df = df.groupby(['hour', 'gender'])[['duration_seconds']].sum()
\ No newline at end of file
+rides_by_hour = sum_rides(['hour', 'gender'])
+rides_by_hour_df = rides_by_hour[['ride_id']]
+duration_by_hour_df = rides_by_hour[['duration_seconds']]
\ No newline at end of file
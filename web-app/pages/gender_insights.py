@@ -3,7 +3,7 @@ from dash import html, dcc, callback, Input, Output
 import dash_bootstrap_components as dbc
 import plotly.express as px
 
-from db import rides_by_gender_df, duration_by_gender_df, get_indexes, rides_by_hour_df, duration_by_hour_df, df
+from db import rides_by_gender_df, duration_by_gender_df, get_indexes, rides_by_hour_df, duration_by_hour_df, average_duration_by_gender
 
 fig1 = px.pie(rides_by_gender_df, values='ride_id', names=rides_by_gender_df.index,
 title='Number of Rides Split by Gender', color_discrete_sequence=['#7CC37C', '#E6E6D9'])
@@ -29,11 +29,8 @@ fig3.update_layout({'template':'plotly_dark',
 fig4.update_layout({'template':'plotly_dark',
 'paper_bgcolor': 'rgba(0, 0, 0, 0)'})
 
-male_df = df[df['gender'] == 'male']
-female_df = df[df['gender'] == 'female']
-
-average_male_duration = male_df['duration_seconds'].mean()
-average_female_duration = female_df['duration_seconds'].mean()
+average_male_duration = average_duration_by_gender.get('male', 0)
+average_female_duration = average_duration_by_gender.get('female', 0)
 
 gender_layout = html.Div(children=[
     dbc.Row([
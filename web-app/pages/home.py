@@ -4,6 +4,7 @@ import dash_bootstrap_components as dbc
 
 from pages.current_ride import current_ride_layout
 from pages.recent_rides import recent_rides_layout
+from pages.ride_timeline import ride_timeline_layout
 
 dash.register_page(__name__, path='/')
 
@@ -15,6 +16,7 @@ layout = html.Div(children=[
             [
                 dbc.Tab(label="Current Ride", tabClassName="flex-grow-1 text-center", tab_id="tab-1"),
                 dbc.Tab(label="Recent Rides", tabClassName="flex-grow-1 text-center", tab_id="tab-2"),
+                dbc.Tab(label="Ride Timeline", tabClassName="flex-grow-1 text-center", tab_id="tab-3"),
             ],
             id="tabs",
             active_tab="tab-1",
@@ -30,6 +32,8 @@ def switch_tab(at):
         return current_ride_layout
     elif at == "tab-2":
         return recent_rides_layout
+    elif at == "tab-3":
+        return ride_timeline_layout
     return html.P("This shouldn't ever be displayed...")
 
 "tab_style={'marginLeft': '41%'}"
\ No newline at end of file
@@ -2,18 +2,7 @@ import dash
 from dash import html, dcc, callback, Input, Output
 import dash_bootstrap_components as dbc
 
-from db import df
-
-# variables for power insights
-
-total_power = df['power_total'].sum()
-average_power = df['power_avg'].mean()
-
-average_heart_rate = df['heart_rate_avg'].mean()
-
-average_rpm = df['rpm_avg'].mean()
-
-average_bmi = df['bmi'].mean()
+from db import total_power, average_power, average_heart_rate, average_rpm, average_bmi
 
 power_layout = html.Div(children=[
     dbc.Row([
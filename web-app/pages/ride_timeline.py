@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from dash import html, dcc, callback, Input, Output
+import dash_bootstrap_components as dbc
+from dotenv import load_dotenv
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+load_dotenv()
+# Flask API serving the downsampled timelines (see flask/timeline.py)
+API_URL = os.getenv('API_URL', 'http://localhost:5001')
+TIMELINE_POINTS = int(os.getenv('TIMELINE_POINTS', '500'))
+
+TIMELINE_SERIES = {
+    'heart_rate': 'Heart Rate (bpm)',
+    'power': 'Power (W)',
+    'rpm': 'RPM'
+}
+
+ride_timeline_layout = html.Div(children=[
+    html.H3('Ride Timeline', style={'textAlign': 'center'}),
+    dbc.Row([
+        dbc.Col([
+            dbc.Input(id='timeline-ride-id', placeholder='Ride ID', type='text', debounce=True)
+        ], width=6),
+        dbc.Col([
+            dcc.Dropdown(
+                id='timeline-method',
+                options=[
+                    {'label': 'Largest triangle (LTTB)', 'value': 'lttb'},
+                    {'label': 'Min / max per bucket', 'value': 'minmax'}
+                ],
+                value='lttb',
+                clearable=False,
+                style={'color': 'black'}
+            )
+        ], width=3),
+        dbc.Col([
+            dbc.Input(id='timeline-points', type='number', min=3, step=1, value=TIMELINE_POINTS, debounce=True)
+        ], width=3)
+    ], style={'margin': '10px'}),
+    html.Div(id='timeline-content')
+])
+
+def get_ride_timeline(ride_id: str, points: int, method: str) -> dict:
+    """
+    Requests a ride's downsampled telemetry from the API
+
+    Returns:
+    - timeline dictionary (see the API's /ride/:id/timeline)
+    - None if the ride has no telemetry or the request fails
+    """
+    query = urllib.parse.urlencode({'points': points, 'method': method})
+    url = f"{API_URL}/ride/{urllib.parse.quote(ride_id, safe='')}/timeline?{query}"
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return json.load(response)
+    except (urllib.error.URLError, ValueError) as e:
+        logging.error("Error whilst requesting ride timeline: %s", e)
+        return None
+
+def generate_timeline_figure(timeline: dict) -> go.Figure:
+    """
+    Returns:
+    - plotly figure of heart rate, power & rpm over the ride, one row each
+    """
+    fig = make_subplots(rows=len(TIMELINE_SERIES), cols=1, shared_xaxes=True, vertical_spacing=0.05)
+    for row, (name, label) in enumerate(TIMELINE_SERIES.items(), start=1):
+        series = timeline['series'][name]
+        fig.add_trace(
+            go.Scattergl(x=series['duration_seconds'], y=series['value'], mode='lines', name=label),
+            row=row, col=1
+        )
+        fig.update_yaxes(title_text=label, row=row, col=1)
+    fig.update_xaxes(title_text='Duration (seconds)', row=len(TIMELINE_SERIES), col=1)
+    fig.update_layout(
+        template='plotly_dark',
+        height=700,
+        showlegend=False,
+        title=f"{timeline['readings']} readings, {timeline['method']} downsampled to {timeline['points']} points"
+    )
+    return fig
+
+@callback(
+    Output('timeline-content', 'children'),
+    Input('timeline-ride-id', 'value'),
+    Input('timeline-method', 'value'),
+    Input('timeline-points', 'value')
+    )
+def update_timeline(ride_id, method, points):
+    if not ride_id:
+        return html.P('Enter a ride ID to view its timeline', style={'textAlign': 'center'})
+    timeline = get_ride_timeline(ride_id, points or TIMELINE_POINTS, method)
+    if timeline is None:
+        return html.P(f'No timeline for ride: {ride_id}', style={'textAlign': 'center'})
+    return dcc.Graph(figure=generate_timeline_figure(timeline))